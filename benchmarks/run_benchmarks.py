@@ -0,0 +1,436 @@
+"""Benchmarks of the image analysis pipelines on synthetic movies
+
+Generates synthetic time-lapse data (moving Gaussian cells with known
+tracks and matching _MASK files), then runs the stages of each pipeline
+(open, background, detect, link, crop, measure, save) with the same ImageJ
+commands and settings as the scripts. Wall time, peak heap and throughput
+of every stage, and of the whole pipeline, are appended to
+benchmark_results.csv in the output folder, tagged with the git commit.
+
+Run headless from the repository root:
+    ImageJ-linux64 --headless --console --run benchmarks/run_benchmarks.py \
+        'repoDir="/path/to/imageJ-scripts",outputDir="/tmp/bench",width=512,height=512,frames=100,channels=1,cells=50,repeats=3,pipelines="all"'
+"""
+
+#@ File(label="Repository folder", style="directory") repoDir
+#@ File(label="Output directory", style="directory") outputDir
+#@ Integer(label="Width", value=512) width
+#@ Integer(label="Height", value=512) height
+#@ Integer(label="Frames", value=100) frames
+#@ Integer(label="Channels", value=1) channels
+#@ Integer(label="Cells", value=50) cells
+#@ Integer(label="Repeats", value=3) repeats
+#@ String(label="Pipelines (comma separated or all)", value="all") pipelines
+
+import os
+import sys
+import csv
+import time
+import socket
+import itertools
+import threading
+import subprocess
+from java.lang import Runtime, System
+from ij import IJ
+from ij.io import FileSaver
+from ij.plugin import ChannelSplitter, RGBStackMerge, ZProjector, ImageCalculator
+from ij.plugin.filter import ParticleAnalyzer
+from ij.plugin.frame import RoiManager
+from fiji.threshold import Auto_Local_Threshold as ALT
+from fiji.plugin.trackmate import Model, Settings, TrackMate
+from fiji.plugin.trackmate.detection import LogDetectorFactory
+from fiji.plugin.trackmate.tracking.jaqaman import SparseLAPTrackerFactory
+import fiji.plugin.trackmate.features.FeatureFilter as FeatureFilter
+import fiji.plugin.trackmate.features.track.TrackDurationAnalyzer as TrackDurationAnalyzer
+import fiji.plugin.trackmate.features.track.TrackIndexAnalyzer as TrackIndexAnalyzer
+import fiji.plugin.trackmate.features.spot.SpotContrastAndSNRAnalyzerFactory as SpotContrastAndSNRAnalyzerFactory
+import fiji.plugin.trackmate.features.spot.SpotIntensityMultiCAnalyzerFactory as SpotIntensityMultiCAnalyzerFactory
+
+sys.path.append(os.path.join(repoDir.getPath(), "scripts"))
+from ij_utils import synthetic, crops
+from ij_utils.spot_table import SpotTable
+
+MB = 1024.0 * 1024.0
+RESULT_COLUMNS = ['DATE', 'COMMIT', 'HOST', 'PIPELINE', 'STAGE', 'REPEAT', 'WIDTH', 'HEIGHT',
+                  'FRAMES', 'CHANNELS', 'CELLS', 'WALL_S', 'PEAK_HEAP_MB', 'ITEMS', 'UNIT', 'THROUGHPUT']
+
+
+def git_commit(repo):
+
+    """ Short hash of the checked-out commit, 'unknown' outside git """
+
+    try:
+        out = subprocess.check_output(["git", "-C", repo, "rev-parse", "--short", "HEAD"])
+        return out.strip()
+    except Exception:
+        return "unknown"
+
+
+class HeapSampler(object):
+
+    """ Track the peak used heap with a polling thread """
+
+    def __init__(self, interval=0.01):
+
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def used(self):
+        rt = Runtime.getRuntime()
+        return rt.totalMemory() - rt.freeMemory()
+
+    def _run(self):
+        while self.running:
+            self.peak = max(self.peak, self.used())
+            time.sleep(self.interval)
+
+    def start(self):
+        self.peak = self.used()
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.used())
+        return self.peak
+
+
+class Recorder(object):
+
+    """ Time the stages of a pipeline and append them to the results file """
+
+    def __init__(self, path, config):
+
+        self.path = path
+        self.config = config
+        self.rows = []
+
+    def stage(self, pipeline, stage, fn, unit):
+
+        """ Run fn() as a stage
+        :param fn: function returning (result, number of items processed)
+        :param unit: name of the items (frames, spots, tracks, rows)
+        :return: the result of fn
+        """
+
+        System.gc()
+        sampler = HeapSampler()
+        sampler.start()
+        t0 = time.time()
+        result, items = fn()
+        wall = time.time() - t0
+        peak = sampler.stop()
+        self.add(pipeline, stage, wall, peak, items, unit)
+        return result
+
+    def add(self, pipeline, stage, wall, peak, items, unit):
+
+        row = dict(self.config)
+        row.update({'PIPELINE': pipeline, 'STAGE': stage, 'WALL_S': "%.4f" % wall,
+                    'PEAK_HEAP_MB': "%.1f" % (peak / MB), 'ITEMS': items, 'UNIT': unit,
+                    'THROUGHPUT': "%.2f" % (items / wall) if wall > 0 else ""})
+        self.rows.append(row)
+        IJ.log(pipeline + " / " + stage + ": " + row['WALL_S'] + " s, " + row['THROUGHPUT'] + " " + unit + "/s")
+
+    def total(self, pipeline, items, unit):
+
+        """ Add the end-to-end row of a pipeline from its stage rows """
+
+        rows = [r for r in self.rows if r['PIPELINE'] == pipeline and r['REPEAT'] == self.config['REPEAT']]
+        wall = sum([float(r['WALL_S']) for r in rows])
+        peak = max([float(r['PEAK_HEAP_MB']) for r in rows]) * MB
+        self.add(pipeline, "total", wall, peak, items, unit)
+
+    def save(self):
+
+        new = not os.path.exists(self.path)
+        with open(self.path, 'ab') as out:
+            writer = csv.DictWriter(out, RESULT_COLUMNS)
+            if new:
+                writer.writeheader()
+            for row in self.rows:
+                writer.writerow(row)
+        self.rows = []
+
+
+#----------------------------
+# Shared stages
+#----------------------------
+
+def open_image(path):
+    imp = IJ.openImage(path)
+    return imp, imp.getNFrames()
+
+
+def subtract_background(imp, rolling):
+    IJ.run(imp, "Subtract Background...", "rolling=" + str(rolling) + " stack")
+    return imp, imp.getNFrames()
+
+
+def trackmate_settings(imp, target_channel, radius, threshold, duration, dist):
+
+    """ Detector/tracker settings used by the tracking scripts """
+
+    settings = Settings(imp)
+    settings.detectorFactory = LogDetectorFactory()
+    settings.detectorSettings = {
+        'DO_SUBPIXEL_LOCALIZATION': True,
+        'RADIUS': radius,
+        'TARGET_CHANNEL': target_channel,
+        'THRESHOLD': threshold,
+        'DO_MEDIAN_FILTERING': True,
+    }
+    settings.trackerFactory = SparseLAPTrackerFactory()
+    settings.trackerSettings = settings.trackerFactory.getDefaultSettings()
+    settings.trackerSettings['LINKING_MAX_DISTANCE'] = dist
+    settings.trackerSettings['GAP_CLOSING_MAX_DISTANCE'] = dist
+    settings.trackerSettings['MAX_FRAME_GAP'] = 5
+    settings.trackerSettings['ALLOW_TRACK_SPLITTING'] = False
+    settings.trackerSettings['ALLOW_TRACK_MERGING'] = False
+    spotIntensityAnalyzer = SpotIntensityMultiCAnalyzerFactory()
+    spotIntensityAnalyzer.setNChannels(imp.getNChannels())
+    settings.addSpotAnalyzerFactory(spotIntensityAnalyzer)
+    snrAnalyzer = SpotContrastAndSNRAnalyzerFactory()
+    snrAnalyzer.setNChannels(imp.getNChannels())
+    settings.addSpotAnalyzerFactory(snrAnalyzer)
+    settings.addTrackAnalyzer(TrackDurationAnalyzer())
+    settings.addTrackAnalyzer(TrackIndexAnalyzer())
+    settings.addTrackFilter(FeatureFilter('TRACK_DURATION', duration, True))
+    return settings
+
+
+def detect(trackmate):
+
+    """ Detection, spot features and spot filtering """
+
+    if not (trackmate.checkInput() and trackmate.execDetection() and trackmate.execInitialSpotFiltering()):
+        raise RuntimeError(str(trackmate.getErrorMessage()))
+    trackmate.computeSpotFeatures(False)
+    trackmate.execSpotFiltering(False)
+    return trackmate, trackmate.getModel().getSpots().getNSpots(True)
+
+
+def link(trackmate):
+
+    """ Linking, edge/track features and track filtering """
+
+    if not trackmate.execTracking():
+        raise RuntimeError(str(trackmate.getErrorMessage()))
+    trackmate.computeEdgeFeatures(False)
+    trackmate.computeTrackFeatures(False)
+    trackmate.execTrackFiltering(False)
+    return trackmate, trackmate.getModel().getSpots().getNSpots(True)
+
+
+#----------------------------
+# Pipelines
+#----------------------------
+
+def bench_track_n_crop(rec, data, out_dir):
+
+    name = "track_n_crop"
+    imp0 = rec.stage(name, "open", lambda: open_image(data['image']), "frames")
+    imp1 = IJ.openImage(data['mask'])
+    c1, c2, c3 = ChannelSplitter.split(imp1)
+    IJ.run(c1, "16-bit", "")
+    IJ.run(c2, "16-bit", "")
+    final = RGBStackMerge().mergeChannels([imp0, c1, c2], True)
+    final.setCalibration(imp0.getCalibration().copy())
+    n_frames = final.getNFrames()
+    rec.stage(name, "background", lambda: subtract_background(final, 15), "frames")
+
+    trackmate = TrackMate(Model(), trackmate_settings(final, 2, 2.0, 10, n_frames / 2, 3.0))
+    rec.stage(name, "detect", lambda: detect(trackmate), "spots")
+    rec.stage(name, "link", lambda: link(trackmate), "spots")
+
+    def crop():
+        table = SpotTable.from_model(trackmate.getModel(), final)
+        images = []
+        for tid in table.track_ids():
+            image = crops.new_crop_image(final, 17, 37)
+            crops.fill_track_crop(final, image, table, tid, 17, 37)
+            images.append((tid, image))
+        return images, len(images)
+
+    images = rec.stage(name, "crop", crop, "tracks")
+
+    def save():
+        for tid, image in images:
+            FileSaver(image).saveAsTiff(os.path.join(out_dir, "crop_" + str(tid) + ".tif"))
+        return None, len(images)
+
+    rec.stage(name, "save", save, "tracks")
+    rec.total(name, n_frames, "frames")
+
+
+def bench_trackmate_cells_plusRef(rec, data, out_dir):
+
+    name = "trackmate_cells_plusRef"
+    imp = rec.stage(name, "open", lambda: open_image(data['merged']), "frames")
+    n_frames = imp.getNFrames()
+    rec.stage(name, "background", lambda: subtract_background(imp, 20), "frames")
+
+    trackmate = TrackMate(Model(), trackmate_settings(imp, 3, 2.0, 10, n_frames / 2, 3.0))
+    rec.stage(name, "detect", lambda: detect(trackmate), "spots")
+    rec.stage(name, "link", lambda: link(trackmate), "spots")
+
+    def measure():
+        model = trackmate.getModel()
+        rows = []
+        for tid in model.getTrackModel().trackIDs(True):
+            for spot in model.getTrackModel().trackSpots(tid):
+                t = int(spot.getFeature('FRAME'))
+                ip = imp.getStack().getProcessor(imp.getStackIndex(1, 1, t + 1))
+                rows.append([tid, spot.getFeature('POSITION_X'), spot.getFeature('POSITION_Y'), t,
+                             spot.getFeature('MEAN_INTENSITY_CH1'), spot.getFeature('SNR_CH1'),
+                             ip.getStatistics().mean])
+        return rows, len(rows)
+
+    rows = rec.stage(name, "measure", measure, "spots")
+
+    def save():
+        with open(os.path.join(out_dir, "spots.csv"), 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(['TRACK_ID', 'POSITION_X', 'POSITION_Y', 'FRAME', 'MEAN_INTENSITY', 'SNR', 'REF'])
+            writer.writerows(rows)
+        return None, len(rows)
+
+    rec.stage(name, "save", save, "rows")
+    rec.total(name, n_frames, "frames")
+
+
+def bench_static_cell_measure_with_mask(rec, data, out_dir):
+
+    name = "static_cell_measure_with_mask"
+    imp = rec.stage(name, "open", lambda: open_image(data['image']), "frames")
+    ref_image = IJ.openImage(data['mask'])
+    n_frames = imp.getNFrames()
+    rec.stage(name, "background", lambda: subtract_background(imp, 15), "frames")
+
+    rm = RoiManager(True)
+    ParticleAnalyzer.setRoiManager(rm)
+
+    def detect_rois():
+        IJ.setThreshold(ref_image, 2, 65535)
+        IJ.run(ref_image, "Analyze Particles...", "size=0.5-Infinity circularity=0.10-0.95 add stack")
+        return None, rm.getCount()
+
+    rec.stage(name, "detect", detect_rois, "rois")
+    rt = rec.stage(name, "measure", lambda: (rm.multiMeasure(imp), rm.getCount()), "rois")
+
+    def save():
+        rt.saveAs(os.path.join(out_dir, "measure.csv"))
+        return None, rt.size()
+
+    rec.stage(name, "save", save, "rows")
+    rm.reset()
+    rm.close()
+    rec.total(name, n_frames, "frames")
+
+
+def bench_mask_maker(rec, data, out_dir):
+
+    name = "mask_maker"
+    imp = rec.stage(name, "open", lambda: open_image(data['image']), "frames")
+    n_frames = imp.getNFrames()
+    img, img2 = imp.duplicate(), imp.duplicate()
+
+    def background():
+        IJ.run(img, "Subtract...", "value=2000 stack")
+        IJ.run(img, "Subtract Background...", "rolling=12.5 stack")
+        IJ.run(img, "Despeckle", "stack")
+        IJ.run(img, "Enhance Contrast", "saturated=0.35")
+        IJ.run(img, "8-bit", "")
+        IJ.run(img2, "Subtract Background...", "rolling=12.5 stack")
+        return None, n_frames
+
+    rec.stage(name, "background", background, "frames")
+
+    def threshold():
+        img_Zave = ZProjector.run(img, "avg")
+        IJ.run(img_Zave, "Auto Local Threshold", "method=Phansalkar radius=0.7 parameter_1=0.2 parameter_2=0.1 white stack")
+        IJ.run(img_Zave, "Erode", "")
+        img_Zave.getProcessor().add(-254)
+        return img_Zave, n_frames
+
+    img_Zave = rec.stage(name, "detect", threshold, "frames")
+
+    def measure():
+        IJ.run(img2, "Gaussian Blur...", "sigma=2 stack")
+        ImageCalculator().run("Multiply stack", img2, img_Zave)
+        return None, n_frames
+
+    rec.stage(name, "measure", measure, "frames")
+    rec.stage(name, "save", lambda: (FileSaver(img2).saveAsTiff(os.path.join(out_dir, "mask.tif")), n_frames), "frames")
+    rec.total(name, n_frames, "frames")
+
+
+def bench_auto_thr_explorer(rec, data, out_dir):
+
+    name = "auto_thr_explorer"
+    imp = rec.stage(name, "open", lambda: open_image(data['image']), "frames")
+    ip = imp.getProcessor().convertToByteProcessor()
+    p_range = [0.0, 2.5, 5.0]
+
+    def threshold():
+        n = 0
+        for p1, p2 in itertools.product(p_range, p_range):
+            imp2 = IJ.createImage("p", "8-bit black", ip.getWidth(), ip.getHeight(), 1)
+            imp2.setProcessor(ip.duplicate())
+            ALT().exec(imp2, "Phansalkar", 15, p1, p2, True)
+            n += 1
+        return None, n
+
+    rec.stage(name, "detect", threshold, "combinations")
+    rec.total(name, len(p_range) ** 2, "combinations")
+
+
+PIPELINES = [('track_n_crop', bench_track_n_crop),
+             ('trackmate_cells_plusRef', bench_trackmate_cells_plusRef),
+             ('static_cell_measure_with_mask', bench_static_cell_measure_with_mask),
+             ('mask_maker', bench_mask_maker),
+             ('auto_thr_explorer', bench_auto_thr_explorer)]
+
+
+def make_data(out_dir):
+
+    """ Write the synthetic movie, its mask, the merged movie and the ground truth """
+
+    image, mask, tracks = synthetic.make_movie(width, height, frames, channels, cells, title="synthetic")
+    merged = synthetic.merged_movie(image, mask)
+    data = {'image': os.path.join(out_dir, "synthetic.tif"),
+            'mask': os.path.join(out_dir, "synthetic_MASK.tif"),
+            'merged': os.path.join(out_dir, "synthetic_merged.tif")}
+    FileSaver(image).saveAsTiff(data['image'])
+    FileSaver(mask).saveAsTiff(data['mask'])
+    FileSaver(merged).saveAsTiff(data['merged'])
+    synthetic.write_tracks(tracks, os.path.join(out_dir, "synthetic_tracks.csv"))
+    return data
+
+
+def run_benchmarks():
+
+    out_dir = outputDir.getPath()
+    data = make_data(out_dir)
+    selected = [p.strip() for p in pipelines.split(",")]
+    config = {'DATE': time.strftime("%Y-%m-%d %H:%M:%S"), 'COMMIT': git_commit(repoDir.getPath()),
+              'HOST': socket.gethostname(), 'WIDTH': width, 'HEIGHT': height, 'FRAMES': frames,
+              'CHANNELS': channels, 'CELLS': cells}
+    rec = Recorder(os.path.join(out_dir, "benchmark_results.csv"), config)
+
+    for name, bench in PIPELINES:
+        if "all" not in selected and name not in selected:
+            continue
+        for repeat in range(repeats):
+            rec.config['REPEAT'] = repeat
+            bench(rec, data, out_dir)
+            IJ.run("Close All", "")
+        rec.save()
+
+    return True
+
+run_benchmarks()
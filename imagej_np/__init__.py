@@ -0,0 +1,21 @@
+"""CPython/NumPy engine for the measurement pipelines
+
+Reimplements the core of the Fiji scripts so a batch can run on plain
+Python workers (numpy, scipy, tifffile) without a JVM:
+
+    measure.analyse_movie    static_cell_measure_with_mask.analyse_movie
+    mask.clean_image         mask_maker.clean_image
+    normalise.fl_normaliser  FL_normaliser.fl_normaliser
+
+reads the experiment results datasets the scripts write
+(results.read_dataset), and checks that a faster path gives the same outputs
+as the scripts (compare.compare_folders).
+
+Run ``python -m imagej_np --help`` for the command line.
+"""
+
+from imagej_np.measure import analyse_movie, write_multi_measure
+from imagej_np.mask import clean_image
+from imagej_np.normalise import fl_normaliser
+from imagej_np.results import read_dataset
+from imagej_np.compare import compare_folders, Tolerances
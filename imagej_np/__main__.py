@@ -0,0 +1,188 @@
+"""Command line of the NumPy engine
+
+    python -m imagej_np measure INPUT_DIR OUTPUT_DIR [--mask-suffixes _MASK,MASK] [--workers N]
+    python -m imagej_np clean IMAGE... --output OUTPUT_DIR [--workers N]
+    python -m imagej_np normalise IMAGE... --output OUTPUT_DIR [--workers N]
+    python -m imagej_np results DATASET [--columns A,B] [--where NAME=VALUE|NAME=LO:HI] [--csv OUT]
+    python -m imagej_np compare REFERENCE_DIR CANDIDATE_DIR [--tolerances JSON] [--report CSV]
+                                [--input DIR --reference-cmd CMD --candidate-cmd CMD]
+
+Files are processed in parallel with one worker process per file.
+"""
+
+import os
+import sys
+import argparse
+import functools
+from multiprocessing import Pool
+
+from imagej_np.tiff import open_stack, write_stack
+from imagej_np.measure import measure_pair, pair_files, MASK_SUFFIXES
+from imagej_np.mask import clean_image
+from imagej_np.normalise import fl_normaliser
+from imagej_np.results import read_dataset, write_csv
+from imagej_np import compare as equivalence
+
+
+def clean_file(path, output_dir):
+
+    """ clean_image on a file, saved as <image>_MASK.tif """
+
+    out = os.path.join(output_dir, os.path.basename(path).replace(".tif", "_MASK.tif"))
+    cleaned, _ = clean_image(open_stack(path))
+    write_stack(out, cleaned, like=path)
+    return out
+
+
+def normalise_file(path, output_dir):
+
+    """ fl_normaliser on a file, saved under the same name """
+
+    out = os.path.join(output_dir, os.path.basename(path))
+    if os.path.abspath(out) == os.path.abspath(path):
+        raise ValueError("Output folder must differ from the input folder: " + path)
+    write_stack(out, fl_normaliser(open_stack(path)), like=path)
+    return out
+
+
+def parse_value(text):
+
+    """ Number if the text is one, else the text """
+
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def parse_where(conditions):
+
+    """ NAME=VALUE or NAME=LO:HI (either bound may be empty) filters """
+
+    where = {}
+    for condition in conditions:
+        name, value = condition.split("=", 1)
+        if ":" in value:
+            lo, hi = value.split(":", 1)
+            where[name] = (parse_value(lo) if lo else None, parse_value(hi) if hi else None)
+        else:
+            where[name] = parse_value(value)
+    return where
+
+
+def results(args):
+
+    """ Read a results dataset, print its size or save the selection as CSV """
+
+    columns = args.columns.split(",") if args.columns else None
+    data = read_dataset(args.dataset, columns, parse_where(args.where))
+    if args.csv:
+        write_csv(data, args.csv)
+        print(args.csv)
+    else:
+        n = len(next(iter(data.values()))) if data else 0
+        print("%d rows, columns: %s" % (n, ", ".join(data)))
+
+
+def compare(args):
+
+    """ Run both paths if asked, then compare their output folders
+    :return: 0 if they are equivalent, 1 otherwise or if nothing was compared
+    """
+
+    times = []
+    if args.reference_cmd or args.candidate_cmd:
+        if not (args.reference_cmd and args.candidate_cmd and args.input):
+            raise SystemExit("--reference-cmd, --candidate-cmd and --input go together")
+        times.append(('command', equivalence.run_timed(args.reference_cmd, args.input, args.reference),
+                      equivalence.run_timed(args.candidate_cmd, args.input, args.candidate)))
+    findings, stages = equivalence.compare_folders(args.reference, args.candidate,
+                                                   equivalence.Tolerances.load(args.tolerances),
+                                                   args.labels.split(","))
+    times += stages
+    equivalence.print_report(findings, times, sys.stdout)
+    if args.report:
+        equivalence.write_report(findings, times, args.report)
+    if not findings:
+        sys.stderr.write("No result files in common between %s and %s\n" % (args.reference, args.candidate))
+        return 1
+    return 0 if all(f.ok for f in findings) else 1
+
+
+def run(task, items, workers):
+
+    """ task on every item, in a process pool if workers > 1 """
+
+    if workers > 1 and len(items) > 1:
+        pool = Pool(min(workers, len(items)))
+        try:
+            results = pool.imap_unordered(task, items)
+            for out in results:
+                print(out)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for item in items:
+            print(task(item))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m imagej_np", description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    measure = sub.add_parser('measure', help="static_cell_measure_with_mask on a folder of images + _MASK files")
+    measure.add_argument('input_dir')
+    measure.add_argument('output_dir')
+    measure.add_argument('--mask-suffixes', default=",".join(MASK_SUFFIXES),
+                         help="comma-separated suffixes of the mask names, e.g. cell_03_MASK.tif")
+
+    for name, help_text in (('clean', "mask_maker.clean_image"), ('normalise', "FL_normaliser.fl_normaliser")):
+        command = sub.add_parser(name, help=help_text)
+        command.add_argument('images', nargs='+')
+        command.add_argument('--output', required=True, help="output folder")
+
+    for command in sub.choices.values():
+        command.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="worker processes")
+
+    query = sub.add_parser('results', help="read an experiment dataset (<experiment>.results)")
+    query.add_argument('dataset')
+    query.add_argument('--columns', help="comma-separated columns, default all")
+    query.add_argument('--where', action='append', default=[], help="NAME=VALUE or NAME=LO:HI, repeatable")
+    query.add_argument('--csv', help="save the selected rows as CSV")
+
+    check = sub.add_parser('compare', help="check a candidate output folder against a reference one")
+    check.add_argument('reference', help="output folder of the reference (Fiji) path")
+    check.add_argument('candidate', help="output folder of the candidate path")
+    check.add_argument('--tolerances', help="JSON tolerances, see imagej_np/compare.py")
+    check.add_argument('--labels', default=",".join(equivalence.LABEL_PATTERNS),
+                       help="comma-separated name patterns of the label images")
+    check.add_argument('--report', help="save every comparison as CSV")
+    check.add_argument('--input', help="input folder, {input} in the commands")
+    check.add_argument('--reference-cmd', help="shell command writing the reference outputs to {output}")
+    check.add_argument('--candidate-cmd', help="shell command writing the candidate outputs to {output}")
+
+    args = parser.parse_args(argv)
+    if args.command == 'results':
+        results(args)
+    elif args.command == 'compare':
+        return compare(args)
+    elif args.command == 'measure':
+        pairs, unpaired = pair_files(args.input_dir, args.mask_suffixes.split(","))
+        for path in unpaired:
+            sys.stderr.write("No partner, skipped: %s\n" % path)
+        if not pairs:
+            parser.error("no image + mask pair in %s" % args.input_dir)
+        os.makedirs(args.output_dir, exist_ok=True)
+        run(functools.partial(measure_pair, output_dir=args.output_dir), pairs, args.workers)
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        task = clean_file if args.command == 'clean' else normalise_file
+        run(functools.partial(task, output_dir=args.output), args.images, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,574 @@
+"""Equivalence of a candidate output folder with a reference one
+
+A faster path (this engine, fused filters, another tracker) can replace the
+Fiji scripts once it gives the same numbers on the same inputs. The two
+output folders are compared file by file:
+
+    CSV tables     value by value, with per-column tolerances; rows are
+                   matched on TRACK_ID / FRAME / CHANNEL when present, else
+                   by order
+    datasets       (<experiment>.results, read with imagej_np.results) the
+                   same, rows matched on FILE / SERIES / FRAME / ROI /
+                   TRACK_ID
+    label images   objects matched by overlap (IoU), so label values may
+                   differ
+    other TIFFs    (crops, stacks) pixel by pixel
+
+Tracks are matched first: a track of the candidate corresponds to the
+reference track closest to it over their common frames, and its TRACK_ID
+(in tables and in crop file names) is translated before comparing; in a
+dataset tracks are matched movie by movie (FILE). The
+timing profiles of both runs (ij_utils.profiler summaries) and the wall time
+of the commands, when the harness runs them, are reported side by side.
+
+    findings, times = compare_folders(reference_dir, candidate_dir, Tolerances.load("tol.json"))
+"""
+
+import os
+import re
+import csv
+import json
+import math
+import time
+import fnmatch
+import subprocess
+
+import numpy as np
+from scipy import ndimage
+from scipy.optimize import linear_sum_assignment
+
+from imagej_np.tiff import open_stack
+from imagej_np.results import read_dataset
+
+DEFAULT_TOLERANCE = {'abs': 1e-6, 'rel': 1e-6}
+LABEL_PATTERNS = ['*_MASK*.tif', '*label*.tif']
+NAN_TEXT = ('', 'nan', 'none', 'null')
+KEY_COLUMNS = ['TRACK_ID', 'FRAME', 'CHANNEL']
+DATASET_KEY_COLUMNS = ['FILE', 'SERIES', 'FRAME', 'ROI', 'TRACK_ID']
+POSITION_COLUMNS = [('X', 'Y'), ('POSITION_X', 'POSITION_Y')]
+# headers of the files written by ij_utils.profiler: timings, not results
+PROFILE_HEADER = ['MOVIE', 'STAGE', 'CALLS', 'WALL_S']
+SUMMARY_HEADER = ['STAGE', 'MOVIES', 'CALLS', 'WALL_S']
+SKIPPED = ['*.json', '*.partial', '*.log']
+TRACK_CROP = re.compile(r'^(?P<movie>.*)_celln_(?P<tid>\d+)_path\d+\.tif$')
+REPORT_COLUMNS = ['KIND', 'FILE', 'ITEM', 'COMPARED', 'DIFFERENT', 'MAX_ABS', 'STATUS', 'DETAIL']
+
+
+class Tolerances(object):
+
+    """ Allowed differences
+    :param spec: dict as in the JSON file
+        {"default": {"abs": 1e-6, "rel": 1e-6},
+         "columns": {"Mean*": {"abs": 0.01}, "SPOT_ID": "ignore"},
+         "pixels": {"abs": 0, "fraction": 0},
+         "track_distance": 2.0, "min_iou": 0.5}
+    Column names are matched with fnmatch patterns, the first match wins.
+    """
+
+    def __init__(self, spec=None):
+
+        spec = spec or {}
+        self.default = dict(DEFAULT_TOLERANCE, **spec.get('default', {}))
+        self.columns = list(spec.get('columns', {}).items())
+        pixels = spec.get('pixels', {})
+        self.pixel_abs = pixels.get('abs', 0)
+        self.pixel_fraction = pixels.get('fraction', 0)
+        self.track_distance = spec.get('track_distance', 2.0)
+        self.min_iou = spec.get('min_iou', 0.5)
+
+    @classmethod
+    def load(cls, path=None):
+
+        if not path:
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def column(self, name):
+
+        """ (abs, rel) tolerance of a column, None if it is ignored """
+
+        for pattern, tol in self.columns:
+            if fnmatch.fnmatchcase(name, pattern):
+                if tol == 'ignore':
+                    return None
+                tol = dict(self.default, **tol)
+                return tol['abs'], tol['rel']
+        return self.default['abs'], self.default['rel']
+
+
+class Finding(object):
+
+    """ Result of one comparison: a column, a stack, a label image, a file """
+
+    def __init__(self, kind, name, item, compared=0, different=0, max_abs=0.0, detail=""):
+
+        self.kind = kind
+        self.name = name
+        self.item = item
+        self.compared = compared
+        self.different = different
+        self.max_abs = max_abs
+        self.detail = detail
+
+    @property
+    def ok(self):
+        return self.different == 0
+
+    def row(self):
+        return [self.kind, self.name, self.item, self.compared, self.different,
+                "%.6g" % self.max_abs, "ok" if self.ok else "DIFFERENT", self.detail]
+
+
+def parse_cell(text):
+
+    """ Float for numbers and NaN markers, the text otherwise """
+
+    if text.strip().lower() in NAN_TEXT:
+        return float('nan')
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def read_csv(path):
+
+    """ Header and rows of parsed cells """
+
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return [], []
+    return rows[0], [[parse_cell(cell) for cell in row] for row in rows[1:]]
+
+
+def dataset_cell(value):
+
+    """ A dataset value as read_csv would parse it: float or text """
+
+    return value if isinstance(value, str) else float(value)
+
+
+def read_results(path):
+
+    """ Header and rows of a results dataset, like read_csv """
+
+    data = read_dataset(path)
+    header = list(data)
+    return header, [[dataset_cell(v) for v in row] for row in zip(*[data[c] for c in header])]
+
+
+def is_profile(header):
+
+    return header[:4] == PROFILE_HEADER or header[:4] == SUMMARY_HEADER
+
+
+def close(a, b, abs_tol, rel_tol):
+
+    """ Whether two cells agree, and their absolute difference (0 for text) """
+
+    if isinstance(a, float) and isinstance(b, float):
+        if math.isnan(a) or math.isnan(b):
+            return math.isnan(a) and math.isnan(b), 0.0
+        diff = abs(a - b)
+        return diff <= abs_tol + rel_tol * abs(a), diff
+    return a == b, 0.0
+
+
+def track_positions(header, rows):
+
+    """ track id -> {frame: (x, y)} of a table with positions, None without """
+
+    if 'TRACK_ID' not in header or 'FRAME' not in header:
+        return None
+    for xc, yc in POSITION_COLUMNS:
+        if xc in header and yc in header:
+            it, ft, xi, yi = [header.index(c) for c in ('TRACK_ID', 'FRAME', xc, yc)]
+            tracks = {}
+            for row in rows:
+                tracks.setdefault(row[it], {})[row[ft]] = (row[xi], row[yi])
+            return tracks
+    return None
+
+
+def match_tracks(reference, candidate, max_distance):
+
+    """ Candidate tracks paired with the reference ones
+    The cost of a pair is the mean distance over their common frames; pairs
+    without common frames or farther than max_distance are not matched.
+    :param reference, candidate: track id -> {frame: (x, y)}
+    :return: dict candidate id -> reference id
+    """
+
+    ref_ids, cand_ids = sorted(reference), sorted(candidate)
+    if not ref_ids or not cand_ids:
+        return {}
+    distance = np.full((len(cand_ids), len(ref_ids)), np.inf)
+    cost = np.full(distance.shape, max_distance * 1e3 + 1)
+    for i, cid in enumerate(cand_ids):
+        for j, rid in enumerate(ref_ids):
+            common = set(candidate[cid]) & set(reference[rid])
+            if common:
+                distance[i, j] = np.mean([math.hypot(candidate[cid][f][0] - reference[rid][f][0],
+                                                     candidate[cid][f][1] - reference[rid][f][1]) for f in common])
+                # of two close tracks, the one overlapping longer wins
+                overlap = len(common) / float(max(len(candidate[cid]), len(reference[rid])))
+                cost[i, j] = distance[i, j] + max_distance * (1 - overlap)
+    rows, cols = linear_sum_assignment(cost)
+    return dict((cand_ids[i], ref_ids[j]) for i, j in zip(rows, cols) if distance[i, j] <= max_distance)
+
+
+def translate_tracks(header, rows, track_map):
+
+    """ Rows with their TRACK_ID translated with track_map (candidate id ->
+    reference id), unmatched tracks marked as such
+    """
+
+    if track_map is None or 'TRACK_ID' not in header:
+        return rows
+    it = header.index('TRACK_ID')
+    out = []
+    for row in rows:
+        row = list(row)
+        row[it] = track_map.get(row[it], "unmatched %s" % row[it])
+        out.append(row)
+    return out
+
+
+def keyed_rows(header, rows, key_columns=KEY_COLUMNS):
+
+    """ dict key -> row, the key made of the key columns present (row order
+    without any)
+    """
+
+    keys = [header.index(c) for c in key_columns if c in header]
+    out, seen = {}, {}
+    for n, row in enumerate(rows):
+        key = tuple(row[k] for k in keys) if keys else (n,)
+        # repeated keys (e.g. two spots of a track in a frame) in row order
+        seen[key] = seen.get(key, -1) + 1
+        out[key + (seen[key],)] = row
+    return out
+
+
+def format_key(value):
+
+    return "%g" % value if isinstance(value, float) else str(value)
+
+
+def compare_csv(name, reference_path, candidate_path, tol, track_map=None):
+
+    """ Findings of a table: one for the rows, one per column """
+
+    ref_header, ref_rows = read_csv(reference_path)
+    cand_header, cand_rows = read_csv(candidate_path)
+    return compare_table(name, ref_header, ref_rows, cand_header,
+                         translate_tracks(cand_header, cand_rows, track_map), tol)
+
+
+def compare_dataset(name, reference_path, candidate_path, tol):
+
+    """ Findings of a results dataset, as compare_csv; the tracks of each
+    movie (FILE) are matched separately, track ids being per movie
+    """
+
+    ref_header, ref_rows = read_results(reference_path)
+    cand_header, cand_rows = read_results(candidate_path)
+    findings = []
+    if 'FILE' in ref_header and 'FILE' in cand_header:
+        rf, cf = ref_header.index('FILE'), cand_header.index('FILE')
+        translated = []
+        for movie in sorted(set(row[cf] for row in cand_rows)):
+            movie_rows = [row for row in cand_rows if row[cf] == movie]
+            ref_tracks = track_positions(ref_header, [row for row in ref_rows if row[rf] == movie])
+            cand_tracks = track_positions(cand_header, movie_rows)
+            if ref_tracks is not None and cand_tracks is not None:
+                track_map = match_tracks(ref_tracks, cand_tracks, tol.track_distance)
+                unmatched = len(ref_tracks) + len(cand_tracks) - 2 * len(track_map)
+                findings.append(Finding('tracks', name, movie, len(ref_tracks), unmatched,
+                                        detail="%d vs %d tracks, %d matched" % (len(ref_tracks), len(cand_tracks),
+                                                                             len(track_map))))
+                movie_rows = translate_tracks(cand_header, movie_rows, track_map)
+            translated += movie_rows
+        cand_rows = translated
+    return findings + compare_table(name, ref_header, ref_rows, cand_header, cand_rows, tol, DATASET_KEY_COLUMNS)
+
+
+def compare_table(name, ref_header, ref_rows, cand_header, cand_rows, tol, key_columns=KEY_COLUMNS):
+
+    """ Findings of two tables already read: one for the rows, one per column """
+
+    ref = keyed_rows(ref_header, ref_rows, key_columns)
+    cand = keyed_rows(cand_header, cand_rows, key_columns)
+    common = [key for key in ref if key in cand]
+    missing = len(ref) - len(common)
+    extra = len(cand) - len(common)
+    findings = [Finding('rows', name, "rows", len(ref), missing + extra,
+                        detail="%d missing, %d extra" % (missing, extra) if missing or extra else "")]
+    columns = [c for c in ref_header if c in cand_header]
+    for c in ref_header + cand_header:
+        if c not in columns:
+            findings.append(Finding('column', name, c, 0, 1, detail="only in one table"))
+            columns.append(c)  # reported once
+    for c in columns:
+        if c not in ref_header or c not in cand_header:
+            continue
+        tolerance = tol.column(c)
+        if tolerance is None:
+            continue
+        ri, ci = ref_header.index(c), cand_header.index(c)
+        different, max_abs, example = 0, 0.0, ""
+        for key in common:
+            a, b = ref[key][ri], cand[key][ci]
+            same, diff = close(a, b, *tolerance)
+            max_abs = max(max_abs, diff)
+            if not same:
+                different += 1
+                if not example:
+                    example = "row %s: %s vs %s" % ("/".join(format_key(k) for k in key[:-1]) or key[-1], a, b)
+        findings.append(Finding('column', name, c, len(common), different, max_abs, example))
+    return findings
+
+
+def compare_stack(name, reference, candidate, tol):
+
+    """ Pixel by pixel, plane by plane """
+
+    if reference.shape != candidate.shape:
+        return Finding('stack', name, "pixels", 0, 1, detail="shape %s vs %s" % (reference.shape, candidate.shape))
+    different, max_abs = 0, 0.0
+    for p in range(len(reference)):
+        diff = np.abs(np.asarray(reference[p], np.float64) - np.asarray(candidate[p], np.float64))
+        different += int(np.count_nonzero(diff > tol.pixel_abs))
+        max_abs = max(max_abs, float(diff.max()) if diff.size else 0.0)
+    total = reference.size
+    allowed = int(tol.pixel_fraction * total)
+    return Finding('stack', name, "pixels", total, max(different - allowed, 0), max_abs,
+                   "%d pixels beyond %g" % (different, tol.pixel_abs) if different else "")
+
+
+def labels_of(plane):
+
+    """ Labels of a plane; a binary mask is labelled into 8-connected objects """
+
+    plane = np.asarray(plane)
+    if np.unique(plane).size <= 2:
+        return ndimage.label(plane > 0, structure=np.ones((3, 3), bool))[0]
+    return plane.astype(np.int64)
+
+
+def match_labels(reference, candidate, min_iou):
+
+    """ Objects of two label planes matched by IoU
+    :return: (reference objects, candidate objects, matched, sum of matched IoU)
+    """
+
+    ref_areas = np.bincount(reference.ravel())
+    cand_areas = np.bincount(candidate.ravel())
+    n_ref = int(np.count_nonzero(ref_areas[1:]))
+    n_cand = int(np.count_nonzero(cand_areas[1:]))
+    both = (reference > 0) & (candidate > 0)
+    pairs, inter = np.unique(np.stack([reference[both], candidate[both]]), axis=1, return_counts=True)
+    iou = inter / (ref_areas[pairs[0]] + cand_areas[pairs[1]] - inter).astype(np.float64)
+    # above 0.5 an object overlaps at most one other that well; below, best pairs first
+    matched, total, used_ref, used_cand = 0, 0.0, set(), set()
+    for k in np.argsort(-iou):
+        if iou[k] < min_iou:
+            break
+        r, c = pairs[0][k], pairs[1][k]
+        if r in used_ref or c in used_cand:
+            continue
+        used_ref.add(r)
+        used_cand.add(c)
+        matched += 1
+        total += iou[k]
+    return n_ref, n_cand, matched, total
+
+
+def compare_labels(name, reference, candidate, tol):
+
+    """ Objects of every plane matched by overlap """
+
+    if reference.shape != candidate.shape:
+        return Finding('labels', name, "objects", 0, 1, detail="shape %s vs %s" % (reference.shape, candidate.shape))
+    n_ref = n_cand = matched = 0
+    iou = 0.0
+    for p in range(len(reference)):
+        r, c, m, s = match_labels(labels_of(reference[p]), labels_of(candidate[p]), tol.min_iou)
+        n_ref, n_cand, matched, iou = n_ref + r, n_cand + c, matched + m, iou + s
+    different = (n_ref - matched) + (n_cand - matched)
+    detail = "%d vs %d objects, %d matched, mean IoU %.3f" % (n_ref, n_cand, matched, iou / matched if matched else 0)
+    return Finding('labels', name, "objects", n_ref, different, detail=detail)
+
+
+def stage_times(path):
+
+    """ Stage -> wall seconds of a profiler summary """
+
+    header, rows = read_csv(path)
+    return dict((row[0], row[header.index('WALL_S')]) for row in rows)
+
+
+def output_files(folder):
+
+    """ Relative paths of the result files of a folder, datasets
+    (<experiment>.results folders) included
+    """
+
+    found = []
+    for root, dirs, files in os.walk(folder):
+        found += [os.path.relpath(os.path.join(root, d), folder) for d in dirs if d.endswith('.results')]
+        dirs[:] = [d for d in dirs if not d.endswith(('.zarr', '.results'))]
+        for name in files:
+            if not any(fnmatch.fnmatch(name, p) for p in SKIPPED):
+                found.append(os.path.relpath(os.path.join(root, name), folder))
+    return sorted(found)
+
+
+def movie_map(name, maps):
+
+    """ Track map of the movie a file belongs to (longest matching stem) """
+
+    stems = [stem for stem in maps if name.startswith(stem)]
+    return maps[max(stems, key=len)] if stems else None
+
+
+def reference_name(name, maps, reference_files):
+
+    """ Reference file of a candidate file: crops per track are renamed with
+    the matching reference track id
+    """
+
+    match = TRACK_CROP.match(os.path.basename(name))
+    if match is None:
+        return name
+    track_map = movie_map(name, maps)
+    if track_map is None:
+        return name
+    tid = track_map.get(float(match.group('tid')))
+    if tid is None:
+        return None
+    prefix = os.path.join(os.path.dirname(name), match.group('movie') + "_celln_%d_path" % tid)
+    found = [f for f in reference_files if f.startswith(prefix) and TRACK_CROP.match(os.path.basename(f))]
+    return found[0] if found else None
+
+
+def compare_folders(reference_dir, candidate_dir, tol, label_patterns=LABEL_PATTERNS):
+
+    """ Compare every result file of two output folders
+    :return: (list of Finding, list of (stage, reference s, candidate s))
+    """
+
+    ref_files, cand_files = output_files(reference_dir), output_files(candidate_dir)
+    tables, profiles, maps, findings = set(), [], {}, []
+    for name in cand_files:
+        if not (name.endswith(".csv") and name in ref_files):
+            continue
+        ref_table = read_csv(os.path.join(reference_dir, name))
+        cand_table = read_csv(os.path.join(candidate_dir, name))
+        if is_profile(ref_table[0]):
+            if ref_table[0][:4] == SUMMARY_HEADER:
+                profiles.append(name)
+            continue
+        tables.add(name)
+        ref_tracks, cand_tracks = track_positions(*ref_table), track_positions(*cand_table)
+        if ref_tracks is not None and cand_tracks is not None:
+            stem = name[:-len(".csv")]
+            stem = stem[:-len("_spots")] if stem.endswith("_spots") else stem
+            maps[stem] = match_tracks(ref_tracks, cand_tracks, tol.track_distance)
+            unmatched = len(ref_tracks) + len(cand_tracks) - 2 * len(maps[stem])
+            findings.append(Finding('tracks', name, "tracks", len(ref_tracks), unmatched,
+                                    detail="%d vs %d tracks, %d matched" % (len(ref_tracks), len(cand_tracks),
+                                                                         len(maps[stem]))))
+
+    paired = set()
+    for name in cand_files:
+        if name.endswith(".csv"):
+            if name in tables:
+                paired.add(name)
+                findings += compare_csv(name, os.path.join(reference_dir, name), os.path.join(candidate_dir, name),
+                                        tol, movie_map(name, maps))
+            elif name not in ref_files:
+                findings.append(Finding('file', name, "file", 1, 1, detail="only in the candidate"))
+            else:
+                paired.add(name)  # a timing profile
+        elif name.endswith(".results"):
+            if name not in ref_files:
+                findings.append(Finding('file', name, "dataset", 1, 1, detail="only in the candidate"))
+                continue
+            paired.add(name)
+            findings += compare_dataset(name, os.path.join(reference_dir, name), os.path.join(candidate_dir, name), tol)
+        elif name.lower().endswith((".tif", ".tiff")):
+            ref_name = reference_name(name, maps, ref_files)
+            if ref_name is None or ref_name not in ref_files:
+                findings.append(Finding('file', name, "file", 1, 1, detail="no reference file"))
+                continue
+            paired.add(ref_name)
+            reference = open_stack(os.path.join(reference_dir, ref_name))
+            candidate = open_stack(os.path.join(candidate_dir, name))
+            if any(fnmatch.fnmatch(os.path.basename(name), p) for p in label_patterns):
+                findings.append(compare_labels(name, reference, candidate, tol))
+            else:
+                findings.append(compare_stack(name, reference, candidate, tol))
+    for name in ref_files:
+        if name not in paired and name.endswith((".csv", ".tif", ".tiff", ".results")):
+            findings.append(Finding('file', name, "file", 1, 1, detail="missing from the candidate"))
+
+    times = []
+    for name in profiles:
+        ref_times = stage_times(os.path.join(reference_dir, name))
+        cand_times = stage_times(os.path.join(candidate_dir, name))
+        for stage in list(ref_times) + [s for s in cand_times if s not in ref_times]:
+            times.append((stage, ref_times.get(stage), cand_times.get(stage)))
+    return findings, times
+
+
+def run_timed(command, input_dir, output_dir):
+
+    """ Run a shell command with {input} and {output} filled in
+    :return: wall time in seconds
+    """
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    started = time.time()
+    subprocess.check_call(command.format(input=input_dir, output=output_dir), shell=True)
+    return time.time() - started
+
+
+def speedup(reference, candidate):
+
+    if reference is None or candidate is None or candidate <= 0:
+        return ""
+    return "%.2fx" % (reference / candidate)
+
+
+def print_report(findings, times, out):
+
+    """ Differences first, then the timings side by side """
+
+    failed = [f for f in findings if not f.ok]
+    out.write("%d comparisons, %d different\n" % (len(findings), len(failed)))
+    for f in failed:
+        out.write("  %-8s %s [%s]: %d/%d different, max |diff| %.6g  %s\n"
+                  % (f.kind, f.name, f.item, f.different, f.compared, f.max_abs, f.detail))
+    if times:
+        out.write("%-24s %12s %12s %9s\n" % ("STAGE", "REFERENCE_S", "CANDIDATE_S", "SPEEDUP"))
+        for stage, ref, cand in times:
+            out.write("%-24s %12s %12s %9s\n" % (stage, "" if ref is None else "%.3f" % ref,
+                                                 "" if cand is None else "%.3f" % cand, speedup(ref, cand)))
+
+
+def write_report(findings, times, path):
+
+    """ Every comparison and timing as CSV """
+
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(REPORT_COLUMNS)
+        for f in findings:
+            writer.writerow(f.row())
+        for stage, ref, cand in times:
+            writer.writerow(['time', stage, "wall_s", "", "", "", speedup(ref, cand),
+                             "reference %s s, candidate %s s" % (ref, cand)])
@@ -0,0 +1,352 @@
+"""ImageJ filters reimplemented with NumPy/SciPy
+
+Each function follows the algorithm of the ImageJ command named in its
+docstring (kernel shapes, edge handling, float32 intermediates, rounding
+and clamping of integer results), so that results match Fiji to the
+rounding of the saved values.
+"""
+
+import math
+
+import numpy as np
+from scipy import ndimage
+
+
+# ---------------------------------------------------------------------------
+# Pixel arithmetic
+# ---------------------------------------------------------------------------
+
+def dtype_range(dtype):
+
+    """ (min, max) of an integer image type, None for float """
+
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return info.min, info.max
+    return None
+
+
+def to_type(values, dtype):
+
+    """ Round (Math.round) and clamp float results to an integer type,
+    as ImageJ processors do; float types are only cast
+    """
+
+    limits = dtype_range(dtype)
+    if limits is None:
+        return values.astype(dtype)
+    return np.clip(np.floor(values + 0.5), limits[0], limits[1]).astype(dtype)
+
+
+def subtract_value(plane, value):
+
+    """ Process>Math>Subtract... """
+
+    return to_type(plane.astype(np.float64) - value, plane.dtype)
+
+
+def multiply_value(plane, value):
+
+    """ Process>Math>Multiply... (Divide... multiplies by 1/value) """
+
+    if dtype_range(plane.dtype) is None:
+        return (plane * np.float32(value)).astype(plane.dtype)
+    return to_type(plane.astype(np.float64) * value, plane.dtype)
+
+
+# ---------------------------------------------------------------------------
+# Rank filters (Process>Filters, RankFilters)
+# ---------------------------------------------------------------------------
+
+def rank_kernel(radius):
+
+    """ Circular footprint of RankFilters for a radius """
+
+    if 1.5 <= radius < 1.75:
+        radius = 1.75
+    elif 2.5 <= radius < 2.85:
+        radius = 2.85
+    r2 = int(radius * radius) + 1
+    k = int(math.sqrt(r2 + 1e-10))
+    footprint = np.zeros((2 * k + 1, 2 * k + 1), bool)
+    for dy in range(-k, k + 1):
+        dx = int(math.sqrt(r2 - dy * dy + 1e-10))
+        footprint[dy + k, k - dx:k + dx + 1] = True
+    return footprint
+
+
+def median_filter(plane, radius):
+
+    """ Process>Filters>Median... (Despeckle is radius 1) """
+
+    out = ndimage.median_filter(plane.astype(np.float32), footprint=rank_kernel(radius), mode='nearest')
+    return to_type(out, plane.dtype)
+
+
+def mean_filter(plane, radius):
+
+    """ RankFilters MEAN as float32, edges padded with the nearest pixel """
+
+    footprint = rank_kernel(radius)
+    return ndimage.correlate(plane.astype(np.float64), footprint / float(footprint.sum()),
+                             mode='nearest').astype(np.float32)
+
+
+def variance_filter(plane, radius):
+
+    """ RankFilters VARIANCE (population variance) as float32 """
+
+    footprint = rank_kernel(radius)
+    weights = footprint / float(footprint.sum())
+    data = plane.astype(np.float64)
+    mean = ndimage.correlate(data, weights, mode='nearest')
+    mean2 = ndimage.correlate(data * data, weights, mode='nearest')
+    return np.maximum(mean2 - mean * mean, 0).astype(np.float32)
+
+
+def remove_outliers(plane, radius, threshold, bright=True):
+
+    """ Process>Noise>Remove Outliers... """
+
+    median = ndimage.median_filter(plane.astype(np.float32), footprint=rank_kernel(radius), mode='nearest')
+    data = plane.astype(np.float32)
+    outlier = data - median > threshold if bright else median - data > threshold
+    return to_type(np.where(outlier, median, data), plane.dtype)
+
+
+# ---------------------------------------------------------------------------
+# Gaussian blur (GaussianBlur)
+# ---------------------------------------------------------------------------
+
+def gaussian_kernel(sigma, accuracy):
+
+    """ One-sided ImageJ Gaussian kernel, tail smoothed and normalised """
+
+    k_radius = int(math.ceil(sigma * math.sqrt(-2 * math.log(accuracy)))) + 1
+    kernel = np.exp(-0.5 * np.arange(k_radius) ** 2 / (sigma * sigma)).astype(np.float32)
+    if k_radius > 3:
+        # smooth the kernel tail down to zero at k_radius
+        sqrt_slope = float('inf')
+        r = k_radius
+        while r > k_radius // 2:
+            r -= 1
+            a = math.sqrt(kernel[r]) / (k_radius - r)
+            if a < sqrt_slope:
+                sqrt_slope = a
+            else:
+                break
+        for r1 in range(r + 2, k_radius):
+            kernel[r1] = (k_radius - r1) ** 2 * sqrt_slope * sqrt_slope
+    total = kernel[0] + 2 * kernel[1:].astype(np.float64).sum()
+    return (kernel / total).astype(np.float32)
+
+
+def gaussian_blur(plane, sigma):
+
+    """ Process>Filters>Gaussian Blur... (edges padded with the nearest pixel) """
+
+    accuracy = 0.002 if plane.dtype == np.uint8 else 0.0002
+    half = gaussian_kernel(sigma, accuracy)
+    weights = np.concatenate([half[:0:-1], half])
+    out = plane.astype(np.float32)
+    for axis in (1, 0):
+        out = ndimage.correlate1d(out, weights, axis=axis, mode='nearest')
+    return to_type(out, plane.dtype)
+
+
+# ---------------------------------------------------------------------------
+# Rolling ball background (BackgroundSubtracter)
+# ---------------------------------------------------------------------------
+
+def rolling_ball(radius):
+
+    """ Ball of BackgroundSubtracter: (z values, shrink factor) """
+
+    if radius <= 10:
+        shrink, trim = 1, 24
+    elif radius <= 30:
+        shrink, trim = 2, 24
+    elif radius <= 100:
+        shrink, trim = 4, 32
+    else:
+        shrink, trim = 8, 40
+    small = max(radius / shrink, 1.0)
+    xtrim = int(trim * small) // 100
+    half = int(math.floor(small - xtrim + 0.5))
+    yy, xx = np.mgrid[-half:half + 1, -half:half + 1]
+    temp = small * small - xx * xx - yy * yy
+    z = np.where(temp > 0, np.sqrt(np.maximum(temp, 0)), 0).astype(np.float32)
+    return z, shrink
+
+
+def filter3x3_mean(data):
+
+    """ 3x3 mean of the presmoothing step, rows then columns """
+
+    out = data
+    for axis in (1, 0):
+        padded = np.concatenate([np.take(out, [0], axis), out, np.take(out, [-1], axis)], axis)
+        n = out.shape[axis]
+        a = np.take(padded, range(0, n), axis)
+        b = np.take(padded, range(1, n + 1), axis)
+        c = np.take(padded, range(2, n + 2), axis)
+        out = ((a + b + c) * np.float32(0.33333333)).astype(np.float32)
+    return out
+
+
+def shrink_image(data, factor):
+
+    """ Minimum over factor x factor blocks (partial blocks at the edges) """
+
+    h, w = data.shape
+    sh, sw = -(-h // factor), -(-w // factor)
+    padded = np.full((sh * factor, sw * factor), np.inf, np.float32)
+    padded[:h, :w] = data
+    return padded.reshape(sh, factor, sw, factor).min(axis=(1, 3))
+
+
+def interpolation_arrays(length, small_length, factor):
+
+    """ Indices and weights used to enlarge the shrunk background """
+
+    i = np.arange(length)
+    index = np.maximum((i - factor // 2) // factor, 0)
+    index = np.minimum(index, small_length - 2)
+    distance = ((i + np.float32(0.5)) / factor - (index + np.float32(0.5))).astype(np.float32)
+    return index, (1 - distance).astype(np.float32)
+
+
+def enlarge_image(small, shape, factor):
+
+    """ Bilinear enlargement of the shrunk background to the image size """
+
+    h, w = shape
+    xi, xw = interpolation_arrays(w, small.shape[1], factor)
+    yi, yw = interpolation_arrays(h, small.shape[0], factor)
+    lines = small[:, xi] * xw + small[:, xi + 1] * (1 - xw)
+    return (lines[yi] * yw[:, None] + lines[yi + 1] * (1 - yw[:, None])).astype(np.float32)
+
+
+def roll_ball(data, z):
+
+    """ Background under the ball: grey opening with the ball as
+    structuring element, the ball centre allowed up to its radius
+    outside the image
+    """
+
+    r = z.shape[0] // 2
+    padded = np.pad(data, r, mode='constant', constant_values=np.inf)
+    eroded = ndimage.grey_erosion(padded, structure=z, mode='constant', cval=np.inf)
+    eroded = np.pad(eroded, r, mode='constant', constant_values=-np.inf)
+    opened = ndimage.grey_dilation(eroded, structure=z, mode='constant', cval=-np.inf)
+    return opened[2 * r:-2 * r, 2 * r:-2 * r].astype(np.float32)
+
+
+def rolling_ball_background(plane, radius, presmooth=True):
+
+    """ Background of a plane with a dark background, as float32 """
+
+    z, shrink = rolling_ball(radius)
+    data = plane.astype(np.float32)
+    if presmooth:
+        data = filter3x3_mean(data)
+    if shrink > 1:
+        small = roll_ball(shrink_image(data, shrink), z)
+        return enlarge_image(small, data.shape, shrink)
+    return roll_ball(data, z)
+
+
+def subtract_background(plane, radius, presmooth=True):
+
+    """ Process>Subtract Background... (rolling ball, dark background) """
+
+    background = rolling_ball_background(plane, radius, presmooth)
+    if dtype_range(plane.dtype) is None:
+        return (plane - background).astype(plane.dtype)
+    limits = dtype_range(plane.dtype)
+    values = plane.astype(np.float32) - background + np.float32(0.5)
+    return np.clip(values, limits[0], limits[1]).astype(plane.dtype)
+
+
+# ---------------------------------------------------------------------------
+# Contrast and type conversion
+# ---------------------------------------------------------------------------
+
+def histogram_stats(plane, n_bins=256):
+
+    """ 256-bin histogram as ImageJ computes it for 16-bit and float images
+    :return: (histogram, hist_min, bin_size, min, max)
+    """
+
+    lo, hi = float(plane.min()), float(plane.max())
+    bin_size = (hi - lo) / n_bins
+    scale = n_bins / (hi - lo) if hi > lo else 0.0
+    index = np.minimum(((plane.astype(np.float64) - lo) * scale).astype(np.int64), n_bins - 1)
+    return np.bincount(index.ravel(), minlength=n_bins), lo, bin_size, lo, hi
+
+
+def saturated_range(plane, saturated):
+
+    """ Display range set by Process>Enhance Contrast (saturated=...) """
+
+    if plane.dtype == np.uint8:
+        hist = np.bincount(plane.ravel(), minlength=256)
+        hist_min, bin_size, lo, hi = 0.0, 1.0, float(plane.min()), float(plane.max())
+    else:
+        hist, hist_min, bin_size, lo, hi = histogram_stats(plane)
+    threshold = int(plane.size * saturated / 200.0)
+    above = np.nonzero(np.cumsum(hist) > threshold)[0]
+    hmin = above[0] if len(above) else 255
+    above = np.nonzero(np.cumsum(hist[::-1]) > threshold)[0]
+    hmax = 255 - above[0] if len(above) else 0
+    if hmax < hmin:
+        return lo, hi
+    vmin, vmax = hist_min + hmin * bin_size, hist_min + hmax * bin_size
+    if vmin == vmax:
+        vmin, vmax = lo, hi
+    if plane.dtype != np.float32:
+        vmin, vmax = int(vmin), int(vmax)
+    return vmin, vmax
+
+
+def to_8bit(plane, vmin, vmax):
+
+    """ Image>Type>8-bit with scaling from the display range """
+
+    if dtype_range(plane.dtype) is None:
+        scale = np.float32(255.0 / (vmax - vmin)) if vmax > vmin else np.float32(1.0)
+        values = (plane.astype(np.float32) - np.float32(vmin)) * scale + np.float32(0.5)
+        return np.clip(values, 0, 255).astype(np.uint8)
+    scale = 256.0 / (vmax - vmin + 1)
+    values = np.maximum(plane.astype(np.float64) - vmin, 0)
+    return np.minimum((values * scale + 0.5).astype(np.int64), 255).astype(np.uint8)
+
+
+# ---------------------------------------------------------------------------
+# Thresholds and binary operations
+# ---------------------------------------------------------------------------
+
+def phansalkar(plane, radius, k=0.25, r=0.5, p=2.0, q=10.0):
+
+    """ Image>Adjust>Auto Local Threshold, method=Phansalkar, white objects
+    The radius is truncated to an integer as the plugin does.
+    :param plane: 8-bit plane
+    :return: bool mask of the objects
+    """
+
+    radius = int(radius)
+    data = plane.astype(np.float32) / np.float32(255)
+    mean = mean_filter(data, radius).astype(np.float64)
+    std = np.sqrt(variance_filter(data, radius).astype(np.float64))
+    return data > mean * (1.0 + p * np.exp(-q * mean) + k * (std / r - 1.0))
+
+
+def erode(mask, count=1):
+
+    """ Process>Binary>Erode (black background, edges not padded)
+    A pixel is removed if at least count of its 8 neighbours are background.
+    """
+
+    neighbours = ndimage.correlate((~mask).astype(np.int32), np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]]),
+                                   mode='constant', cval=1)
+    return mask & (neighbours < count)
@@ -0,0 +1,45 @@
+"""NumPy version of mask_maker.clean_image
+
+    copy 1: Subtract 2000, Subtract Background (rolling=12.5), Despeckle,
+            Enhance Contrast (saturated=0.35), 8-bit
+            -> average projection -> Auto Local Threshold (Phansalkar
+            radius=0.7 parameter_1=0.2 parameter_2=0.1 white) -> Erode -> 0/1
+    copy 2: Subtract Background (rolling=12.5), Gaussian Blur (sigma=2)
+            -> multiplied by the 0/1 projection mask
+
+Auto Local Threshold only takes 8-bit images, so the float average
+projection is rounded to 8-bit before thresholding. The Remove Outliers
+step of the Fiji script works on copy 1 after the projection and does not
+change the result, so it is skipped.
+"""
+
+import numpy as np
+
+from imagej_np import filters
+
+
+def clean_image(stack, rolling=12.5, offset=2000, saturated=0.35, sigma=2.0):
+
+    """ Cleaned stack for the segmentation
+    :param stack: array (n_planes, height, width), 16-bit
+    :return: (cleaned stack, 0/1 projection mask)
+    """
+
+    # Enhance Contrast without "process_all" uses the first plane only
+    first = filters.median_filter(filters.subtract_background(filters.subtract_value(stack[0], offset),
+                                                              rolling), 1)
+    vmin, vmax = filters.saturated_range(first, saturated)
+
+    total = np.zeros(stack.shape[1:], np.float64)
+    cleaned = np.empty(stack.shape, stack.dtype)
+    for p in range(len(stack)):
+        plane = np.asarray(stack[p])
+        img = filters.subtract_background(filters.subtract_value(plane, offset), rolling)
+        img = filters.median_filter(img, 1)
+        total += filters.to_8bit(img, vmin, vmax)
+        cleaned[p] = filters.gaussian_blur(filters.subtract_background(plane, rolling), sigma)
+
+    average = (total / len(stack)).astype(np.float32)
+    binary = filters.phansalkar(filters.to_type(average, np.uint8), 0.7, k=0.2, r=0.1)
+    mask = filters.erode(binary).astype(stack.dtype)
+    return cleaned * mask, mask
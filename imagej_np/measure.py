@@ -0,0 +1,168 @@
+"""NumPy version of static_cell_measure_with_mask.analyse_movie
+
+    background subtraction (rolling=15 stack)
+    -> mask thresholded at 2-65535 on its first plane
+    -> Analyze Particles (size=0.5-Infinity circularity=0.10-0.95)
+    -> Multi Measure of every ROI on every plane
+
+The table has one row per plane and, for each ROI i (1-based, ROI Manager
+order), the columns Area, Mean, StdDev, Min, Max, X, Y and Median suffixed
+with i, as set by "Set Measurements... area mean median standard min
+centroid". The manual ROI review of the Fiji script is skipped.
+"""
+
+import os
+import csv
+
+import numpy as np
+
+from imagej_np import filters
+from imagej_np.tiff import open_stack, calibration
+from imagej_np.particles import analyze_particles
+
+STATS = ['Area', 'Mean', 'StdDev', 'Min', 'Max', 'X', 'Y', 'Median']
+# as the "Pairing suffixes" default of static_cell_measure_with_mask.py
+MASK_SUFFIXES = ('_MASK', 'MASK')
+EXTENSIONS = ('.tif', '.tiff')
+
+
+def roi_stats(plane, rois, n_rois, pw=1.0, ph=1.0):
+
+    """ Statistics of every ROI of a label image on one plane
+    :param plane: 2D image
+    :param rois: int label image, 0 is background
+    :param n_rois: number of ROIs
+    :return: array (n_rois, len(STATS)), NaN for empty ROIs
+    """
+
+    inside = rois > 0
+    labels = rois[inside]
+    values = plane[inside].astype(np.float64)
+    ys, xs = np.nonzero(inside)
+
+    n = np.bincount(labels, minlength=n_rois + 1)[1:].astype(np.float64)
+    total = np.bincount(labels, values, minlength=n_rois + 1)[1:]
+    total2 = np.bincount(labels, values * values, minlength=n_rois + 1)[1:]
+    sum_x = np.bincount(labels, xs + 0.5, minlength=n_rois + 1)[1:]
+    sum_y = np.bincount(labels, ys + 0.5, minlength=n_rois + 1)[1:]
+
+    # one sort gives min, max and median of every ROI
+    order = np.lexsort((values, labels))
+    sorted_values = values[order]
+    start = np.concatenate([[0], np.cumsum(n)[:-1]]).astype(np.int64)
+    count = n.astype(np.int64)
+    empty = count == 0
+    safe = np.where(empty, 0, start)
+    vmin = sorted_values[safe] if len(sorted_values) else np.zeros(n_rois)
+    vmax = sorted_values[np.maximum(safe + count - 1, 0)] if len(sorted_values) else np.zeros(n_rois)
+    median = sorted_values[safe + count // 2 - empty] if len(sorted_values) else np.zeros(n_rois)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / n
+        std = np.sqrt(np.maximum((n * total2 - total * total) / n / (n - 1), 0))
+        std[n < 2] = 0.0
+        out = np.column_stack([n * pw * ph, mean, std, vmin, vmax, sum_x / n * pw, sum_y / n * ph, median])
+    out[empty, 1:] = np.nan
+    return out
+
+
+def format_value(value, decimals=3):
+
+    """ Number as ResultsTable writes it: integers without decimals """
+
+    if np.isnan(value):
+        return "NaN"
+    if value == round(value) and abs(value) < 1e9:
+        return str(int(round(value)))
+    return "%.*f" % (decimals, value)
+
+
+def write_multi_measure(path, table):
+
+    """ Save a Multi Measure table (n_planes, n_rois, len(STATS)) as CSV """
+
+    n_planes, n_rois, _ = table.shape
+    with open(path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow([' '] + [stat + str(i + 1) for i in range(n_rois) for stat in STATS])
+        for p in range(n_planes):
+            writer.writerow([p + 1] + [format_value(v) for v in table[p].ravel()])
+
+
+def analyse_movie(image_path, mask_path, rolling=15, min_size=0.5, max_size=float('inf'),
+                  min_circularity=0.10, max_circularity=0.95):
+
+    """ Background-subtract a movie and measure the mask particles on every plane
+    :param image_path: movie TIFF
+    :param mask_path: matching _MASK TIFF
+    :return: array (n_planes, n_rois, len(STATS))
+    """
+
+    pw, ph, _ = calibration(image_path)
+    mask = open_stack(mask_path)
+    rois = analyze_particles(mask[0] >= 2, min_size, max_size, min_circularity, max_circularity,
+                             pixel_area=pw * ph)
+    n_rois = int(rois.max())
+
+    stack = open_stack(image_path)
+    table = np.empty((len(stack), n_rois, len(STATS)))
+    for p in range(len(stack)):
+        plane = filters.subtract_background(np.asarray(stack[p]), rolling)
+        table[p] = roi_stats(plane, rois, n_rois, pw, ph)
+    return table
+
+
+def measure_pair(pair, output_dir):
+
+    """ analyse_movie on an (image, mask) pair, the table saved as <image>.csv
+    :return: output path
+    """
+
+    image_path, mask_path = pair
+    out = os.path.join(output_dir, os.path.basename(image_path).replace(".tif", ".csv"))
+    write_multi_measure(out, analyse_movie(image_path, mask_path))
+    return out
+
+
+def classify(name, suffixes=MASK_SUFFIXES):
+
+    """ (stem, role) of a file name as ij_utils.dataset_index.PairingRules
+    does: the extension removed, then the longest mask suffix ending the stem
+    :return: (stem, 'mask' or 'raw'), None if it is not an image
+    """
+
+    lower = name.lower()
+    for ext in EXTENSIONS:
+        if lower.endswith(ext):
+            stem = name[:-len(ext)]
+            break
+    else:
+        return None
+    for suffix in sorted(suffixes, key=len, reverse=True):
+        if stem.endswith(suffix) and len(stem) > len(suffix):
+            return stem[:-len(suffix)], 'mask'
+    return stem, 'raw'
+
+
+def pair_files(folder, suffixes=MASK_SUFFIXES):
+
+    """ Images and masks of a folder paired by stem (cell_03.tif with
+    cell_03_MASK.tif), whatever order they are listed in
+    :return: (list of (image, mask) paths in stem order, sorted list of the
+             files without a partner)
+    """
+
+    groups = {}
+    for name in sorted(os.listdir(folder)):
+        found = classify(name, suffixes)
+        if found is not None:
+            # the first of e.g. cell.tif and cell.tiff is kept
+            groups.setdefault(found[0], {}).setdefault(found[1], os.path.join(folder, name))
+    pairs, unpaired = [], []
+    for stem in sorted(groups):
+        group = groups[stem]
+        if 'raw' in group and 'mask' in group:
+            pairs.append((group['raw'], group['mask']))
+        else:
+            unpaired.extend(group.values())
+    return pairs, sorted(unpaired)
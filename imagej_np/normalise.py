@@ -0,0 +1,20 @@
+"""NumPy version of FL_normaliser.fl_normaliser"""
+
+import numpy as np
+
+from imagej_np import filters
+
+
+def fl_normaliser(stack):
+
+    """ Divide each plane by its own mean, as Process>Math>Divide... does
+    (integer images are rounded and clamped)
+    :param stack: array (n_planes, height, width)
+    :return: normalised stack of the same type
+    """
+
+    out = np.empty(stack.shape, stack.dtype)
+    for p in range(len(stack)):
+        plane = np.asarray(stack[p])
+        out[p] = filters.multiply_value(plane, 1.0 / plane.mean(dtype=np.float64))
+    return out
@@ -0,0 +1,120 @@
+"""Analyze Particles on a thresholded plane
+
+Particles are 8-connected, found in raster order of their first pixel as
+ParticleAnalyzer scans the image. Each particle becomes the traced outline
+ImageJ adds to the ROI Manager: the interior of its outer boundary, holes
+included. Size is filtered on the thresholded pixels inside the outline and
+circularity on the traced perimeter (PolygonRoi.getTracedPerimeter).
+"""
+
+import math
+
+import numpy as np
+from scipy import ndimage
+
+EIGHT = np.ones((3, 3), bool)
+
+
+def trace_outline(inside, x0, y0):
+
+    """ Vertices of the outer crack boundary of an 8-connected particle
+    :param inside: bool array of the particle, with a one pixel empty border
+    :param x0, y0: first pixel of the particle in raster order
+    :return: list of (x, y) vertices where the direction changes
+    """
+
+    # start at the top-left corner of the first pixel heading right,
+    # the particle on the right-hand side (y points down)
+    x, y, dx, dy = x0, y0, 1, 0
+    vertices = []
+    while True:
+        # pixels ahead of the vertex on the left and on the right
+        lx, ly = x + min(0, dx) + min(0, dy), y + min(0, dy) + min(0, -dx)
+        rx, ry = x + min(0, dx) + min(0, -dy), y + min(0, dy) + min(0, dx)
+        if inside[ly, lx]:
+            ndx, ndy = dy, -dx
+        elif inside[ry, rx]:
+            ndx, ndy = dx, dy
+        else:
+            ndx, ndy = -dy, dx
+        if (ndx, ndy) != (dx, dy) or not vertices:
+            vertices.append((x, y))
+        dx, dy = ndx, ndy
+        x, y = x + dx, y + dy
+        # the first corner only touches the first pixel: it is reached once
+        if (x, y) == (x0, y0):
+            break
+    return vertices
+
+
+def traced_perimeter(vertices):
+
+    """ PolygonRoi.getTracedPerimeter of a traced outline """
+
+    n = len(vertices)
+    sum_dx = sum_dy = n_corners = 0
+    dx1 = vertices[0][0] - vertices[-1][0]
+    dy1 = vertices[0][1] - vertices[-1][1]
+    side1 = abs(dx1) + abs(dy1)
+    corner = False
+    for i in range(n):
+        nxt = vertices[(i + 1) % n]
+        dx2, dy2 = nxt[0] - vertices[i][0], nxt[1] - vertices[i][1]
+        sum_dx += abs(dx1)
+        sum_dy += abs(dy1)
+        side2 = abs(dx2) + abs(dy2)
+        if side1 > 1 or not corner:
+            corner = True
+            n_corners += 1
+        else:
+            corner = False
+        dx1, dy1, side1 = dx2, dy2, side2
+    return sum_dx + sum_dy - n_corners * (2.0 - math.sqrt(2.0))
+
+
+def analyze_particles(thresholded, min_size=0.0, max_size=float('inf'),
+                      min_circularity=0.0, max_circularity=1.0, pixel_area=1.0):
+
+    """ Analyze Particles... with "add": the ROIs as a label image
+    :param thresholded: bool plane, True inside the threshold
+    :param min_size, max_size: size range in calibrated units
+    :param pixel_area: calibrated area of a pixel
+    :return: int32 label image, ROI i + 1 is label i + 1 in ROI Manager order
+    """
+
+    labels, n = ndimage.label(thresholded, structure=EIGHT)
+    rois = np.zeros(thresholded.shape, np.int32)
+    if n == 0:
+        return rois
+
+    # first pixel of each particle in raster order
+    flat = np.arange(labels.size).reshape(labels.shape)
+    first = np.asarray(ndimage.minimum(flat, labels, np.arange(1, n + 1)), np.int64)
+    boxes = ndimage.find_objects(labels)
+    consumed = np.zeros(thresholded.shape, bool)
+    min_pixels, max_pixels = min_size / pixel_area, max_size / pixel_area
+
+    count = 0
+    for label in np.argsort(first, kind='stable') + 1:
+        y0, x0 = divmod(int(first[label - 1]), labels.shape[1])
+        if consumed[y0, x0]:
+            # inside the outline of a particle already analysed
+            continue
+        sy, sx = boxes[label - 1]
+        particle = np.pad(labels[sy, sx] == label, 1)
+        outline = ndimage.binary_fill_holes(particle)[1:-1, 1:-1]
+        pixels = int(np.count_nonzero(outline & thresholded[sy, sx]))
+        consumed[sy, sx] |= outline
+
+        if not min_pixels <= pixels <= max_pixels:
+            continue
+        if min_circularity > 0.0 or max_circularity != 1.0:
+            perimeter = traced_perimeter(trace_outline(particle, x0 - sx.start + 1, y0 - sy.start + 1))
+            circularity = 4.0 * math.pi * (pixels / (perimeter * perimeter)) if perimeter else 0.0
+            if circularity > 1.0 and max_circularity <= 1.0:
+                circularity = 1.0
+            if not min_circularity <= circularity <= max_circularity:
+                continue
+        count += 1
+        rois[sy, sx][outline] = count
+    return rois
@@ -0,0 +1,166 @@
+"""Reader of the experiment results datasets written by ij_utils.results_sink
+
+    data = read_dataset("/data/results/exp01.results", columns=['FILE', 'FRAME', 'Mean'],
+                        where={'FILE': 'movie_03.tif', 'FRAME': (1, 50)})
+    data['Mean']                         # numpy array
+
+Row groups are selected on the statistics of the index (min/max of each
+column, constant key columns) before any block is read, then the rows of
+the selected groups are filtered. Columns missing from a group are NaN (or
+empty strings).
+"""
+
+import os
+import json
+import zlib
+
+import numpy as np
+
+DTYPES = {'i8': '<i8', 'f8': '<f8'}
+
+
+def read_index(path):
+
+    """ Current row groups of every part, an image re-appended in another
+    part superseding the older groups of the same key
+    :return: list of row group dicts with their 'part' data file
+    """
+
+    groups = {}
+    for name in sorted(os.listdir(path)):
+        if not (name.startswith("part-") and name.endswith(".json")):
+            continue
+        with open(os.path.join(path, name)) as f:
+            index = json.load(f)
+        data = os.path.join(path, name[:-len(".json")] + ".bin")
+        for group in index['row_groups']:
+            group['part'] = data
+            groups.setdefault(group['key'], []).append(group)
+    out = []
+    for key, found in groups.items():
+        latest = max(g['written'] for g in found)
+        out.extend(g for g in found if g['written'] == latest)
+    return sorted(out, key=lambda g: g['written'])
+
+
+def _bounds(condition):
+
+    """ (lo, hi) of a filter value: equality or an inclusive (lo, hi) range """
+
+    if isinstance(condition, tuple):
+        return condition
+    return condition, condition
+
+
+def group_may_match(group, where):
+
+    """ False when the statistics of a row group exclude a filter """
+
+    for name, condition in where.items():
+        meta = group['columns'].get(name)
+        if meta is None:
+            return False
+        lo, hi = _bounds(condition)
+        if 'const' in meta:
+            gmin = gmax = meta['const']
+        elif 'min' in meta:
+            gmin, gmax = meta['min'], meta['max']
+        else:
+            return False  # only NaN / no rows
+        if (lo is not None and gmax < lo) or (hi is not None and gmin > hi):
+            return False
+    return True
+
+
+def read_column(group, name, handle):
+
+    """ Values of one column of a row group """
+
+    meta = group['columns'].get(name)
+    n = group['rows']
+    if meta is None:
+        return np.full(n, np.nan)
+    if 'const' in meta:
+        return np.full(n, meta['const'], dtype=object if meta['type'] == 'str' else None)
+    handle.seek(meta['offset'])
+    raw = zlib.decompress(handle.read(meta['length']))
+    if meta['type'] == 'str':
+        return np.array(json.loads(raw.decode('utf-8')), dtype=object)
+    return np.frombuffer(raw, dtype=DTYPES[meta['type']])
+
+
+def row_mask(data, where):
+
+    mask = None
+    for name, condition in where.items():
+        lo, hi = _bounds(condition)
+        values = data[name]
+        keep = np.ones(len(values), dtype=bool)
+        if lo is not None:
+            keep &= values >= lo
+        if hi is not None:
+            keep &= values <= hi
+        mask = keep if mask is None else mask & keep
+    return mask
+
+
+def read_dataset(path, columns=None, where=None):
+
+    """ Read a results dataset
+    :param path: <experiment>.results folder
+    :param columns: names to read, default all
+    :param where: dict name -> value or (lo, hi) inclusive, None for an open bound
+    :return: dict name -> numpy array
+    """
+
+    where = where or {}
+    groups = [g for g in read_index(path) if group_may_match(g, where)]
+    if columns is None:
+        columns = []
+        for g in groups:
+            # key columns first, then the columns in their appended order
+            order = g.get('order', [])
+            for name in sorted(c for c in g['columns'] if c not in order) + order:
+                if name not in columns:
+                    columns.append(name)
+    needed = list(columns) + [name for name in where if name not in columns]
+
+    parts = dict((name, []) for name in needed)
+    handles = {}
+    try:
+        for g in groups:
+            if g['part'] not in handles:
+                handles[g['part']] = open(g['part'], 'rb')
+            block = dict((name, read_column(g, name, handles[g['part']])) for name in needed)
+            if where:
+                keep = row_mask(block, where)
+                block = dict((name, values[keep]) for name, values in block.items())
+            for name in needed:
+                parts[name].append(block[name])
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    return dict((name, np.concatenate(parts[name]) if parts[name] else np.empty(0)) for name in columns)
+
+
+def to_dataframe(path, columns=None, where=None):
+
+    """ read_dataset as a pandas DataFrame (needs pandas) """
+
+    import pandas as pd
+    data = read_dataset(path, columns, where)
+    return pd.DataFrame(data, columns=list(data))
+
+
+def write_csv(data, out_path):
+
+    """ Save read_dataset output as CSV """
+
+    import csv
+    names = list(data)
+    with open(out_path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(names)
+        for row in zip(*[data[name] for name in names]):
+            writer.writerow(row)
@@ -0,0 +1,46 @@
+"""Rolling ball background against the ImageJ algorithm
+
+The ball sizes follow RollingBall in BackgroundSubtracter: shrink factor and
+arc trim by radius, halfWidth = round(radius / shrink - trim).
+"""
+
+import numpy as np
+import pytest
+
+from imagej_np import filters
+
+
+@pytest.mark.parametrize("radius, width, shrink", [(5, 9, 1), (15, 15, 2), (50, 19, 4), (150, 25, 8)])
+def test_rolling_ball_size(radius, width, shrink):
+
+    z, factor = filters.rolling_ball(radius)
+    assert z.shape == (width, width)
+    assert factor == shrink
+    assert z.max() == pytest.approx(radius / float(shrink))
+
+
+@pytest.mark.parametrize("radius", [5, 15, 50])
+def test_flat_plane_becomes_zero(radius):
+
+    plane = np.full((64, 48), 100, np.uint16)
+    out = filters.subtract_background(plane, radius)
+    assert out.dtype == np.uint16
+    assert not out.any()
+
+
+def test_spike_narrower_than_the_ball_is_kept():
+
+    # the ball cannot rise into a one-pixel spike: the background stays at
+    # 100 around it and 5 - sqrt(24) above it, removed by the +0.5 rounding
+    plane = np.full((31, 31), 100, np.uint16)
+    plane[15, 15] = 1000
+    out = filters.subtract_background(plane, 5, presmooth=False)
+    expected = np.zeros_like(plane)
+    expected[15, 15] = 900
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_result_is_clipped_at_zero():
+
+    plane = np.zeros((20, 20), np.uint16)
+    assert not filters.subtract_background(plane, 5).any()
@@ -0,0 +1,107 @@
+"""Multi Measure statistics with ImageJ conventions
+
+StdDev is the sample standard deviation (n - 1), X and Y the centroid of the
+pixel centres, and Median, read from the histogram of 16-bit images, is the
+upper middle value of an even count.
+"""
+
+import math
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+from imagej_np.measure import STATS, roi_stats, analyse_movie, write_multi_measure, pair_files
+
+
+def column(name):
+    return STATS.index(name)
+
+
+def test_roi_stats_by_hand():
+
+    plane = np.zeros((4, 6), np.uint16)
+    plane[1, 1:5] = [10, 40, 20, 30]
+    rois = np.zeros(plane.shape, np.int32)
+    rois[1, 1:5] = 1
+    rois[3, 0:3] = 2           # three pixels of 0
+    stats = roi_stats(plane, rois, 3, pw=0.5, ph=0.5)
+
+    first = stats[0]
+    assert first[column('Area')] == pytest.approx(1.0)
+    assert first[column('Mean')] == pytest.approx(25.0)
+    assert first[column('StdDev')] == pytest.approx(math.sqrt(500.0 / 3))
+    assert first[column('Min')] == 10
+    assert first[column('Max')] == 40
+    assert first[column('X')] == pytest.approx(3.0 * 0.5)
+    assert first[column('Y')] == pytest.approx(1.5 * 0.5)
+    assert first[column('Median')] == 30
+
+    second = stats[1]
+    assert second[column('Mean')] == 0
+    assert second[column('StdDev')] == 0
+    assert second[column('Median')] == 0
+
+    # ROI 3 has no pixel
+    assert stats[2][column('Area')] == 0
+    assert np.isnan(stats[2][1:]).all()
+
+
+def test_median_of_odd_count():
+
+    plane = np.array([[7, 1, 5]], np.uint16)
+    rois = np.ones(plane.shape, np.int32)
+    assert roi_stats(plane, rois, 1)[0][column('Median')] == 5
+
+
+def test_single_pixel_std_is_zero():
+
+    plane = np.array([[3]], np.uint16)
+    stats = roi_stats(plane, np.ones((1, 1), np.int32), 1)
+    assert stats[0][column('StdDev')] == 0
+
+
+def write_movie(folder):
+
+    image = np.full((3, 32, 32), 100, np.uint16)
+    mask = np.zeros((1, 32, 32), np.uint16)
+    mask[0, 5:15, 5:15] = 2    # 10 x 10, circularity 0.886
+    mask[0, 20:30, 18:26] = 3
+    mask[0, 2, 28] = 2         # single pixel, circularity above 0.95
+    image_path, mask_path = os.path.join(folder, "cell.tif"), os.path.join(folder, "cell_MASK.tif")
+    tifffile.imwrite(image_path, image, photometric='minisblack')
+    tifffile.imwrite(mask_path, mask, photometric='minisblack')
+    return image_path, mask_path
+
+
+def test_analyse_movie_on_a_flat_movie(tmp_path):
+
+    image_path, mask_path = write_movie(str(tmp_path))
+    table = analyse_movie(image_path, mask_path)
+    assert table.shape == (3, 2, len(STATS))
+    np.testing.assert_array_equal(table[:, :, column('Area')], [[100, 80]] * 3)
+    assert not table[:, :, column('Mean')].any()
+    assert table[0, 0, column('X')] == pytest.approx(10.0)
+    assert table[0, 1, column('Y')] == pytest.approx(25.0)
+
+
+def test_multi_measure_csv(tmp_path):
+
+    table = np.array([[[4, 2.5, 0.12345, 1, 4, 1.5, 2, 2]]])
+    path = str(tmp_path / "out.csv")
+    write_multi_measure(path, table)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == " ,Area1,Mean1,StdDev1,Min1,Max1,X1,Y1,Median1"
+    assert lines[1] == "1,4,2.500,0.123,1,4,1.500,2,2"
+
+
+def test_pair_files_by_stem(tmp_path):
+
+    for name in ("a.tif", "a_MASK.tif", "b_MASK.tif", "c.tif", "dMASK.tiff", "d.tif", "notes.txt"):
+        (tmp_path / name).write_bytes(b"")
+    pairs, unpaired = pair_files(str(tmp_path))
+    names = [tuple(os.path.basename(p) for p in pair) for pair in pairs]
+    assert names == [("a.tif", "a_MASK.tif"), ("d.tif", "dMASK.tiff")]
+    assert [os.path.basename(p) for p in unpaired] == ["b_MASK.tif", "c.tif"]
@@ -0,0 +1,89 @@
+"""Analyze Particles against values worked out from the ImageJ sources
+
+PolygonRoi.getTracedPerimeter of a w x h rectangle is 2 (w + h) minus
+(2 - sqrt 2) per corner counted, where a one-pixel side right after a
+counted corner is no corner; ImageJ gives 37.657 for a 10 x 10 square and
+2.828 for a single pixel.
+"""
+
+import math
+
+import numpy as np
+import pytest
+
+from imagej_np.particles import analyze_particles, trace_outline, traced_perimeter
+
+CORNER = 2.0 - math.sqrt(2.0)
+
+
+def rectangle_perimeter(w, h):
+
+    inside = np.zeros((h + 2, w + 2), bool)
+    inside[1:-1, 1:-1] = True
+    return traced_perimeter(trace_outline(inside, 1, 1))
+
+
+@pytest.mark.parametrize("w, h, expected", [
+    (1, 1, 4 - 2 * CORNER),
+    (10, 10, 40 - 4 * CORNER),
+    (10, 1, 22 - 3 * CORNER),
+    (3, 7, 20 - 4 * CORNER),
+])
+def test_rectangle_perimeter(w, h, expected):
+
+    assert rectangle_perimeter(w, h) == pytest.approx(expected)
+
+
+def test_perimeter_values_of_imagej():
+
+    assert round(rectangle_perimeter(10, 10), 3) == 37.657
+    assert round(rectangle_perimeter(1, 1), 3) == 2.828
+
+
+def test_rois_in_raster_order_of_their_first_pixel():
+
+    plane = np.zeros((20, 20), bool)
+    plane[12:16, 1:5] = True   # first pixel (12, 1)
+    plane[2:6, 10:14] = True   # first pixel (2, 10)
+    plane[2:6, 15:19] = True   # first pixel (2, 15)
+    rois = analyze_particles(plane)
+    assert rois[3, 11] == 1
+    assert rois[3, 16] == 2
+    assert rois[13, 2] == 3
+
+
+def test_diagonal_pixels_are_one_particle():
+
+    plane = np.eye(4, dtype=bool)
+    rois = analyze_particles(plane)
+    assert rois.max() == 1
+    assert np.count_nonzero(rois) == 4
+
+
+def test_roi_includes_holes_size_does_not():
+
+    ring = np.zeros((9, 9), bool)
+    ring[2:7, 2:7] = True
+    ring[3:6, 3:6] = False     # 25 pixels inside the outline, 16 thresholded
+    rois = analyze_particles(ring)
+    assert np.count_nonzero(rois) == 25
+    assert analyze_particles(ring, min_size=16).max() == 1
+    assert analyze_particles(ring, min_size=17).max() == 0
+
+
+def test_size_in_calibrated_units():
+
+    plane = np.zeros((10, 10), bool)
+    plane[2:6, 2:6] = True     # 16 pixels of 0.25 x 0.25
+    assert analyze_particles(plane, min_size=1.0, pixel_area=0.0625).max() == 1
+    assert analyze_particles(plane, min_size=1.01, pixel_area=0.0625).max() == 0
+
+
+@pytest.mark.parametrize("side, kept", [(1, False), (5, False), (6, False), (7, True), (10, True)])
+def test_circularity_of_squares(side, kept):
+
+    # 4 pi area / perimeter^2, capped at 1: small squares score above 0.95
+    plane = np.zeros((side + 4, side + 4), bool)
+    plane[2:2 + side, 2:2 + side] = True
+    rois = analyze_particles(plane, min_circularity=0.10, max_circularity=0.95)
+    assert (rois.max() == 1) == kept
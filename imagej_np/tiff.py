@@ -0,0 +1,62 @@
+"""TIFF stacks as NumPy arrays
+
+Stacks are memory-mapped when the file allows it (uncompressed, contiguous,
+as saved by ImageJ), so a movie is read plane by plane instead of being
+loaded whole. Other files are read into memory.
+"""
+
+import numpy as np
+import tifffile
+
+
+def open_stack(path):
+
+    """ Planes of a TIFF file in ImageJ stack order
+    :param path: TIFF file
+    :return: array (n_planes, height, width), memory-mapped when possible
+    """
+
+    try:
+        data = tifffile.memmap(path, mode='r')
+    except ValueError:
+        data = tifffile.imread(path)
+    return data.reshape((-1,) + data.shape[-2:])
+
+
+def calibration(path):
+
+    """ Pixel width and height as ImageJ reads them
+    :param path: TIFF file
+    :return: (pixel_width, pixel_height, unit), (1.0, 1.0, 'pixel') if uncalibrated
+    """
+
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        unit = (tif.imagej_metadata or {}).get('unit', 'pixel')
+
+        def size(tag):
+            if tag not in page.tags:
+                return 1.0
+            num, den = page.tags[tag].value
+            return float(den) / num if num else 1.0
+
+        pw, ph = size('XResolution'), size('YResolution')
+    if unit in ('pixel', 'pixels', None):
+        return 1.0, 1.0, 'pixel'
+    return pw, ph, unit
+
+
+def write_stack(path, data, like=None):
+
+    """ Save a stack as an ImageJ TIFF
+    :param path: output file
+    :param data: array (n_planes, height, width)
+    :param like: TIFF file to copy the calibration from
+    """
+
+    kwargs = {}
+    if like is not None:
+        pw, ph, unit = calibration(like)
+        if unit != 'pixel':
+            kwargs = {'resolution': (1.0 / pw, 1.0 / ph), 'metadata': {'unit': unit}}
+    tifffile.imwrite(path, np.ascontiguousarray(data), imagej=True, **kwargs)
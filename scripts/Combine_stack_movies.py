@@ -7,12 +7,14 @@ all the movies.
 """
 
 #@ File(label="Output directory", description="Select the output directory", style="directory") outputFolder
+#@ String(label="Output format", choices={"TIFF", "OME-Zarr", "TIFF and OME-Zarr"}, value="TIFF") output_format
 
 import os
 from ij import IJ, WindowManager
 from ij.io import FileSaver
 from ij.gui import GenericDialog
 from ij.plugin import Concatenator, ChannelSplitter, ZProjector
+from ij_utils.zarr_writer import OmeZarrWriter
 
 def sort_imges(section_filter = "part0"):
     
@@ -96,18 +98,53 @@ def split_and_project(imp, show_image = False):
         c_cip.show()
     return c_cip
 
+def output_name(title, outputFolder, extension):
+
+    """Output path of the combined movie"""
+
+    title = title.replace("MAX_C1-", "")
+    outputFileName = title.replace("CIP100", "CIP100_maxZ" + extension)
+    return str(os.path.join(outputFolder.getPath(), outputFileName))
+
 def imagep_tifsaver(imp, outputFolder):
 
     """Save the image as a tif file"""
     
-    title = imp.getTitle()
-    title = title.replace("MAX_C1-", "")
-    outputFileName = title.replace("CIP100", "CIP100_maxZ.tif")
-    oname = str(os.path.join(outputFolder.getPath(), outputFileName))
+    oname = output_name(imp.getTitle(), outputFolder, ".tif")
     print("Saving file " + oname)
     FileSaver(imp).saveAsTiff(oname)
 
-concat_image = concat_commad(sort_imges(section_filter = "part0"), show_image = False)
-final = split_and_project(concat_image, show_image = True)
-imagep_tifsaver(final, outputFolder)
+def imagep_zarrsaver(images_list, outputFolder):
+
+    """Stream the projected CIP channel of each part into an OME-Zarr movie
+    The parts are added in order as they are projected, so the combined
+    movie is never held in memory.
+    :param images_list: sorted titles of the parts
+    """
+
+    title = create_title(images_list)
+    writer = None
+    try:
+        for image_title in images_list:
+            print("Adding:" + image_title[-9:])
+            imp = WindowManager.getImage(image_title)
+            c_cip = ZProjector.run(ChannelSplitter.split(imp)[0], "max all")
+            if writer is None:
+                oname = output_name(title, outputFolder, ".zarr")
+                print("Saving file " + oname)
+                writer = OmeZarrWriter(oname, c_cip.getWidth(), c_cip.getHeight(), c_cip.getBitDepth(),
+                                       calibration=imp.getCalibration(), name=title)
+            writer.add_stack(c_cip.getStack())
+            c_cip.close()
+    finally:
+        if writer is not None:
+            writer.close()
+
+sorted_titles = sort_imges(section_filter = "part0")
+if output_format != "TIFF":
+    imagep_zarrsaver(list(sorted_titles), outputFolder)
+if output_format != "OME-Zarr":
+    concat_image = concat_commad(sorted_titles, show_image = False)
+    final = split_and_project(concat_image, show_image = True)
+    imagep_tifsaver(final, outputFolder)
 IJ.run("Collect Garbage", "")
@@ -11,12 +11,21 @@
 """
 
 import itertools
+import threading
+from java.awt.event import MouseAdapter
+from java.lang import Runnable, Runtime
+from java.util.concurrent import Executors
 from ij import IJ, ImageStack, ImagePlus
-from ij.gui import GenericDialog
+from ij.gui import GenericDialog, NonBlockingGenericDialog, DialogListener
+from ij.process import ByteProcessor, ImageProcessor
 from fiji.threshold import Auto_Local_Threshold as ALT
+from ij_utils.tiling import TileExecutor, local_threshold_halo
 
 imp = IJ.getImage()
 
+MODES = ["Live preview", "Full montage"]
+BORDER = 2
+
 def range_float(start, end, step):
 
     """Range float generator
@@ -39,7 +48,66 @@ def range_parameters(param_set):
     p1range = range_float(param_set['p1min'], param_set['p1max'], param_set['p1steps'])
     p2range = range_float(param_set['p2min'], param_set['p2max'], param_set['p2steps'])
     
-    return [param_set['Filter'], param_set['radius'], p1range, p2range]
+    return [param_set['Filter'], param_set['radius'], p1range, p2range, param_set['tile_size']]
+
+def add_fields(gd, values):
+
+    """Dialog fields
+    Adds the explorer fields to a dialog, with the given values.
+    """
+
+    filter_names = ["Bernsen", "Contrast", "Mean", "Median", "MidGrey", "Niblack","Otsu", "Phansalkar", "Sauvola"]
+    gd.addChoice("Filter", filter_names, values["Filter"])
+    gd.addNumericField("Radius:", values["radius"], 0)
+
+    gd.addNumericField("Parameter 1, Min:", values["p1min"], 2)
+    gd.addToSameRow()
+    gd.addNumericField("Max:", values["p1max"], 2)
+    gd.addToSameRow()
+    gd.addNumericField("Steps:", values["p1steps"], 0)
+
+    gd.addNumericField("Parameter 1, Min:", values["p2min"], 2)
+    gd.addToSameRow()
+    gd.addNumericField("Max:", values["p2max"], 2)
+    gd.addToSameRow()
+    gd.addNumericField("Steps:", values["p2steps"], 0)
+
+    gd.addNumericField("Tile size (0 = whole image):", values["tile_size"], 0)
+
+def read_fields(gd):
+
+    """Dialog values
+    Reads the fields added by add_fields, in the same order.
+    """
+
+    filter_choice = gd.getNextChoice()
+    radius = gd.getNextNumber()
+
+    p1min = gd.getNextNumber()
+    p1max = gd.getNextNumber()
+    p1steps = gd.getNextNumber()
+    p2min = gd.getNextNumber()
+    p2max = gd.getNextNumber()
+    p2steps = gd.getNextNumber()
+    tile_size = int(gd.getNextNumber())
+
+    return {"Filter" : filter_choice, "radius" : radius, 
+            "p1min" : p1min, "p1max" : p1max, "p1steps" : p1steps, 
+            "p2min" : p2min, "p2max" : p2max, "p2steps" : p2steps,
+            "tile_size" : tile_size}
+
+def valid_steps(settings):
+
+    """Steps check
+    range_float divides by the number of steps, so both need at least one.
+    """
+
+    return settings["p1steps"] >= 1 and settings["p2steps"] >= 1
+
+DEFAULTS = {"Filter" : "Phansalkar", "radius" : 15,
+            "p1min" : 0, "p1max" : 5, "p1steps" : 2,
+            "p2min" : 0, "p2max" : 5, "p2steps" : 2,
+            "tile_size" : 2048}
 
 def getSettings(img):
 
@@ -48,7 +116,6 @@ def getSettings(img):
     """
 
     canProceed = True
-    filter_names = ["Bernsen", "Contrast", "Mean", "Median", "MidGrey", "Niblack","Otsu", "Phansalkar", "Sauvola"]
 
     if not img:
         IJ.error("No images open.")
@@ -58,20 +125,9 @@ def getSettings(img):
     if canProceed:
         
         gd = GenericDialog("Filter explorer")
-        gd.addChoice("Filter", filter_names, "Phansalkar")
-        gd.addNumericField("Radius:", 15, 0)
-
-        gd.addNumericField("Parameter 1, Min:", 0, 2)
-        gd.addToSameRow()
-        gd.addNumericField("Max:", 5, 2)
-        gd.addToSameRow()
-        gd.addNumericField("Steps:", 2, 0)
-
-        gd.addNumericField("Parameter 1, Min:", 0, 2)
-        gd.addToSameRow()
-        gd.addNumericField("Max:", 5, 2)
-        gd.addToSameRow()
-        gd.addNumericField("Steps:", 2, 0)
+        gd.addChoice("Mode", MODES, MODES[0])
+        gd.addNumericField("Preview scale (without a selection):", 0.25, 2)
+        add_fields(gd, DEFAULTS)
 
         gd.showDialog()
         
@@ -79,41 +135,240 @@ def getSettings(img):
         return None
     
     else:
-        filter_choice = gd.getNextChoice()
-        radius = gd.getNextNumber()
-
-        p1min = gd.getNextNumber()
-        p1max = gd.getNextNumber()
-        p1steps = gd.getNextNumber()
-        p2min = gd.getNextNumber()
-        p2max = gd.getNextNumber()
-        p2steps = gd.getNextNumber()
-        
-        return {"Filter" : filter_choice, "radius" : radius, 
-                "p1min" : p1min, "p1max" : p1max, "p1steps" : p1steps, 
-                "p2min" : p2min, "p2max" : p2max, "p2steps" : p2steps}
+        mode = gd.getNextChoice()
+        scale = gd.getNextNumber()
+        settings = read_fields(gd)
+        if not valid_steps(settings):
+            IJ.error("Filter explorer", "Steps must be at least 1.")
+            return None
+        settings.update({"mode" : mode, "scale" : scale})
+        return settings
+
+def threshold_function(method, radius, p1, p2, label="tile"):
+
+    """Auto Local Threshold of a processor
+    Returns a function(ip) -> thresholded processor, as used by TileExecutor.
+    """
+
+    def threshold(tile):
+        imp2 = ImagePlus(label, tile)
+        ALT().exec(imp2, method, int(radius), p1, p2, True)
+        return imp2.getProcessor()
+    return threshold
+
+def to_8bit(ip):
+
+    """Auto Local Threshold only takes 8-bit images"""
+
+    return ip if ip.getBitDepth() == 8 else ip.convertToByteProcessor()
+
+class _Task(Runnable):
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def run(self):
+        try:
+            self.fn()
+        except Exception, e:
+            IJ.log("Threshold preview: " + str(e))
+
+class ThresholdPreview(object):
+
+    """Progressive preview of the parameter grid
+    The grid is computed on the selection of the image, or on a copy
+    scaled by scale (the radius scaled with it), one tile per combination
+    on a thread pool. Tiles are drawn into the montage as they finish;
+    run() with new parameters cancels the tiles still pending. Clicking a
+    tile thresholds the whole image at full resolution with its parameters.
+    """
+
+    def __init__(self, imp, scale=0.25):
+
+        self.imp = imp
+        self.full = to_8bit(imp.getProcessor())
+        roi = imp.getRoi()
+        if roi is not None and roi.isArea():
+            self.full.setRoi(roi.getBounds())
+            self.source, self.scale = self.full.crop(), 1.0
+            self.full.resetRoi()
+        else:
+            self.scale = min(max(scale, 0.01), 1.0)
+            self.full.setInterpolationMethod(ImageProcessor.BILINEAR)
+            self.source = self.full.resize(max(int(self.full.getWidth() * self.scale), 1),
+                                           max(int(self.full.getHeight() * self.scale), 1), True)
+        self.pool = Executors.newFixedThreadPool(Runtime.getRuntime().availableProcessors())
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.futures = []
+        self.grid = None
+        self.p_range = None
+        self.montage = None
+        self.click = None
+
+    def cancel(self):
+
+        """Drop the pending and running tiles of the previous parameters"""
+
+        with self.lock:
+            self.generation += 1
+            futures, self.futures = self.futures, []
+        for future in futures:
+            future.cancel(True)
+        return self.generation
+
+    def run(self, p_range):
+
+        """Start the grid for new parameters"""
+
+        generation = self.cancel()
+        self.p_range = p_range
+        cols, rows = len(p_range[2]), len(p_range[3])
+        tw, th = self.source.getWidth(), self.source.getHeight()
+        self.grid = (cols, rows, tw + BORDER, th + BORDER)
+        canvas = ByteProcessor(cols * (tw + BORDER) - BORDER, rows * (th + BORDER) - BORDER)
+        canvas.setValue(128)
+        canvas.fill()
+        if self.montage is None or self.montage.getWindow() is None:
+            self.montage = ImagePlus("Threshold preview", canvas)
+            self.montage.show()
+            self.click = _TileClick(self)
+            self.montage.getCanvas().addMouseListener(self.click)
+        else:
+            self.montage.setProcessor(canvas)
+
+        radius = max(int(round(p_range[1] * self.scale)), 1)
+        for i, (p1, p2) in enumerate(itertools.product(p_range[2], p_range[3])):
+            # column by p1, row by p2 (the full montage fills its grid in slice order instead)
+            col, row = i // rows, i % rows
+            task = _Task(self._tile_task(generation, p_range[0], radius, p1, p2, col, row))
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.futures.append(self.pool.submit(task))
+
+    def _tile_task(self, generation, method, radius, p1, p2, col, row):
+
+        def compute():
+            if generation != self.generation:
+                return
+            tile = threshold_function(method, radius, p1, p2)(self.source.duplicate())
+            with self.lock:
+                if generation != self.generation:
+                    return
+                canvas = self.montage.getProcessor()
+                canvas.insert(tile, col * self.grid[2], row * self.grid[3])
+                canvas.setColor(255)
+                canvas.drawString("%.2f, %.2f" % (p1, p2), col * self.grid[2] + 2, row * self.grid[3] + 14, 0)
+            self.montage.updateAndDraw()
+        return compute
+
+    def parameters_at(self, x, y):
+
+        """(p1, p2) of the tile under a montage pixel, None on a border"""
+
+        if self.grid is None:
+            return None
+        cols, rows, cw, ch = self.grid
+        col, row = x // cw, y // ch
+        if col >= cols or row >= rows or x % cw >= cw - BORDER or y % ch >= ch - BORDER:
+            return None
+        return self.p_range[2][col], self.p_range[3][row]
+
+    def refine(self, p1, p2):
+
+        """Threshold the whole image at full resolution in the background"""
+
+        if self.pool.isShutdown():
+            return
+        generation, p_range = self.generation, self.p_range
+        label = p_range[0] + " p1 = " + str(p1) + " p2 = " + str(p2)
+
+        def compute():
+            executor = TileExecutor(tile_size=p_range[4])
+            out = executor.map(self.full, threshold_function(p_range[0], p_range[1], p1, p2, label),
+                               local_threshold_halo(p_range[1]))
+            if generation == self.generation:
+                ImagePlus(label, out).show()
+        IJ.showStatus("Thresholding " + label)
+        self.pool.submit(_Task(compute))
+
+    def shutdown(self):
+
+        """Stop the tiles and close the preview with its click listener"""
+
+        self.cancel()
+        self.pool.shutdown()
+        if self.montage is not None:
+            if self.montage.getCanvas() is not None and self.click is not None:
+                self.montage.getCanvas().removeMouseListener(self.click)
+            self.montage.changes = False
+            self.montage.close()
+
+class _TileClick(MouseAdapter):
+
+    def __init__(self, preview):
+        self.preview = preview
+
+    def mouseClicked(self, e):
+        canvas = e.getSource()
+        params = self.preview.parameters_at(canvas.offScreenX(e.getX()), canvas.offScreenY(e.getY()))
+        if params is not None:
+            self.preview.refine(*params)
+
+class _LiveListener(DialogListener):
+
+    def __init__(self, preview):
+        self.preview = preview
+        self.last = None
+
+    def dialogItemChanged(self, gd, e):
+        settings = read_fields(gd)
+        if gd.invalidNumber() or not valid_steps(settings):
+            return False
+        if settings != self.last:
+            self.last = settings
+            self.preview.run(range_parameters(settings))
+        return True
+
+def live_explorer(imp, settings):
+
+    """Live preview
+    Shows the preview grid and keeps a non-blocking dialog open; every
+    change of the parameters restarts the grid, clicking a tile of the
+    preview computes it at full resolution.
+    """
+
+    preview = ThresholdPreview(imp, settings["scale"])
+    try:
+        preview.run(range_parameters(settings))
+        gd = NonBlockingGenericDialog("Threshold explorer (live)")
+        add_fields(gd, settings)
+        gd.addMessage("Click a tile of the preview to compute it at full resolution")
+        gd.addDialogListener(_LiveListener(preview))
+        gd.showDialog()
+    finally:
+        preview.shutdown()
 
 def range_autolocalthr(imp, p_range):
 
     """Local thresholder
     Iterates over the different parameters and generates
-    the thresholded images.
+    the thresholded images, each one tile by tile on all cores.
     """
     
-    ip = imp.getProcessor()
-    if ip.getBitDepth() is not 8:
-    	 ip = ip.convertToByteProcessor()
+    ip = to_8bit(imp.getProcessor())
     	
     radius = p_range[1]
     x, y = imp.getDimensions()[0], imp.getDimensions()[1]
     tstack = ImageStack(x, y)
+    executor = TileExecutor(tile_size=p_range[4])
     
     for p1, p2 in itertools.product(p_range[2], p_range[3]):
     
         label = "p1 = " + str(p1) + " p2 = " + str(p2)
-        imp2 = ImagePlus(label, ip.duplicate())
-        thimp = ALT().exec(imp2, p_range[0], int(radius), p1, p2, True)
-        tstack.addSlice(label, imp2.getProcessor())
+        threshold = threshold_function(p_range[0], radius, p1, p2, label)
+        tstack.addSlice(label, executor.map(ip, threshold, local_threshold_halo(radius)))
         
     montage = ImagePlus("Montage", tstack)
     IJ.run(montage, "Make Montage...", "columns=" + 
@@ -123,5 +378,9 @@ def range_autolocalthr(imp, p_range):
     return None
 
 parameters = getSettings(imp)
-p_range = range_parameters(parameters)
-i_stack = range_autolocalthr(imp, p_range)
+if parameters is not None:
+    if parameters["mode"] == "Live preview":
+        live_explorer(imp, parameters)
+    else:
+        p_range = range_parameters(parameters)
+        i_stack = range_autolocalthr(imp, p_range)
@@ -0,0 +1,237 @@
+""" Long-running Fiji worker for many short jobs.
+    Start it once, headless, and submit the scripts of this folder with their parameters
+    to its spool directory (see ij_utils/spool.py) instead of starting Fiji for every job:
+
+        ImageJ-linux64 --headless --run fiji_worker.py 'spoolDir="/data/spool"'
+
+    The JVM, the plugins, the imported modules and the loaded models (ij_utils.warm_cache)
+    stay warm between jobs. Each job runs in a fresh namespace, its #@ parameters taken
+    from the job (defaults from the script), its output in spool/logs/<id>.log. Images,
+    ROI Manager and Results are cleared after every job, so a failed movie does not
+    leave anything behind for the next one. A job running longer than the timeout is
+    recorded as such and the worker exits, to be restarted by whatever supervises it.
+"""
+
+#@ File(label="Spool directory", style="directory") spoolDir
+#@ Integer(label="Poll interval (ms)", value=500) poll_ms
+#@ Integer(label="Exit after idle minutes (0 = never)", value=0) idle_minutes
+#@ Integer(label="Job timeout in minutes (0 = none)", value=0) job_timeout
+#@ Boolean(label="Preload TrackMate, Weka and Bio-Formats", value=true) preload
+
+import os
+import re
+import sys
+import time
+import socket
+import threading
+import traceback
+from java.io import File
+from java.lang import System, Throwable, OutOfMemoryError
+from java.awt import GraphicsEnvironment
+from ij import IJ, WindowManager as WM
+from ij.plugin.frame import RoiManager
+from ij.measure import ResultsTable
+from ij_utils.spool import Spool
+from ij_utils import warm_cache
+
+PARAMETER = re.compile(r'^#@\s*(\w+)\s*(?:\((.*)\))?\s+(\w+)\s*$')
+ATTRIBUTE = re.compile(r'(\w+)\s*=\s*("(?:[^"\\]|\\.)*"|\{[^}]*\}|[^,]+)')
+PRELOAD = ["fiji.plugin.trackmate.TrackMate", "trainableSegmentation.WekaSegmentation", "loci.plugins.BF"]
+
+
+def script_parameters(path):
+
+    """ #@ parameters declared by a script
+    :return: list of (type, name, attributes dict), in declaration order
+    """
+
+    declared = []
+    with open(path) as f:
+        for line in f:
+            match = PARAMETER.match(line.strip())
+            if match:
+                kind, attrs, name = match.groups()
+                declared.append((kind, name, dict((k, v.strip()) for k, v in ATTRIBUTE.findall(attrs or ""))))
+    return declared
+
+
+def unquote(value):
+
+    if value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    return value
+
+
+def convert(kind, value):
+
+    """ Job value (JSON) to the type of a script parameter """
+
+    if value is None:
+        return None
+    if kind == 'File':
+        return File(value)
+    if kind in ('Integer', 'int', 'Long', 'long', 'Short', 'short'):
+        return int(value)
+    if kind in ('Float', 'float', 'Double', 'double'):
+        return float(value)
+    if kind in ('Boolean', 'boolean'):
+        return value if isinstance(value, bool) else str(value).lower() == 'true'
+    if kind == 'ImagePlus':
+        imp = IJ.openImage(value)
+        if imp is None:
+            raise IOError("Cannot open " + value)
+        return imp
+    return value
+
+
+def bind_parameters(declared, values):
+
+    """ Script namespace entries for the declared parameters
+    Missing values take the script default (value=, the first choice, or
+    None when not required); a required parameter without one is an error.
+    """
+
+    unknown = [name for name in values if name not in [d[1] for d in declared]]
+    if unknown:
+        raise ValueError("Unknown parameters: " + ", ".join(unknown))
+    bound = {}
+    for kind, name, attrs in declared:
+        if name in values:
+            bound[name] = convert(kind, values[name])
+        elif 'value' in attrs:
+            bound[name] = convert(kind, unquote(attrs['value']))
+        elif 'choices' in attrs:
+            bound[name] = unquote(attrs['choices'].strip('{}').split(',')[0].strip())
+        elif kind in ('Boolean', 'boolean'):
+            bound[name] = False
+        elif attrs.get('required') == 'false':
+            bound[name] = None
+        else:
+            raise ValueError("Missing parameter " + name)
+    return bound
+
+
+def reset_session():
+
+    """ Close what a job left open: images, ROIs, results """
+
+    for image_id in WM.getIDList() or []:
+        imp = WM.getImage(image_id)
+        if imp is not None:
+            imp.changes = False
+            imp.close()
+    rm = RoiManager.getInstance()
+    if rm is not None:
+        rm.reset()
+    rt = ResultsTable.getResultsTable()
+    if rt is not None:
+        rt.reset()
+
+
+def run_script(job, log_path, outcome):
+
+    """ Execute the script of a job in a fresh namespace, filling outcome """
+
+    script = job['script']
+    stdout, stderr = sys.stdout, sys.stderr
+    log = open(log_path, 'w')
+    sys.stdout = sys.stderr = log
+    try:
+        try:
+            folder = os.path.dirname(os.path.abspath(script))
+            if folder not in sys.path:
+                sys.path.append(folder)
+            namespace = {'__name__': '__main__', '__file__': script}
+            namespace.update(bind_parameters(script_parameters(script), job.get('params', {})))
+            execfile(script, namespace)
+            outcome['status'] = 'ok'
+        except SystemExit, e:
+            # sys.exit(0) ends a script early, any other code is an error
+            outcome['status'] = 'ok' if e.code in (0, None) else 'failed'
+            if e.code not in (0, None):
+                outcome['error'] = str(e.code)
+        except Exception, e:
+            outcome.update({'status': 'failed', 'error': str(e), 'traceback': traceback.format_exc()})
+        except OutOfMemoryError, e:
+            # the models are the largest thing kept between jobs
+            warm_cache.clear()
+            outcome.update({'status': 'failed', 'error': "Out of memory: " + str(e)})
+        except Throwable, e:
+            outcome.update({'status': 'failed', 'error': str(e), 'traceback': traceback.format_exc()})
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        log.close()
+
+
+def execute(spool, job, timeout_s):
+
+    """ Run a job with a timeout and clean up after it
+    :return: outcome dict for the result file
+    """
+
+    started = time.time()
+    outcome = {'status': 'failed', 'log': spool.log_path(job['id']),
+               'started': time.strftime("%Y-%m-%d %H:%M:%S")}
+    thread = threading.Thread(target=run_script, args=(job, outcome['log'], outcome),
+                              name="job-" + job['id'])
+    thread.setDaemon(True)
+    thread.start()
+    thread.join(timeout_s or None)
+    if thread.isAlive():
+        outcome.update({'status': 'timeout', 'error': "Still running after %d s" % timeout_s})
+    else:
+        reset_session()
+        System.gc()
+    outcome['seconds'] = round(time.time() - started, 3)
+    return outcome
+
+
+def preload_classes(names):
+
+    """ Load the heavy plugin classes before the first job """
+
+    for name in names:
+        try:
+            __import__(name)
+        except ImportError:
+            IJ.log("Worker: " + name + " not available")
+
+
+def serve(spool_dir):
+
+    worker = "%s-%d" % (socket.gethostname().split(".")[0], os.getpid())
+    spool = Spool(spool_dir, worker)
+    if preload:
+        preload_classes(PRELOAD)
+    IJ.log("Worker " + worker + " serving " + spool_dir)
+
+    jobs, idle_since = 0, time.time()
+    while not spool.stop_requested():
+        job = spool.claim()
+        if job is None:
+            spool.heartbeat({'state': 'idle', 'jobs': jobs, 'models': warm_cache.size()})
+            if idle_minutes and time.time() - idle_since > idle_minutes * 60:
+                break
+            time.sleep(poll_ms / 1000.0)
+            continue
+
+        spool.heartbeat({'state': 'running', 'job': job['id'], 'jobs': jobs, 'models': warm_cache.size()})
+        IJ.log("Worker: job " + job['id'] + " " + os.path.basename(job.get('script', "")))
+        outcome = execute(spool, job, job_timeout * 60)
+        outcome['warm_jobs'] = jobs  # jobs this worker ran before this one
+        spool.finish(job, outcome)
+        IJ.log("Worker: job " + job['id'] + " " + outcome['status'] + " in %.1f s" % outcome['seconds'])
+        jobs += 1
+        idle_since = time.time()
+        if outcome['status'] == 'timeout':
+            # the job thread cannot be stopped safely: leave it to a new worker
+            spool.heartbeat({'state': 'stopped', 'jobs': jobs, 'error': outcome['error']})
+            spool.close()
+            if GraphicsEnvironment.isHeadless():
+                System.exit(3)
+            return
+
+    spool.heartbeat({'state': 'stopped', 'jobs': jobs, 'models': warm_cache.size()})
+    spool.close()
+
+serve(spoolDir.getPath())
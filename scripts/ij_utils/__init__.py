@@ -0,0 +1,5 @@
+"""Shared helpers for the Fiji/Jython scripts in this folder.
+
+Copy (or symlink) the ``ij_utils`` folder into ``Fiji.app/jars/Lib`` so the
+scripts can import it.
+"""
@@ -0,0 +1,73 @@
+"""Level-controlled, buffered logger
+
+IJ.log appends to the Log window one line at a time and every call is
+synchronised with the GUI. This logger keeps the messages in memory and
+sends them to the sink in blocks, so per-spot messages cost a list append.
+"""
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+
+def ij_sink(lines):
+
+    """ Write a block of lines to the ImageJ log window with a single call
+    :param lines: list of strings
+    """
+
+    from ij import IJ
+    IJ.log("\n".join(lines))
+
+
+class BufferedLogger(object):
+
+    """ Collect log messages and flush them in blocks
+    :param level: minimum level (int or one of "DEBUG", "INFO", "WARNING", "ERROR")
+    :param capacity: number of buffered lines that triggers a flush
+    :param sink: callable receiving a list of lines, IJ.log by default
+    """
+
+    def __init__(self, level=INFO, capacity=500, sink=None):
+
+        self.level = LEVELS.get(level, level)
+        self.capacity = capacity
+        self.sink = sink or ij_sink
+        self.buffer = []
+
+    def enabled(self, level):
+
+        """ True if messages of this level are kept """
+
+        return level >= self.level
+
+    def log(self, level, msg):
+
+        if level < self.level:
+            return
+        self.buffer.append(msg)
+        if level >= ERROR or len(self.buffer) >= self.capacity:
+            self.flush()
+
+    def debug(self, msg):
+        self.log(DEBUG, msg)
+
+    def info(self, msg):
+        self.log(INFO, msg)
+
+    def warning(self, msg):
+        self.log(WARNING, "WARNING: " + msg)
+
+    def error(self, msg):
+        self.log(ERROR, "ERROR: " + msg)
+
+    def flush(self):
+
+        """ Send the buffered lines to the sink """
+
+        if self.buffer:
+            lines, self.buffer = self.buffer, []
+            self.sink(lines)
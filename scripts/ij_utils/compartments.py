@@ -0,0 +1,181 @@
+"""Inner and outer compartments of the cells in track crops
+
+Each crop is centred on its spot, so the cell is the object of the cell
+mask channel under the crop centre. The masks can come from a crop of their
+own (same box, e.g. masks without background subtraction). Its inner compartment (cytoplasm) is
+either the part covered by a second mask channel or the cell shrunk by a rim
+of fixed width; the outer compartment (periplasm) is the rest of the cell.
+Both are measured in every channel, frame by frame, while the crop is still
+in memory:
+
+    TRACK_ID, FRAME, CELL_AREA, INNER_AREA, OUTER_AREA, OUTER_FRACTION,
+    INNER_MEAN_CHn, OUTER_MEAN_CHn, CELL_MEAN_CHn, OUTER_INNER_RATIO_CHn
+
+Areas are in pixels. Crops are measured in parallel; a crop must not be
+changed or closed before its future is done.
+
+    measures = CompartmentTable(MODE_RIM, rim=2)
+    done = measures.submit(crop, spots, tid)
+    ...
+    measures.write_csv(path)
+"""
+
+import csv
+from java.awt import Rectangle
+from java.lang import Runtime
+from java.util.concurrent import Executors, Callable
+from ij.process import ByteProcessor, Blitter
+from ij.plugin.filter import RankFilters
+
+from ij_utils.crops import object_roi
+
+MODE_NONE = "None"
+MODE_CHANNEL = "Mask channel 3"
+MODE_RIM = "Rim"
+
+
+class _CropTask(Callable):
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def call(self):
+        return self.fn(*self.args)
+
+
+def masked_sum(ip, mask):
+
+    """ Sum and pixel count of ip under a mask of the same size """
+
+    ip.setRoi(Rectangle(0, 0, ip.getWidth(), ip.getHeight()))
+    ip.setMask(mask)
+    stats = ip.getStats()
+    ip.resetRoi()
+    return stats.mean * stats.pixelCount, stats.pixelCount
+
+
+def mask_area(mask):
+
+    """ Pixels set in a 0/255 mask """
+
+    return mask.getStats().histogram[255]
+
+
+class CompartmentTable(object):
+
+    """ Compartment measurements of the crops of a movie
+    :param mode: MODE_CHANNEL (inner compartment from a mask channel) or MODE_RIM
+    :param cell_channel: channel of the cell mask
+    :param inner_channel: channel of the inner compartment mask (MODE_CHANNEL)
+    :param rim: width in pixels of the outer compartment (MODE_RIM)
+    :param workers: crops measured in parallel, 0 for one per core
+    """
+
+    def __init__(self, mode=MODE_RIM, cell_channel=2, inner_channel=3, rim=2, workers=0):
+
+        self.mode = mode
+        self.cell_channel = cell_channel
+        self.inner_channel = inner_channel
+        self.rim = rim
+        self.pool = Executors.newFixedThreadPool(workers or Runtime.getRuntime().availableProcessors())
+        self.futures = []
+        self.n_channels = None
+
+    def headings(self, n_channels):
+
+        """ Column names, in the order of the rows """
+
+        names = ['TRACK_ID', 'FRAME', 'CELL_AREA', 'INNER_AREA', 'OUTER_AREA', 'OUTER_FRACTION']
+        for c in range(1, n_channels + 1):
+            names += ['INNER_MEAN_CH%d' % c, 'OUTER_MEAN_CH%d' % c, 'CELL_MEAN_CH%d' % c,
+                      'OUTER_INNER_RATIO_CH%d' % c]
+        return names
+
+    def submit(self, crop, table, tid, track_index=0, nz=1, masks=None):
+
+        """ Queue the measurement of a track in a crop
+        :param crop: crop hyperstack (see crops.new_crop_image), filled
+        :param table: SpotTable the crop was filled from
+        :param tid: track id
+        :param track_index: position of the track along Z in the crop
+        :param nz: slices per track (of the source image)
+        :param masks: crop of the same box holding the mask channels, default crop
+        :return: Future, done once the crops have been read
+        """
+
+        self.n_channels = crop.getNChannels()
+        frames = [table.frame[row] for row in table.track_rows(tid)]
+        future = self.pool.submit(_CropTask(self.measure_crop, crop, tid, frames, track_index, nz, masks))
+        self.futures.append(future)
+        return future
+
+    def compartments(self, masks, z, t):
+
+        """ Cell, inner and outer 0/255 masks of a frame, None without a cell
+        :param masks: crop holding the mask channels
+        """
+
+        stack = masks.getStack()
+        w, h = masks.getWidth(), masks.getHeight()
+        found = object_roi(stack.getProcessor(masks.getStackIndex(self.cell_channel, z, t + 1)), w // 2, h // 2)
+        if found is None:
+            return None
+        cell = ByteProcessor(w, h)
+        cell.setValue(255)
+        cell.fill(found)
+        if self.mode == MODE_CHANNEL:
+            # no scaling: any label or mask value above 0 is inside
+            inner = stack.getProcessor(masks.getStackIndex(self.inner_channel, z, t + 1)).convertToByteProcessor(False)
+            inner.threshold(0)
+            inner.copyBits(cell, 0, 0, Blitter.AND)
+        else:
+            inner = cell.duplicate()
+            RankFilters().rank(inner, self.rim, RankFilters.MIN)
+        outer = cell.duplicate()
+        outer.copyBits(inner, 0, 0, Blitter.SUBTRACT)
+        return cell, inner, outer
+
+    def measure_crop(self, crop, tid, frames, track_index=0, nz=1, masks=None):
+
+        """ Rows of one track, one per frame; the track starts at slice
+        track_index * nz + 1, as in crops.fill_track_crop
+        """
+
+        stack = crop.getStack()
+        nc, z = crop.getNChannels(), track_index * nz + 1
+        nan = float('nan')
+        rows = []
+        for t in frames:
+            found = self.compartments(masks if masks is not None else crop, z, t)
+            if found is None:
+                rows.append([tid, t, 0, 0, 0, nan] + [nan] * (4 * nc))
+                continue
+            cell, inner, outer = found
+            areas = [mask_area(m) for m in found]
+            row = [tid, t] + areas + [float(areas[2]) / areas[0] if areas[0] else nan]
+            for c in range(1, nc + 1):
+                ip = stack.getProcessor(crop.getStackIndex(c, z, t + 1))
+                (i_sum, i_n), (o_sum, o_n) = masked_sum(ip, inner), masked_sum(ip, outer)
+                i_mean = i_sum / i_n if i_n else nan
+                o_mean = o_sum / o_n if o_n else nan
+                c_mean = (i_sum + o_sum) / (i_n + o_n) if i_n + o_n else nan
+                row += [i_mean, o_mean, c_mean, o_mean / i_mean if i_mean else nan]
+            rows.append(row)
+        return rows
+
+    def write_csv(self, path):
+
+        """ All rows, in the order the crops were submitted; waits for them """
+
+        with open(path, 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(self.headings(self.n_channels or 0))
+            for future in self.futures:
+                writer.writerows(future.get())
+
+    def shutdown(self):
+
+        """ Stop the pool once the queued crops are measured """
+
+        self.pool.shutdown()
@@ -0,0 +1,163 @@
+"""Border-aware track crops
+
+Crop boxes are computed in array space from a SpotTable: the part of the box
+inside the image is copied with ImageProcessor.crop()/insert() at its offset
+inside the crop, and the part outside the image stays as zero padding. No
+ROI, clipboard or window is involved, so boxes touching the borders keep the
+cell centred instead of being silently clipped and shifted.
+"""
+
+import math
+from ij import IJ
+from ij.gui import Wand, PolygonRoi, Roi
+
+SIZE_FIXED = "Fixed"
+SIZE_RADIUS = "Spot radius"
+SIZE_MASK = "Mask bounding box"
+
+OUTPUT_PER_TRACK = "One file per track"
+OUTPUT_STACK = "Single stack"
+OUTPUT_CHUNKS = "Chunked stacks"
+
+
+def odd(n):
+
+    """ Round up to the next odd integer so the spot stays centred """
+
+    n = int(math.ceil(n))
+    return n if n % 2 else n + 1
+
+
+def mask_object_roi(imp, channel, x, y, frame):
+
+    """ Outline of the mask object under a spot
+    :param imp: image holding the mask channel
+    :param channel: mask channel (1-based)
+    :param x, y: spot position in pixels
+    :param frame: frame (0-based)
+    :return: (traced PolygonRoi, mask plane) or None if there is no object
+    """
+
+    ip = imp.getStack().getProcessor(imp.getStackIndex(channel, 1, frame + 1))
+    roi = object_roi(ip, x, y)
+    return (roi, ip) if roi is not None else None
+
+
+def object_roi(ip, x, y):
+
+    """ Traced outline of the object of a mask plane at (x, y), None on background """
+
+    if ip.getf(x, y) <= 0:
+        return None
+    wand = Wand(ip)
+    wand.autoOutline(x, y, 1.0, float(ip.maxValue()))
+    if wand.npoints == 0:
+        return None
+    return PolygonRoi(wand.xpoints, wand.ypoints, wand.npoints, Roi.TRACED_ROI)
+
+
+def mask_object_bounds(imp, channel, x, y, frame):
+
+    """ Bounding box of the mask object under a spot
+    :return: java.awt.Rectangle or None if there is no object
+    """
+
+    found = mask_object_roi(imp, channel, x, y, frame)
+    return found[0].getBounds() if found is not None else None
+
+
+def track_crop_size(table, tid, mode, w, h, imp=None, mask_channel=2, margin=2, radius_factor=2.0):
+
+    """ Crop size of a track
+    :param table: SpotTable
+    :param tid: track id
+    :param mode: SIZE_FIXED, SIZE_RADIUS or SIZE_MASK
+    :param w, h: fixed size, also the fallback if the other modes fail
+    :param imp: image with the mask channel (SIZE_MASK)
+    :param mask_channel: mask channel in imp (SIZE_MASK)
+    :param margin: pixels added around the object (SIZE_RADIUS, SIZE_MASK)
+    :param radius_factor: box half-size in spot radii (SIZE_RADIUS)
+    :return: (width, height), both odd for the variable modes
+    """
+
+    if mode == SIZE_RADIUS:
+        r = table.max_radius(tid)
+        if r > 0:
+            side = odd(2 * (r * radius_factor + margin))
+            return side, side
+
+    elif mode == SIZE_MASK:
+        bw, bh = 0, 0
+        for row in table.track_rows(tid):
+            rect = mask_object_bounds(imp, mask_channel, table.x[row], table.y[row], table.frame[row])
+            if rect is not None:
+                # the box is centred on the spot, so it must reach the
+                # furthest edge of the object on each side
+                dx = max(table.x[row] - rect.x, rect.x + rect.width - table.x[row])
+                dy = max(table.y[row] - rect.y, rect.y + rect.height - table.y[row])
+                bw, bh = max(bw, 2 * dx), max(bh, 2 * dy)
+        if bw > 0 and bh > 0:
+            return odd(bw + 2 * margin), odd(bh + 2 * margin)
+
+    return w, h
+
+
+def new_crop_image(imp, w, h, n_tracks=1, title="Celln"):
+
+    """ Empty crop hyperstack for one or several tracks
+    Tracks are stacked along Z: slice (track_index * nZ + z) holds plane z of a track.
+    :param imp: source image (dimensions, calibration)
+    :param w, h: crop size
+    :param n_tracks: number of tracks in the stack
+    """
+
+    nc, nz, nt = imp.getNChannels(), imp.getNSlices(), imp.getNFrames()
+    crop = IJ.createImage(title, "16-bit grayscale-mode", w, h, nc, nz * n_tracks, nt)
+    crop.setCalibration(imp.getCalibration().copy())
+    return crop
+
+
+def fill_track_crop(src, dst, table, tid, w, h, track_index=0, label=None):
+
+    """ Copy the ZC planes of a track into a crop, with zero padding at the borders
+    :param src: source image, in memory or opened with mapped_tiff.open_mapped
+    :param dst: crop image from new_crop_image
+    :param table: SpotTable
+    :param tid: track id
+    :param w, h: box size; if smaller than dst the box is centred in it
+    :param track_index: position of the track along Z in dst
+    :param label: optional slice label prefix
+    :return: number of spots copied
+    """
+
+    nc, nz = src.getNChannels(), src.getNSlices()
+    src_stack, dst_stack = src.getStack(), dst.getStack()
+    ox = (dst.getWidth() - w) // 2
+    oy = (dst.getHeight() - h) // 2
+    z0 = track_index * nz
+    n = 0
+
+    for row in table.track_rows(tid):
+        x, y, cw, ch, dx, dy = table.bbox(row, w, h)
+        if cw == 0 or ch == 0:
+            continue
+        t = table.frame[row] + 1
+        for z in range(nz):
+            for c in range(nc):
+                # ImageStack.crop: a memory-mapped source only reads the box
+                box = src_stack.crop(x, y, src.getStackIndex(c + 1, z + 1, t) - 1, cw, ch, 1)
+                dst_index = dst.getStackIndex(c + 1, z0 + z + 1, t)
+                dst_stack.getProcessor(dst_index).insert(box.getProcessor(1), ox + dx, oy + dy)
+                if label is not None:
+                    dst_stack.setSliceLabel(label, dst_index)
+        n += 1
+
+    return n
+
+
+def chunks(items, size):
+
+    """ Split a list in consecutive groups of at most size items """
+
+    size = max(int(size), 1)
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,225 @@
+"""Indexed input folders: image files paired by name
+
+Input trees are scanned once and the listing of every folder is kept in a
+cache file with the folder's modification time. A later scan only lists
+again the folders whose mtime changed (a file added, removed or renamed),
+so start-up on large NAS folders costs one stat per folder instead of a
+listing of every file.
+
+Files are grouped by their stem: the relative folder plus the file name
+without extension and without a role suffix, e.g. with the rules
+"mask=_MASK; ref=_REF"
+
+    exp1/cell_03.tif        raw
+    exp1/cell_03_MASK.tif   mask
+    exp1/cell_03_REF.tif    ref
+
+are one group, whatever order the folder lists them in.
+
+    index = DatasetIndex(input_dir, PairingRules.parse("mask=_MASK"), cache_path)
+    for image, mask in index.pairs('mask'):
+        ...
+"""
+
+import os
+import json
+import time
+from java.io import File
+
+from ij_utils.manifest import replace_file
+
+INDEX_NAME = "dataset_index.json"
+FORMAT = 1
+EXTENSIONS = ('.tif', '.tiff')
+# folders written by the scripts (OME-Zarr movies, results datasets)
+SKIP_SUFFIXES = ('.zarr', '.results')
+# a folder changed less than this before the scan may still be changing
+SETTLE_S = 2.0
+
+
+class PairingRules(object):
+
+    """ How file names map to a stem and a role
+    :param suffixes: dict role -> list of suffixes ending the stem, e.g.
+                     {'mask': ['_MASK']}; files without one are 'raw'
+    :param extensions: image file extensions (case-insensitive)
+    """
+
+    def __init__(self, suffixes=None, extensions=EXTENSIONS):
+
+        self.extensions = tuple(e.lower() for e in extensions)
+        # longest suffix first, so "_MASK" wins over "MASK"
+        self.suffixes = sorted([(suffix, role) for role, found in (suffixes or {}).items() for suffix in found],
+                               key=lambda item: -len(item[0]))
+
+    @classmethod
+    def parse(cls, text, extensions=EXTENSIONS):
+
+        """ Rules from "role=suffix[,suffix...]; role=..." """
+
+        suffixes = {}
+        for part in text.split(";"):
+            if not part.strip():
+                continue
+            role, _, found = part.partition("=")
+            suffixes[role.strip()] = [s.strip() for s in found.split(",") if s.strip()]
+        return cls(suffixes, extensions)
+
+    def classify(self, name):
+
+        """ (stem, role) of a file name, None if it is not an image """
+
+        lower = name.lower()
+        for ext in self.extensions:
+            if lower.endswith(ext):
+                stem = name[:-len(ext)]
+                break
+        else:
+            return None
+        for suffix, role in self.suffixes:
+            if stem.endswith(suffix) and len(stem) > len(suffix):
+                return stem[:-len(suffix)], role
+        return stem, 'raw'
+
+
+class DatasetIndex(object):
+
+    """ Cached listing of an input tree and the groups of its files
+    :param root: input folder
+    :param rules: PairingRules
+    :param cache_path: JSON file of the cached listings, None for no cache
+    :param recursive: also index the subfolders
+    """
+
+    def __init__(self, root, rules, cache_path=None, recursive=False):
+
+        self.root = root
+        self.rules = rules
+        self.cache_path = cache_path
+        self.recursive = recursive
+        self.listings = None  # relative folder -> file names
+        self.unpaired = []
+        self.duplicates = []
+        self.listed = self.reused = 0
+
+    def _load_cache(self):
+
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if cache.get('format') != FORMAT or cache.get('root') != os.path.realpath(self.root):
+            return {}
+        return cache['folders']
+
+    def _save_cache(self, folders):
+
+        if not self.cache_path:
+            return
+        tmp = self.cache_path + ".partial"
+        with open(tmp, 'w') as out:
+            json.dump({'format': FORMAT, 'root': os.path.realpath(self.root), 'folders': folders}, out)
+        replace_file(tmp, self.cache_path)
+
+    def _list(self, path):
+
+        """ Image files and subfolders of a folder; only names that are not
+        images are checked for being folders
+        """
+
+        files, dirs = [], []
+        for name in os.listdir(path):
+            if name.startswith("."):
+                continue
+            if self.rules.classify(name) is not None:
+                files.append(name)
+            elif self.recursive and not name.endswith(SKIP_SUFFIXES) and os.path.isdir(os.path.join(path, name)):
+                dirs.append(name)
+        return sorted(files), sorted(dirs)
+
+    def scan(self):
+
+        """ List the tree, reusing the cached listing of unchanged folders
+        :return: dict relative folder -> image file names
+        """
+
+        cached = self._load_cache()
+        folders, todo = {}, [""]
+        started = time.time()
+        self.listed = self.reused = 0
+        while todo:
+            rel = todo.pop()
+            path = os.path.join(self.root, rel) if rel else self.root
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue  # removed during the scan
+            entry = cached.get(rel)
+            if entry is not None and entry['mtime'] == mtime and entry['recursive'] == self.recursive:
+                self.reused += 1
+            else:
+                files, dirs = self._list(path)
+                # a folder still changing is listed again next time
+                entry = {'mtime': mtime if started - mtime > SETTLE_S else None,
+                         'recursive': self.recursive, 'files': files, 'dirs': dirs}
+                self.listed += 1
+            folders[rel] = entry
+            todo.extend(os.path.join(rel, d) if rel else d for d in entry['dirs'])
+        self._save_cache(folders)
+        self.listings = dict((rel, entry['files']) for rel, entry in folders.items())
+        return self.listings
+
+    def groups(self):
+
+        """ dict stem key -> {role: path}, scanning if needed """
+
+        if self.listings is None:
+            self.scan()
+        groups = {}
+        self.duplicates = []
+        for rel, names in self.listings.items():
+            for name in names:
+                stem, role = self.rules.classify(name)
+                key = os.path.join(rel, stem) if rel else stem
+                group = groups.setdefault(key, {})
+                if role in group:
+                    # e.g. cell.tif and cell.tiff
+                    self.duplicates.append(os.path.join(self.root, rel, name))
+                    continue
+                group[role] = os.path.join(self.root, rel, name)
+        return groups
+
+    def pairs(self, *roles):
+
+        """ Groups having a raw file and every role, in stem order
+        Incomplete groups are left in self.unpaired.
+        :return: iterator of (raw File, role File...) tuples
+        """
+
+        groups = self.groups()
+        keys = sorted(groups)
+        wanted = ('raw',) + roles
+        self.unpaired = [key for key in keys if not all(role in groups[key] for role in wanted)]
+        complete = [key for key in keys if all(role in groups[key] for role in wanted)]
+        return (tuple(File(groups[key][role]) for role in wanted) for key in complete)
+
+    def files(self, role='raw'):
+
+        """ Files of one role, in stem order """
+
+        groups = self.groups()
+        return (File(groups[key][role]) for key in sorted(groups) if role in groups[key])
+
+    def summary(self):
+
+        """ One line about the last scan and pairing """
+
+        text = "%d folders listed, %d from the index cache" % (self.listed, self.reused)
+        if self.unpaired:
+            text += ", %d files without a partner" % len(self.unpaired)
+        if self.duplicates:
+            text += ", %d duplicates ignored" % len(self.duplicates)
+        return text
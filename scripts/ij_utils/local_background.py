@@ -0,0 +1,131 @@
+"""Local background of spots: disc and annulus means per channel
+
+For every spot, the mean of a disc around it and of an annulus around the
+disc (separated by a gap) are measured in every channel, and the corrected
+intensity is their difference. This replaces a global rolling-ball
+subtraction of the whole movie by a measure at the export stage, and does
+not bias dim cells next to bright ones.
+
+Spots are grouped by frame so every plane is read once, and frames are
+measured in parallel. The oval masks are computed once per radius and
+frame task; the annulus sum is the outer disc sum minus the inner disc sum,
+so each spot costs three masked statistics computed by ImageJ.
+
+    local = LocalBackground(gap=1, width=3)
+    values = local.measure(imp, [(spot_id, frame, x, y, radius), ...])
+    dict(zip(local.headings(imp.getNChannels()), values[spot_id]))
+"""
+
+from java.awt import Rectangle
+from java.lang import Runtime
+from java.util.concurrent import Executors, Callable
+from ij.gui import OvalRoi
+
+
+class _FrameTask(Callable):
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def call(self):
+        return self.fn(*self.args)
+
+
+class LocalBackground(object):
+
+    """ Disc and annulus means around spots
+    :param gap: pixels between the disc and the annulus
+    :param width: width of the annulus in pixels
+    :param scale: disc radius as a fraction of the spot radius
+    :param workers: frames measured in parallel, 0 for one per core
+    """
+
+    def __init__(self, gap=1, width=3, scale=1.0, workers=0):
+
+        self.gap = gap
+        self.width = width
+        self.scale = scale
+        self.workers = workers or Runtime.getRuntime().availableProcessors()
+
+    def headings(self, n_channels):
+
+        """ Column names, in the order of the measured values """
+
+        names = []
+        for c in range(1, n_channels + 1):
+            names += ['DISC_MEAN_CH%d' % c, 'LOCAL_BG_CH%d' % c, 'LOCAL_CORR_CH%d' % c]
+        return names
+
+    def radii(self, radius):
+
+        """ Disc, inner and outer annulus radii (pixels) of a spot radius """
+
+        disc = max(int(round(radius * self.scale)), 1)
+        return disc, disc + self.gap, disc + self.gap + self.width
+
+    def measure(self, imp, spots):
+
+        """ Measure spots in every channel
+        :param imp: image, C x T hyperstack (one slice)
+        :param spots: iterable of (key, frame 0-based, x, y, radius) in pixels
+        :return: dict key -> list of values, see headings()
+        """
+
+        by_frame = {}
+        for key, frame, x, y, radius in spots:
+            by_frame.setdefault(int(frame), []).append((key, int(round(x)), int(round(y)), radius))
+
+        pool = Executors.newFixedThreadPool(min(self.workers, max(len(by_frame), 1)))
+        try:
+            futures = [pool.submit(_FrameTask(self.measure_frame, imp, frame, found))
+                       for frame, found in sorted(by_frame.items())]
+            values = {}
+            for future in futures:
+                values.update(future.get())
+        finally:
+            pool.shutdown()
+        return values
+
+    def measure_frame(self, imp, frame, spots):
+
+        """ Values of the spots of one frame; each channel plane is read once """
+
+        stack = imp.getStack()
+        masks = {}  # radius -> oval mask, local to the task
+        values = dict((key, []) for key, _, _, _ in spots)
+        for c in range(1, imp.getNChannels() + 1):
+            # a new processor per task, so the ROIs set below are not shared
+            ip = stack.getProcessor(imp.getStackIndex(c, 1, frame + 1))
+            for key, x, y, radius in spots:
+                disc, inner, outer = self.radii(radius)
+                d_sum, d_n = self.disc_sum(ip, x, y, disc, masks)
+                i_sum, i_n = self.disc_sum(ip, x, y, inner, masks)
+                o_sum, o_n = self.disc_sum(ip, x, y, outer, masks)
+                mean = d_sum / d_n if d_n else float('nan')
+                background = (o_sum - i_sum) / (o_n - i_n) if o_n > i_n else float('nan')
+                values[key] += [mean, background, mean - background]
+        return values
+
+    def disc_sum(self, ip, x, y, r, masks):
+
+        """ Sum and pixel count of a disc of radius r centred on (x, y),
+        clipped to the image
+        """
+
+        if r not in masks:
+            masks[r] = OvalRoi(0, 0, 2 * r + 1, 2 * r + 1).getMask()
+        mask = masks[r]
+        rect = Rectangle(x - r, y - r, 2 * r + 1, 2 * r + 1)
+        clipped = rect.intersection(Rectangle(0, 0, ip.getWidth(), ip.getHeight()))
+        if clipped.isEmpty():
+            return 0.0, 0
+        if clipped.width != rect.width or clipped.height != rect.height:
+            mask = mask.duplicate()
+            mask.setRoi(clipped.x - rect.x, clipped.y - rect.y, clipped.width, clipped.height)
+            mask = mask.crop()
+        ip.setRoi(clipped)
+        ip.setMask(mask)
+        stats = ip.getStats()
+        ip.resetRoi()
+        return stats.mean * stats.pixelCount, stats.pixelCount
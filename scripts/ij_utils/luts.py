@@ -0,0 +1,47 @@
+"""Display settings: cached LUT loading and one-shot LUT application
+
+LUT files are read from disk once per process. A LUT is applied once per
+channel without moving the current slice, which is all ImageJ needs to show
+and save it. Nothing is done in headless mode, where there is no display.
+"""
+
+from java.awt import GraphicsEnvironment
+from ij.plugin import LutLoader
+
+_cache = {}
+
+
+def load_lut(path):
+
+    """ LUT from a file, read only the first time
+    :param path: path string or java.io.File
+    """
+
+    if hasattr(path, 'getCanonicalPath'):
+        path = path.getCanonicalPath()
+    lut = _cache.get(path)
+    if lut is None:
+        lut = LutLoader.openLut(path)
+        _cache[path] = lut
+    return lut
+
+
+def apply_lut(imp, lut):
+
+    """ Set the same LUT on every channel of an image
+    :param imp: ImagePlus or CompositeImage
+    :param lut: LUT, or a path to load it from
+    :return: imp
+    """
+
+    if GraphicsEnvironment.isHeadless():
+        return imp
+    if not hasattr(lut, 'getMapSize'):
+        lut = load_lut(lut)
+
+    if imp.isComposite():
+        for ch in range(imp.getNChannels()):
+            imp.setChannelLut(lut, ch + 1)
+    else:
+        imp.setLut(lut)
+    return imp
@@ -0,0 +1,238 @@
+"""Run manifest for resumable batch runs
+
+The manifest (run_manifest.json in the output folder) records, for each
+input file, a content hash, the parameters used, the outputs written and
+the completion status. A re-run skips the inputs whose entry is complete,
+whose hash and parameters are unchanged and whose outputs still exist with
+the recorded size, and only processes new, changed or failed inputs.
+
+Outputs are written to a temporary name and renamed when complete (see
+atomic_path), so a crash never leaves a file that looks finished.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+MANIFEST_NAME = "run_manifest.json"
+HASH_BLOCK = 4 * 1024 * 1024
+
+
+def content_hash(path, block=HASH_BLOCK):
+
+    """ SHA-1 of the size, the first and the last block of a file
+    Reading whole multi-GB movies from the NAS would cost as much as
+    processing them; size + head + tail catches rewritten acquisitions.
+    """
+
+    size = os.path.getsize(path)
+    sha = hashlib.sha1(str(size))
+    with open(path, 'rb') as f:
+        sha.update(f.read(block))
+        if size > block:
+            f.seek(max(size - block, block))
+            sha.update(f.read(block))
+    return sha.hexdigest()
+
+
+def files_hash(paths):
+
+    """ content_hash of several files (e.g. an image and its mask) """
+
+    if len(paths) == 1:
+        return content_hash(paths[0])
+    return hashlib.sha1("".join([content_hash(p) for p in paths])).hexdigest()
+
+
+def params_hash(params):
+
+    """ Stable hash of a parameter dictionary """
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str)).hexdigest()
+
+
+def replace_file(src, dst):
+
+    """ Atomically rename src to dst, replacing dst """
+
+    try:
+        from java.nio.file import Files, Paths, StandardCopyOption
+        Files.move(Paths.get(src), Paths.get(dst), StandardCopyOption.REPLACE_EXISTING,
+                   StandardCopyOption.ATOMIC_MOVE)
+    except ImportError:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def atomic_path(path):
+
+    """ Temporary path to write an output to before commit_path()
+    The extension is kept so ImageJ savers do not append another one.
+    """
+
+    root, ext = os.path.splitext(path)
+    return root + ".partial" + ext
+
+
+def commit_path(path):
+
+    """ Move the temporary file of path into place """
+
+    replace_file(atomic_path(path), path)
+
+
+def atomic_save(save, path):
+
+    """ Call save(tmp_path) then rename the result to path
+    :param save: function writing a file, e.g. FileSaver(imp).saveAsTiff
+    :param path: final output path
+    """
+
+    tmp = atomic_path(path)
+    result = save(tmp)
+    if result is False:
+        raise IOError("Could not save " + path)
+    replace_file(tmp, path)
+    return path
+
+
+class RunManifest(object):
+
+    """ Per-input status of a batch, persisted as JSON
+    :param out_dir: output folder holding the manifest
+    :param params: parameters of the run, compared on resume
+    :param name: file name; workers sharing out_dir each write their own
+                 (see work_queue) and merge_manifests() combines them
+    """
+
+    def __init__(self, out_dir, params, name=MANIFEST_NAME):
+
+        self.path = os.path.join(out_dir, name)
+        self.params = params
+        self.params_hash = params_hash(params)
+        self.lock = threading.RLock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f).get('inputs', {})
+
+    def save(self):
+
+        with self.lock:
+            tmp = self.path + ".partial"
+            with open(tmp, 'w') as f:
+                json.dump({'params': self.params, 'inputs': self.entries}, f, indent=2, sort_keys=True)
+            replace_file(tmp, self.path)
+
+    def is_complete(self, input_path, *related):
+
+        """ True if the input was processed with the same content and
+        parameters and all its outputs still exist with the recorded size
+        :param input_path: input file, key of the manifest entry
+        :param related: other files read with it (e.g. its mask)
+        """
+
+        entry = self.entries.get(input_path)
+        if not entry or entry.get('status') != 'done' or entry.get('params_hash') != self.params_hash:
+            return False
+        for path, size in entry.get('outputs', {}).items():
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                return False
+        return entry.get('hash') == files_hash((input_path,) + related)
+
+    def pending(self, pairs, skipped, redo=None):
+
+        """ Lazily drop the file tuples (input, related...) already complete,
+        so nothing is hashed before the driver reaches it
+        :param skipped: list receiving the tuples dropped
+        :param redo: optional function(tuple) -> True to process it anyway
+        """
+
+        for pair in pairs:
+            if self.is_complete(*[f.getCanonicalPath() for f in pair]) and not (redo and redo(pair)):
+                skipped.append(pair)
+            else:
+                yield pair
+
+    def start(self, input_path, *related):
+
+        """ Mark an input as running; its previous outputs are forgotten """
+
+        with self.lock:
+            self.entries[input_path] = {'hash': files_hash((input_path,) + related), 'params_hash': self.params_hash,
+                                        'status': 'running', 'outputs': {},
+                                        'started': time.strftime("%Y-%m-%d %H:%M:%S")}
+            self.save()
+
+    def add_output(self, input_path, output_path):
+
+        """ Record a finished output file of an input (thread safe) """
+
+        with self.lock:
+            self.entries[input_path]['outputs'][output_path] = os.path.getsize(output_path)
+
+    def add_error(self, input_path, error):
+
+        """ Record a failed output write; finish() then marks the input failed """
+
+        with self.lock:
+            self.entries[input_path]['error'] = str(error)
+
+    def save_output(self, input_path, save, path):
+
+        """ atomic_save() an output of an input and record it """
+
+        try:
+            atomic_save(save, path)
+            self.add_output(input_path, path)
+        except Exception as e:
+            self.add_error(input_path, e)
+            raise
+
+    def finish(self, input_path, status='done', error=None):
+
+        """ Mark an input as done or failed and persist the manifest
+        Call it after the last output of the input is written (e.g. as the
+        last task queued on the AsyncWriter).
+        """
+
+        with self.lock:
+            entry = self.entries[input_path]
+            if status == 'done' and 'error' in entry:
+                status = 'failed'
+            entry['status'] = status
+            entry['finished'] = time.strftime("%Y-%m-%d %H:%M:%S")
+            if error is not None:
+                entry['error'] = str(error)
+            self.save()
+
+
+def merge_manifests(out_dir, params=None):
+
+    """ Combine run_manifest.<worker>.json files into run_manifest.json
+    For an input in several files the done entry wins, then the latest one.
+    """
+
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    root, ext = os.path.splitext(MANIFEST_NAME)
+    sources = [path] + sorted([os.path.join(out_dir, n) for n in os.listdir(out_dir)
+                               if n.startswith(root + ".") and n.endswith(ext) and ".partial" not in n])
+    entries = {}
+    for source in sources:
+        if not os.path.exists(source):
+            continue
+        with open(source) as f:
+            data = json.load(f)
+        params = data.get('params') if params is None else params
+        for key, entry in data.get('inputs', {}).items():
+            old = entries.get(key)
+            rank = (entry.get('status') == 'done', entry.get('finished', entry.get('started', "")))
+            if old is None or rank >= (old.get('status') == 'done', old.get('finished', old.get('started', ""))):
+                entries[key] = entry
+    tmp = path + ".partial"
+    with open(tmp, 'w') as f:
+        json.dump({'params': params, 'inputs': entries}, f, indent=2, sort_keys=True)
+    replace_file(tmp, path)
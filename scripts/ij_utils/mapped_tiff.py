@@ -0,0 +1,396 @@
+"""Memory-mapped reader for uncompressed TIFF and BigTIFF stacks
+
+The IFDs are parsed once into an index of plane offsets; the file is then
+mapped read-only and planes, or rectangles of planes, are copied straight
+from the mapping. Nothing is read until a plane is requested, so sampling a
+few planes, one channel or the boxes of a crop only touches those bytes.
+
+    imp = open_mapped(path)             # ImagePlus on a MappedTiffStack
+    ip = imp.getStack().getProcessor(n)
+    box = imp.getStack().crop(x, y, n - 1, w, h, 1)
+
+ImageJ TIFFs (one IFD with "images=" in the description, planes contiguous)
+are indexed from the first IFD, as ImageJ does. Compressed, tiled, RGB and
+signed files raise IOError; open_mapped then falls back to IJ.openImage.
+The stack is read-only: filters must run on a copy (Duplicator).
+"""
+
+import os
+import struct
+from java.io import RandomAccessFile
+from java.lang import Integer, IllegalArgumentException
+from java.nio import ByteOrder
+from java.nio.channels import FileChannel
+from jarray import zeros
+from ij import IJ, ImagePlus, ImageStack, VirtualStack
+from ij.measure import Calibration
+from ij.process import ByteProcessor, ShortProcessor, FloatProcessor
+
+TAGS = {256: 'width', 257: 'height', 258: 'bits', 259: 'compression', 270: 'description',
+        273: 'strip_offsets', 277: 'samples', 279: 'strip_counts', 282: 'x_resolution',
+        283: 'y_resolution', 322: 'tile_width', 339: 'sample_format'}
+# TIFF type -> (struct code, size)
+TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1),
+         7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8),
+         16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+
+
+def parse_description(text):
+
+    """ key=value lines of an ImageJ description, empty if not an ImageJ file """
+
+    if not text or not text.startswith("ImageJ"):
+        return {}
+    props = {}
+    for line in text.split("\n"):
+        if "=" in line:
+            key, value = line.split("=", 1)
+            props[key.strip()] = value.strip()
+    return props
+
+
+class TiffIndex(object):
+
+    """ Plane offsets and geometry of an uncompressed grayscale TIFF
+    :param path: TIFF or BigTIFF file
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self.f = f
+            self._parse()
+        del self.f
+
+    def _read(self, offset, n):
+
+        self.f.seek(offset)
+        data = self.f.read(n)
+        if len(data) < n:
+            raise IOError("Truncated TIFF: " + self.path)
+        return data
+
+    def _unpack(self, fmt, offset):
+
+        return struct.unpack(self.order + fmt, self._read(offset, struct.calcsize(self.order + fmt)))
+
+    def _parse(self):
+
+        head = self._read(0, 16)
+        if head[:2] not in ("II", "MM", b"II", b"MM"):
+            raise IOError("Not a TIFF file: " + self.path)
+        self.order = "<" if head[:2] in ("II", b"II") else ">"
+        magic = struct.unpack(self.order + "H", head[2:4])[0]
+        if magic == 42:
+            self.big = False
+            ifd = struct.unpack(self.order + "I", head[4:8])[0]
+        elif magic == 43:
+            self.big = True
+            ifd = struct.unpack(self.order + "Q", head[8:16])[0]
+        else:
+            raise IOError("Not a TIFF file: " + self.path)
+
+        first, ifd = self._read_ifd(ifd)
+        self._check(first)
+        self.width, self.height = first['width'], first['height']
+        self.bits = first['bits']
+        self.float = first.get('sample_format', 1) == 3
+        self.plane_bytes = self.width * self.height * self.bits // 8
+        self.description = first.get('description', "")
+        self.props = parse_description(self.description)
+        self.x_resolution = first.get('x_resolution')
+        self.y_resolution = first.get('y_resolution')
+
+        n_images = int(self.props.get('images', 0))
+        if n_images > 1:
+            # ImageJ writes the planes back to back after the first one
+            start = first['strip_offsets'][0]
+            self.offsets = [start + i * self.plane_bytes for i in range(n_images)]
+            return
+
+        self.offsets = [first['strip_offsets'][0]]
+        while ifd:
+            entries, ifd = self._read_ifd(ifd)
+            if entries.get('width', self.width) != self.width or entries.get('height', self.height) != self.height:
+                continue  # thumbnails and other sub-images
+            self._check(entries)
+            self.offsets.append(entries['strip_offsets'][0])
+
+    def _read_ifd(self, offset):
+
+        """ Tags of one IFD (only those in TAGS) and the offset of the next one """
+
+        count_fmt, entry_size, value_size, offset_fmt = ("Q", 20, 8, "Q") if self.big else ("H", 12, 4, "I")
+        n = self._unpack(count_fmt, offset)[0]
+        pos = offset + struct.calcsize(count_fmt)
+        entries = {}
+        for k in range(n):
+            entry = self._read(pos + k * entry_size, entry_size)
+            tag, typ = struct.unpack(self.order + "HH", entry[:4])
+            if tag not in TAGS or typ not in TYPES:
+                continue
+            count = struct.unpack(self.order + offset_fmt, entry[4:4 + value_size])[0]
+            code, size = TYPES[typ]
+            n_bytes = count * size
+            if n_bytes <= value_size:
+                data = entry[4 + value_size:4 + value_size + n_bytes]
+            else:
+                data = self._read(struct.unpack(self.order + offset_fmt, entry[4 + value_size:])[0], n_bytes)
+            if typ == 2:
+                value = data.rstrip(b"\0")
+                value = value.decode('latin-1') if not isinstance(value, str) else value
+            else:
+                values = struct.unpack(self.order + code * count, data)
+                if typ in (5, 10):
+                    values = [values[i] / float(values[i + 1]) if values[i + 1] else 0.0
+                              for i in range(0, len(values), 2)]
+                value = list(values) if tag in (273, 279) else values[0]
+            entries[TAGS[tag]] = value
+        next_ifd = self._unpack(offset_fmt, pos + n * entry_size)[0]
+        return entries, next_ifd
+
+    def _check(self, entries):
+
+        """ Only planes stored as one contiguous uncompressed block can be mapped """
+
+        if entries.get('compression', 1) != 1:
+            raise IOError("Compressed TIFF: " + self.path)
+        if 'tile_width' in entries:
+            raise IOError("Tiled TIFF: " + self.path)
+        if entries.get('samples', 1) != 1:
+            raise IOError("Multi-sample (RGB) TIFF: " + self.path)
+        bits, fmt = entries.get('bits', 1), entries.get('sample_format', 1)
+        if (bits, fmt) not in ((8, 1), (16, 1), (32, 3)):
+            raise IOError("Unsupported pixel type (%d bits, format %d): %s" % (bits, fmt, self.path))
+        offsets, counts = entries.get('strip_offsets'), entries.get('strip_counts')
+        if not offsets:
+            raise IOError("No image data: " + self.path)
+        if counts:
+            for k in range(1, len(offsets)):
+                if offsets[k] != offsets[k - 1] + counts[k - 1]:
+                    raise IOError("Strips not contiguous: " + self.path)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def dimensions(self):
+
+        """ (channels, slices, frames) from the ImageJ description, or (1, n, 1) """
+
+        n = len(self)
+        c = int(self.props.get('channels', 1))
+        z = int(self.props.get('slices', 1))
+        t = int(self.props.get('frames', 1))
+        if c * z * t != n:
+            return 1, n, 1
+        return c, z, t
+
+
+class MappedTiff(object):
+
+    """ Read-only mapping of the planes of a TiffIndex
+    Planes are grouped into mapped segments of at most 2 GB (the limit of
+    a MappedByteBuffer); the file itself is closed once mapped.
+    """
+
+    def __init__(self, index):
+
+        self.index = index
+        self.order = ByteOrder.LITTLE_ENDIAN if index.order == "<" else ByteOrder.BIG_ENDIAN
+        self.segments = []  # (file offset, buffer)
+        self.planes = []    # (segment, offset in the segment)
+        raf = RandomAccessFile(index.path, "r")
+        try:
+            channel = raf.getChannel()
+            start = None
+            groups = []
+            for offset in index.offsets:
+                if start is None or offset < start or offset + index.plane_bytes - start > Integer.MAX_VALUE:
+                    start = offset
+                    groups.append([start, start])
+                groups[-1][1] = max(groups[-1][1], offset + index.plane_bytes)
+                self.planes.append((len(groups) - 1, offset - start))
+            for start, end in groups:
+                self.segments.append(channel.map(FileChannel.MapMode.READ_ONLY, start, end - start))
+        finally:
+            raf.close()
+
+    def load(self):
+
+        """ Page the whole file into the OS cache (not the heap), e.g. on a prefetch thread """
+
+        for segment in self.segments:
+            segment.load()
+
+    def _view(self, n, offset=0):
+
+        """ Buffer of plane n (0-based) in pixels, positioned at pixel offset """
+
+        segment, start = self.planes[n]
+        buf = self.segments[segment].duplicate()
+        buf.position(start)
+        buf = buf.slice().order(self.order)
+        bits = self.index.bits
+        view = buf if bits == 8 else buf.asShortBuffer() if bits == 16 else buf.asFloatBuffer()
+        view.position(offset)
+        return view
+
+    def new_pixels(self, size):
+        return zeros(size, {8: 'b', 16: 'h', 32: 'f'}[self.index.bits])
+
+    def read_plane(self, n):
+
+        """ Pixel array of plane n (0-based) """
+
+        pixels = self.new_pixels(self.index.width * self.index.height)
+        self._view(n).get(pixels)
+        return pixels
+
+    def read_rect(self, n, x, y, w, h):
+
+        """ Pixel array of a rectangle of plane n (0-based), row by row """
+
+        width = self.index.width
+        pixels = self.new_pixels(w * h)
+        view = self._view(n)
+        for row in range(h):
+            view.position((y + row) * width + x)
+            view.get(pixels, row * w, w)
+        return pixels
+
+    def processor(self, w, h, pixels):
+
+        bits = self.index.bits
+        if bits == 8:
+            return ByteProcessor(w, h, pixels, None)
+        if bits == 16:
+            return ShortProcessor(w, h, pixels, None)
+        return FloatProcessor(w, h, pixels, None)
+
+
+class MappedTiffStack(VirtualStack):
+
+    """ VirtualStack on a MappedTiff; crop() only reads the rectangles """
+
+    def __init__(self, mapped):
+
+        VirtualStack.__init__(self, mapped.index.width, mapped.index.height, None, None)
+        self.mapped = mapped
+
+    def getSize(self):
+        return len(self.mapped.index)
+
+    def getBitDepth(self):
+        return self.mapped.index.bits
+
+    def getPixels(self, n):
+        return self.mapped.read_plane(n - 1)
+
+    def getProcessor(self, n):
+        return self.mapped.processor(self.getWidth(), self.getHeight(), self.mapped.read_plane(n - 1))
+
+    def getSliceLabel(self, n):
+        return None
+
+    def crop(self, x, y, z, width, height, depth):
+
+        """ ImageStack.crop (z is 0-based) reading only the rectangles """
+
+        if x < 0 or y < 0 or z < 0 or x + width > self.getWidth() or y + height > self.getHeight() \
+                or z + depth > self.getSize():
+            raise IllegalArgumentException("Argument out of range")
+        out = ImageStack(width, height)
+        for n in range(z, z + depth):
+            out.addSlice(None, self.mapped.processor(width, height, self.mapped.read_rect(n, x, y, width, height)))
+        return out
+
+
+def calibration(index):
+
+    """ Calibration from the resolution tags and the ImageJ description """
+
+    cal = Calibration()
+    props = index.props
+    unit = props.get('unit')
+    if unit and index.x_resolution:
+        cal.pixelWidth = 1.0 / index.x_resolution
+        cal.pixelHeight = 1.0 / (index.y_resolution or index.x_resolution)
+        cal.setUnit(unit)
+    if 'spacing' in props:
+        cal.pixelDepth = float(props['spacing'])
+    if 'finterval' in props:
+        cal.frameInterval = float(props['finterval'])
+    if 'tunit' in props:
+        cal.setTimeUnit(props['tunit'])
+    return cal
+
+
+def open_mapped(path, fallback=True):
+
+    """ Open a TIFF as an ImagePlus on a memory-mapped virtual stack
+    :param path: TIFF file
+    :param fallback: open unsupported files (compressed...) with IJ.openImage
+                     instead of raising IOError
+    :return: ImagePlus; its stack is a MappedTiffStack unless it fell back
+    """
+
+    try:
+        index = TiffIndex(path)
+    except IOError:
+        if not fallback:
+            raise
+        return IJ.openImage(path)
+    imp = ImagePlus(os.path.basename(path), MappedTiffStack(MappedTiff(index)))
+    c, z, t = index.dimensions()
+    imp.setDimensions(c, z, t)
+    if (c > 1) + (z > 1) + (t > 1) > 1 or index.props.get('hyperstack') == "true":
+        imp.setOpenAsHyperStack(True)
+    imp.setCalibration(calibration(index))
+    return imp
+
+
+def mapped(imp):
+
+    """ MappedTiff behind an ImagePlus, or None for ordinary stacks """
+
+    stack = imp.getStack()
+    return stack.mapped if isinstance(stack, MappedTiffStack) else None
+
+
+def source_path(imp):
+
+    """ Path of the file an ImagePlus was opened from, or None """
+
+    fi = imp.getOriginalFileInfo()
+    if fi is None or not fi.fileName or fi.directory is None:
+        return None
+    return os.path.join(fi.directory, fi.fileName)
+
+
+def mapped_channel(imp, channel):
+
+    """ One channel of the file behind imp as a mapped ImagePlus, without
+    copying it; None if imp was not opened from a mappable TIFF (or was
+    edited since) so the caller can fall back to Duplicator
+    :param imp: hyperstack opened from a TIFF
+    :param channel: channel (1-based)
+    """
+
+    path = source_path(imp)
+    if path is None or imp.changes or not os.path.isfile(path):
+        return None
+    try:
+        source = MappedTiff(TiffIndex(path))
+    except IOError:
+        return None
+    c, z, t = source.index.dimensions()
+    if (c, z, t) != (imp.getNChannels(), imp.getNSlices(), imp.getNFrames()):
+        return None
+    planes = [imp.getStackIndex(channel, zi + 1, ti + 1) - 1 for ti in range(t) for zi in range(z)]
+    source.planes = [source.planes[p] for p in planes]
+    source.index.offsets = [source.index.offsets[p] for p in planes]
+    out = ImagePlus("C" + str(channel) + "-" + imp.getTitle(), MappedTiffStack(source))
+    out.setDimensions(1, z, t)
+    out.setCalibration(imp.getCalibration().copy())
+    return out
@@ -0,0 +1,275 @@
+"""Mask-overlap tracking, an alternative to TrackMate LoG detection + LAP
+
+Each frame of a segmentation mask is labelled once (Analyze Particles with
+count masks) and the objects are linked to the next frame by pixel overlap:
+the last object of every open track is laid over the label image of the new
+frame, and candidate links are matched one-to-one by decreasing IoU. Tracks
+left without a match are gap-closed to objects up to max_gap frames later
+the same way.
+
+MaskOverlapTracking is used like TrackMate(model, settings): process() fills
+the model with spots and edges, then computes the spot, edge and track
+features and applies the track filters of the settings, so the display,
+export and crop code stays the same. Spots are discs of the object area
+centred on the object centroid.
+"""
+
+import math
+from java.lang import Integer
+from ij import ImagePlus
+from ij.measure import Measurements, ResultsTable
+from ij.plugin.filter import ParticleAnalyzer
+from ij.plugin.frame import RoiManager
+from ij.process import ImageProcessor, ImageStatistics
+from ij.gui import GenericDialog
+from fiji.plugin.trackmate import Spot, TrackMate
+
+TRACKER_LAP = "LoG + LAP"
+TRACKER_OVERLAP = "Mask overlap"
+
+DEFAULTS = {'min_size': 10, 'min_iou': 0.2, 'max_gap': 2, 'threshold': 1}
+
+
+class FrameObjects(object):
+
+    """ Objects of one mask frame
+    :param labels: label image (ShortProcessor), object i has label i + 1
+    :param rois: outlines of the objects
+    :param areas: areas in pixels
+    :param x, y: centroids in pixel coordinates (TrackMate convention)
+    """
+
+    def __init__(self, labels, rois, areas, x, y):
+
+        self.labels = labels
+        self.rois = rois
+        self.areas = areas
+        self.x = x
+        self.y = y
+
+    def __len__(self):
+        return len(self.rois)
+
+
+def label_frame(ip, threshold=1, min_size=0):
+
+    """ Label the objects of a mask plane
+    :param ip: mask plane
+    :param threshold: lowest mask value inside objects
+    :param min_size: smallest object kept, in pixels
+    :return: FrameObjects
+    """
+
+    ip = ip.convertToShort(False)
+    ip.setThreshold(threshold, 65535, ImageProcessor.NO_LUT_UPDATE)
+    frame = ImagePlus("mask", ip)
+    rt = ResultsTable()
+    rm = RoiManager(True)
+    ParticleAnalyzer.setRoiManager(rm)
+    pa = ParticleAnalyzer(ParticleAnalyzer.SHOW_ROI_MASKS | ParticleAnalyzer.ADD_TO_MANAGER,
+                          Measurements.AREA | Measurements.CENTROID, rt, min_size, float('inf'))
+    pa.setHideOutputImage(True)
+    try:
+        pa.analyze(frame, ip)
+    finally:
+        ParticleAnalyzer.setRoiManager(None)
+    rois = list(rm.getRoisAsArray())
+    rm.close()
+    out = pa.getOutputImage()
+    labels = out.getProcessor() if out is not None else ip.createProcessor(ip.getWidth(), ip.getHeight())
+    # ImageJ centroids are measured from pixel corners, TrackMate uses pixel centres
+    return FrameObjects(labels, rois, list(rt.getColumn(ResultsTable.AREA) or []),
+                        [v - 0.5 for v in (rt.getColumn(ResultsTable.X_CENTROID) or [])],
+                        [v - 0.5 for v in (rt.getColumn(ResultsTable.Y_CENTROID) or [])])
+
+
+def overlaps(roi, labels):
+
+    """ Pixels of each label under an outline
+    :param roi: outline of an object of another frame
+    :param labels: label image
+    :return: dict label index (0-based) -> overlapping pixels
+    """
+
+    labels.setRoi(roi)
+    labels.setThreshold(1, 65535, ImageProcessor.NO_LUT_UPDATE)
+    stats = ImageStatistics.getStatistics(labels, Measurements.AREA | Measurements.MIN_MAX | Measurements.LIMIT,
+                                          None)
+    labels.resetThreshold()
+    labels.resetRoi()
+    if stats.pixelCount == 0:
+        return {}
+    lo, hi = int(stats.min), int(stats.max)
+    if lo == hi:
+        # the usual case: the object only overlaps one object
+        return {lo - 1: stats.pixelCount}
+    hist = stats.histogram16
+    return dict((v - 1, hist[v]) for v in range(lo, hi + 1) if hist[v] > 0)
+
+
+def match(candidates, used_tracks, used_objects):
+
+    """ Greedy one-to-one matching by decreasing IoU
+    :param candidates: list of (iou, track, object)
+    :return: list of (track, object, iou)
+    """
+
+    links = []
+    for iou, track, obj in sorted(candidates, reverse=True):
+        if track in used_tracks or obj in used_objects:
+            continue
+        used_tracks.add(track)
+        used_objects.add(obj)
+        links.append((track, obj, iou))
+    return links
+
+
+def link_objects(frames, min_iou=0.2, max_gap=2):
+
+    """ Link labelled frames into tracks
+    :param frames: iterable of FrameObjects, one per frame
+    :param min_iou: smallest IoU accepted for a link
+    :param max_gap: frames a track may skip before it is closed
+    :return: list of tracks, each a list of (frame, object index, iou of the link to it)
+    """
+
+    tracks = []
+    # open tracks: track index -> (last frame, roi, area)
+    ends = {}
+    for t, objects in enumerate(frames):
+        candidates, gap_candidates = [], []
+        for k, (last, roi, area) in ends.items():
+            for obj, pixels in overlaps(roi, objects.labels).items():
+                iou = pixels / float(area + objects.areas[obj] - pixels)
+                if iou >= min_iou:
+                    (candidates if last == t - 1 else gap_candidates).append((iou, k, obj))
+
+        used_tracks, used_objects = set(), set()
+        links = match(candidates, used_tracks, used_objects)
+        links += match(gap_candidates, used_tracks, used_objects)
+        for k, obj, iou in links:
+            tracks[k].append((t, obj, iou))
+            ends[k] = (t, objects.rois[obj], objects.areas[obj])
+        for obj in range(len(objects)):
+            if obj not in used_objects:
+                ends[len(tracks)] = (t, objects.rois[obj], objects.areas[obj])
+                tracks.append([(t, obj, 0.0)])
+
+        # tracks not seen for more than max_gap frames are closed
+        for k in [k for k, (last, roi, area) in ends.items() if t - last > max_gap]:
+            del ends[k]
+    return tracks
+
+
+def mask_frame(imp, channel, t):
+
+    """ Mask plane of a frame (frames along T, or along Z when T is 1) """
+
+    if imp.getNFrames() == 1 and imp.getNSlices() > 1:
+        return imp.getStack().getProcessor(imp.getStackIndex(channel, t + 1, 1))
+    return imp.getStack().getProcessor(imp.getStackIndex(channel, 1, t + 1))
+
+
+def n_mask_frames(imp):
+
+    return imp.getNSlices() if imp.getNFrames() == 1 else imp.getNFrames()
+
+
+class MaskOverlapTracking(object):
+
+    """ Drop-in for TrackMate(model, settings) on a segmentation mask
+    :param model: TrackMate Model, cleared by process()
+    :param settings: TrackMate Settings of the intensity image, with the
+                     spot/track analyzers and track filters to apply
+    :param mask: ImagePlus holding the mask
+    :param channel: mask channel (1-based)
+    :param min_size, min_iou, max_gap, threshold: see label_frame and link_objects
+    """
+
+    def __init__(self, model, settings, mask, channel=1, min_size=DEFAULTS['min_size'],
+                 min_iou=DEFAULTS['min_iou'], max_gap=DEFAULTS['max_gap'], threshold=DEFAULTS['threshold']):
+
+        self.model = model
+        self.settings = settings
+        self.mask = mask
+        self.channel = channel
+        self.min_size = min_size
+        self.min_iou = min_iou
+        self.max_gap = max_gap
+        self.threshold = threshold
+        self.error = ""
+        self.trackmate = TrackMate(model, settings)
+
+    def getErrorMessage(self):
+        return self.error or self.trackmate.getErrorMessage()
+
+    def checkInput(self):
+
+        n = n_mask_frames(self.mask)
+        if n != self.settings.nframes:
+            self.error = "Mask has " + str(n) + " frames, image has " + str(self.settings.nframes)
+            return False
+        return True
+
+    def frames(self, spots):
+
+        """ Label the mask frames one by one, keeping the spot data only """
+
+        cal = self.settings.imp.getCalibration()
+        dt = cal.frameInterval if cal.frameInterval > 0 else 1.0
+        for t in range(n_mask_frames(self.mask)):
+            objects = label_frame(mask_frame(self.mask, self.channel, t), self.threshold, self.min_size)
+            for i in range(len(objects)):
+                area = objects.areas[i] * cal.pixelWidth * cal.pixelHeight
+                spot = Spot(objects.x[i] * cal.pixelWidth, objects.y[i] * cal.pixelHeight, 0.0,
+                            math.sqrt(area / math.pi), objects.areas[i])
+                spot.putFeature(Spot.POSITION_T, t * dt)
+                spots[(t, i)] = spot
+            yield objects
+
+    def process(self):
+
+        model = self.model
+        model.clearTracks(True)
+        model.clearSpots(True)
+
+        spots = {}
+        tracks = link_objects(self.frames(spots), self.min_iou, self.max_gap)
+
+        model.beginUpdate()
+        try:
+            for (t, i), spot in sorted(spots.items()):
+                model.addSpotTo(spot, Integer(t))
+            for track in tracks:
+                for (t0, i0, _), (t1, i1, iou) in zip(track, track[1:]):
+                    model.addEdge(spots[(t0, i0)], spots[(t1, i1)], 1.0 - iou)
+        finally:
+            model.endUpdate()
+        model.getSpots().setVisible(True)
+
+        tm = self.trackmate
+        return (tm.computeSpotFeatures(True) and tm.computeEdgeFeatures(True) and
+                tm.computeTrackFeatures(True) and tm.execTrackFiltering(True))
+
+
+def dialog_overlap(values, title='Mask overlap tracking'):
+
+    """ Display a dialog for the overlap tracker parameters
+    :param values: previous min_size, min_iou, max_gap and duration (defaults for missing keys)
+    :return: dictionary with the new values, None if cancelled
+    """
+
+    gd = GenericDialog(title)
+    gd.addNumericField("Min object size (pixels): ", values.get('min_size', DEFAULTS['min_size']), 0)
+    gd.addNumericField("Min IoU to link: ", values.get('min_iou', DEFAULTS['min_iou']), 2)
+    gd.addNumericField("Max frame gap: ", values.get('max_gap', DEFAULTS['max_gap']), 0)
+    gd.addNumericField("Duration filter: ", values.get('duration', 500), 0)
+    gd.showDialog()
+
+    if gd.wasCanceled():
+        return None
+
+    return {'min_size': gd.getNextNumber(),
+            'min_iou': gd.getNextNumber(),
+            'max_gap': int(gd.getNextNumber()),
+            'duration': gd.getNextNumber()}
@@ -0,0 +1,172 @@
+"""Pipelined I/O for the folder drivers
+
+Prefetcher opens the next input(s) on a background thread while the current
+one is processed, and AsyncWriter saves outputs on a background thread while
+the next one is computed. Both are bounded by a memory budget in bytes, so
+the wall time of a batch approaches max(I/O, compute) without holding the
+whole folder in memory.
+"""
+
+import sys
+import threading
+
+MB = 1024 * 1024
+
+
+def file_size(*files):
+
+    """ Size estimate of one or more java.io.File, in bytes """
+
+    return sum([f.length() for f in files if f is not None])
+
+
+class Prefetcher(object):
+
+    """ Iterate over items while the next ones are loaded in the background
+    :param items: work items (e.g. (image, mask) File tuples); may be a generator
+                  such as WorkQueue.claimed(), consumed one item at a time on the
+                  loading thread
+    :param loader: function(item) -> loaded value (e.g. opened ImagePlus)
+    :param size_of: function(item) -> estimated size in bytes of the loaded value
+    :param budget_mb: maximum size of the items loaded but not yet finished.
+                      One item is always allowed, even if it exceeds the budget.
+    :param max_ahead: maximum number of items loaded in advance
+    """
+
+    def __init__(self, items, loader, size_of=None, budget_mb=4096, max_ahead=1):
+
+        self.items = items
+        self.loader = loader
+        self.size_of = size_of or (lambda item: 0)
+        self.budget = budget_mb * MB
+        self.max_ahead = max_ahead
+        self.cond = threading.Condition()
+        self.ready = []
+        self.used = 0
+        self.held = 0
+        self.done = False
+        self.stopped = False
+
+    def _run(self):
+
+        for item in self.items:
+            size = self.size_of(item)
+            with self.cond:
+                while not self.stopped and self.held > 0 and \
+                        (self.used + size > self.budget or len(self.ready) >= self.max_ahead):
+                    self.cond.wait()
+                if self.stopped:
+                    break
+                self.used += size
+                self.held += 1
+            try:
+                value, error = self.loader(item), None
+            except Exception:
+                value, error = None, sys.exc_info()[1]
+            with self.cond:
+                self.ready.append((item, value, error, size))
+                self.cond.notifyAll()
+
+        with self.cond:
+            self.done = True
+            self.cond.notifyAll()
+
+    def __iter__(self):
+
+        worker = threading.Thread(target=self._run, name="prefetch")
+        worker.setDaemon(True)
+        worker.start()
+        try:
+            while True:
+                with self.cond:
+                    while not self.ready and not self.done:
+                        self.cond.wait()
+                    if not self.ready:
+                        return
+                    item, value, error, size = self.ready.pop(0)
+                    self.cond.notifyAll()
+                try:
+                    if error is not None:
+                        raise error
+                    yield item, value
+                finally:
+                    with self.cond:
+                        self.used -= size
+                        self.held -= 1
+                        self.cond.notifyAll()
+        finally:
+            with self.cond:
+                self.stopped = True
+                self.cond.notifyAll()
+
+
+class AsyncWriter(object):
+
+    """ Run save functions in order on a background thread
+    :param budget_mb: maximum size of the pending writes; submit() blocks above it
+    """
+
+    def __init__(self, budget_mb=1024):
+
+        self.budget = budget_mb * MB
+        self.cond = threading.Condition()
+        self.queue = []
+        self.used = 0
+        self.closed = False
+        self.errors = []
+        self.worker = threading.Thread(target=self._run, name="async-writer")
+        self.worker.setDaemon(True)
+        self.worker.start()
+
+    def submit(self, fn, *args, **kwargs):
+
+        """ Queue fn(*args, **kwargs)
+        :param size: keyword only, estimated size in bytes of the data held by the task
+        """
+
+        size = kwargs.pop('size', 0)
+        with self.cond:
+            while self.queue and self.used + size > self.budget:
+                self.cond.wait()
+            self.queue.append((fn, args, kwargs, size))
+            self.used += size
+            self.cond.notifyAll()
+
+    def _run(self):
+
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                fn, args, kwargs, size = self.queue[0]
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                self.errors.append(sys.exc_info()[1])
+            with self.cond:
+                self.queue.pop(0)
+                self.used -= size
+                self.cond.notifyAll()
+
+    def wait(self):
+
+        """ Block until all the queued writes are done """
+
+        with self.cond:
+            while self.queue:
+                self.cond.wait()
+
+    def close(self):
+
+        """ Finish the pending writes and stop the thread
+        Raises the first error raised by a write, if any.
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notifyAll()
+        self.worker.join()
+        if self.errors:
+            raise self.errors[0]
@@ -0,0 +1,221 @@
+"""Per-stage timing and memory instrumentation
+
+    prof = Profiler(enabled=True)
+    with prof.movie("movie_01").stage("background", frames=100):
+        IJ.run(imp, "Subtract Background...", "rolling=15 stack")
+
+Each stage records wall time, CPU time of the calling thread, used JVM heap
+before/after and item counts (frames, spots, tracks, rois). Repeated stages
+of a movie (e.g. one "save" per crop) are summed. A disabled profiler
+returns shared no-op objects, so the instrumentation can stay in the scripts.
+"""
+
+import os
+import csv
+import json
+import time
+import threading
+from java.lang import Runtime
+from java.lang.management import ManagementFactory
+
+MB = 1024.0 * 1024.0
+COUNT_KEYS = ['frames', 'spots', 'tracks', 'rois']
+CSV_COLUMNS = ['MOVIE', 'STAGE', 'CALLS', 'WALL_S', 'CPU_S', 'HEAP_BEFORE_MB', 'HEAP_AFTER_MB'] + \
+              [k.upper() for k in COUNT_KEYS]
+
+_threads = ManagementFactory.getThreadMXBean()
+
+
+def used_heap():
+    rt = Runtime.getRuntime()
+    return rt.totalMemory() - rt.freeMemory()
+
+
+def cpu_time():
+
+    """ CPU time of the current thread in seconds (0 if unsupported) """
+
+    if _threads.isCurrentThreadCpuTimeSupported():
+        return _threads.getCurrentThreadCpuTime() / 1e9
+    return 0.0
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, **counts):
+        pass
+
+
+class _NullMovie(object):
+
+    def stage(self, name, **counts):
+        return NULL_STAGE
+
+    def wrap(self, name, fn, **counts):
+        return fn
+
+
+NULL_STAGE = _NullStage()
+NULL_MOVIE = _NullMovie()
+
+
+class Stage(object):
+
+    """ Context manager timing one stage; count() adds item counts """
+
+    def __init__(self, movie, name, counts):
+
+        self.movie = movie
+        self.name = name
+        self.counts = dict(counts)
+
+    def count(self, **counts):
+        for k, v in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+    def __enter__(self):
+        self.heap0 = used_heap()
+        self.cpu0 = cpu_time()
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.movie.add(self.name, time.time() - self.t0, cpu_time() - self.cpu0,
+                       self.heap0, used_heap(), self.counts)
+        return False
+
+
+class MovieProfile(object):
+
+    """ Stage records of one movie """
+
+    def __init__(self, name):
+
+        self.name = name
+        self.stages = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def stage(self, name, **counts):
+        return Stage(self, name, counts)
+
+    def wrap(self, name, fn, **counts):
+
+        """ fn timed as a stage, e.g. for saves run by an AsyncWriter """
+
+        def timed(*args, **kwargs):
+            with self.stage(name, **counts):
+                return fn(*args, **kwargs)
+        return timed
+
+    def add(self, name, wall, cpu, heap0, heap1, counts):
+
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                     'heap_before_mb': heap0 / MB, 'heap_after_mb': 0.0, 'counts': {}}
+                self.order.append(name)
+            rec = self.stages[name]
+            rec['calls'] += 1
+            rec['wall_s'] += wall
+            rec['cpu_s'] += cpu
+            rec['heap_after_mb'] = heap1 / MB
+            for k, v in counts.items():
+                rec['counts'][k] = rec['counts'].get(k, 0) + v
+
+    def rows(self):
+
+        out = []
+        for name in self.order:
+            rec = self.stages[name]
+            row = [self.name, name, rec['calls'], "%.4f" % rec['wall_s'], "%.4f" % rec['cpu_s'],
+                   "%.1f" % rec['heap_before_mb'], "%.1f" % rec['heap_after_mb']]
+            out.append(row + [rec['counts'].get(k, "") for k in COUNT_KEYS])
+        return out
+
+    def write_json(self, path):
+
+        with open(path, 'w') as out:
+            json.dump({'movie': self.name, 'stages': [dict(self.stages[n], stage=n) for n in self.order]},
+                      out, indent=2)
+
+
+class Profiler(object):
+
+    """ Collect stage profiles per movie
+    :param enabled: if False every call is a no-op
+    """
+
+    def __init__(self, enabled=True):
+
+        self.enabled = enabled
+        self.movies = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def movie(self, name):
+
+        """ Profile of a movie, created on first use (thread safe) """
+
+        if not self.enabled:
+            return NULL_MOVIE
+        with self.lock:
+            if name not in self.movies:
+                self.movies[name] = MovieProfile(name)
+                self.order.append(name)
+            return self.movies[name]
+
+    def write_movie(self, name, out_dir):
+
+        """ Write <movie>_profile.json """
+
+        if self.enabled and name in self.movies:
+            self.movies[name].write_json(os.path.join(out_dir, name + "_profile.json"))
+
+    def write(self, out_dir, prefix="profile"):
+
+        """ Write every movie profile, all stages in <prefix>.csv and
+        the aggregate per stage in <prefix>_summary.csv
+        """
+
+        if not self.enabled:
+            return
+        totals, stage_order = {}, []
+        with open(os.path.join(out_dir, prefix + ".csv"), 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(CSV_COLUMNS)
+            for name in self.order:
+                self.write_movie(name, out_dir)
+                for row in self.movies[name].rows():
+                    writer.writerow(row)
+                movie = self.movies[name]
+                for stage in movie.order:
+                    rec = movie.stages[stage]
+                    if stage not in totals:
+                        totals[stage] = {'movies': 0, 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                         'max_wall_s': 0.0, 'counts': {}}
+                        stage_order.append(stage)
+                    tot = totals[stage]
+                    tot['movies'] += 1
+                    tot['calls'] += rec['calls']
+                    tot['wall_s'] += rec['wall_s']
+                    tot['cpu_s'] += rec['cpu_s']
+                    tot['max_wall_s'] = max(tot['max_wall_s'], rec['wall_s'])
+                    for k, v in rec['counts'].items():
+                        tot['counts'][k] = tot['counts'].get(k, 0) + v
+
+        with open(os.path.join(out_dir, prefix + "_summary.csv"), 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(['STAGE', 'MOVIES', 'CALLS', 'WALL_S', 'MEAN_WALL_S', 'MAX_WALL_S', 'CPU_S'] +
+                            [k.upper() for k in COUNT_KEYS])
+            for stage in stage_order:
+                tot = totals[stage]
+                writer.writerow([stage, tot['movies'], tot['calls'], "%.4f" % tot['wall_s'],
+                                 "%.4f" % (tot['wall_s'] / tot['movies']), "%.4f" % tot['max_wall_s'],
+                                 "%.4f" % tot['cpu_s']] + [tot['counts'].get(k, "") for k in COUNT_KEYS])
@@ -0,0 +1,163 @@
+"""Track-aligned line profiles and kymographs
+
+In the pass that crops the tracks, a line (or ribbon, several parallel
+lines averaged) of fixed length is sampled through every spot along the
+long or short axis of its mask object, in every channel. The axis is the
+orientation of the ellipse fitted to the object; its direction is kept
+consistent from one frame to the next so profiles do not flip. Frames
+without an object reuse the last axis of the track.
+
+All tracks of a movie end up in two files:
+
+    <movie>_profiles.csv     TRACK_ID, FRAME, CHANNEL, X, Y, ANGLE, P000...
+    <movie>_kymographs.tif   32-bit hyperstack, one slice per track and
+                             channel; row k is frame first_frame + k of the
+                             track, frames without a spot are NaN
+"""
+
+import csv
+import math
+from ij import ImagePlus, ImageStack
+from ij.measure import Measurements
+from ij.process import ImageStatistics, FloatProcessor
+
+from ij_utils.crops import mask_object_roi
+
+AXIS_NONE = "None"
+AXIS_LONG = "Long axis"
+AXIS_SHORT = "Short axis"
+
+
+def object_angle(imp, channel, x, y, frame):
+
+    """ Orientation (degrees, counter-clockwise from x) of the ellipse fitted
+    to the mask object under a spot, None without an object
+    """
+
+    found = mask_object_roi(imp, channel, x, y, frame)
+    if found is None:
+        return None
+    roi, ip = found
+    ip.setRoi(roi)
+    stats = ImageStatistics.getStatistics(ip, Measurements.ELLIPSE, None)
+    ip.resetRoi()
+    return stats.angle
+
+
+def sample_profile(ip, x, y, angle, length, width=1):
+
+    """ Profile of a line of the given length centred on (x, y)
+    :param angle: direction in degrees, counter-clockwise from x (y up)
+    :param width: parallel lines averaged (a ribbon)
+    :return: list of length values one pixel apart, interpolated
+    """
+
+    a = math.radians(angle)
+    ux, uy = math.cos(a), -math.sin(a)  # image y points down
+    nx, ny = -uy, ux
+    half = length / 2.0
+    ip.setInterpolate(True)
+    total = None
+    for k in range(width):
+        o = k - (width - 1) / 2.0
+        cx, cy = x + o * nx, y + o * ny
+        line = ip.getLine(cx - half * ux, cy - half * uy, cx + half * ux, cy + half * uy)
+        total = list(line) if total is None else [t + v for t, v in zip(total, line)]
+    # getLine rounds the line length, which float errors may tip either way
+    n = int(round(length))
+    return [t / width for t in total[:n]] + [float('nan')] * (n - len(total))
+
+
+class TrackProfiles(object):
+
+    """ Profiles of every spot of the tracks added, by track
+    :param imp: source image
+    :param axis: AXIS_LONG or AXIS_SHORT
+    :param length: profile length in pixels
+    :param width: ribbon width in pixels
+    :param mask_channel: channel of mask_imp holding the mask
+    :param mask_imp: image holding the mask channel, default imp
+    """
+
+    def __init__(self, imp, axis=AXIS_LONG, length=37, width=1, mask_channel=2, mask_imp=None):
+
+        self.imp = imp
+        self.mask_imp = mask_imp if mask_imp is not None else imp
+        self.axis = axis
+        self.length = length
+        self.width = max(int(width), 1)
+        self.mask_channel = mask_channel
+        self.rows = []  # (track id, frame, channel, x, y, angle, values)
+        self.tracks = []  # (track id, first frame, last frame)
+
+    def add_track(self, table, tid):
+
+        """ Sample the profiles of a track of a SpotTable """
+
+        imp, stack = self.imp, self.imp.getStack()
+        nc = imp.getNChannels()
+        last = None
+        for row in table.track_rows(tid):
+            x, y, t = table.x[row], table.y[row], table.frame[row]
+            angle = object_angle(self.mask_imp, self.mask_channel, x, y, t)
+            if angle is None:
+                angle = last if last is not None else 0.0
+            else:
+                if self.axis == AXIS_SHORT:
+                    angle += 90.0
+                # the ellipse angle is defined modulo 180: keep the direction
+                if last is not None and math.cos(math.radians(angle - last)) < 0:
+                    angle += 180.0
+                angle %= 360.0
+            last = angle
+            for c in range(1, nc + 1):
+                ip = stack.getProcessor(imp.getStackIndex(c, 1, t + 1))
+                self.rows.append((tid, t, c, x, y, angle, sample_profile(ip, x, y, angle, self.length, self.width)))
+        self.tracks.append((tid, table.first_frame(tid), table.last_frame(tid)))
+
+    def n_samples(self):
+        return len(self.rows[0][6]) if self.rows else 0
+
+    def write_csv(self, path):
+
+        """ One row per spot and channel, the samples in P000... columns """
+
+        n = self.n_samples()
+        with open(path, 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(['TRACK_ID', 'FRAME', 'CHANNEL', 'X', 'Y', 'ANGLE'] + ['P%03d' % i for i in range(n)])
+            for tid, t, c, x, y, angle, values in self.rows:
+                writer.writerow([tid, t, c, x, y, round(angle, 2)] + values)
+
+    def kymographs(self, title="kymographs"):
+
+        """ Kymographs of all tracks, track-aligned (row 0 = first frame)
+        :return: 32-bit ImagePlus, channels x tracks, None without profiles
+        """
+
+        n = self.n_samples()
+        if n == 0:
+            return None
+        nc = self.imp.getNChannels()
+        height = max(last - first + 1 for _, first, last in self.tracks)
+        planes = {}
+        for tid, first, last in self.tracks:
+            for c in range(1, nc + 1):
+                fp = FloatProcessor(n, height)
+                fp.setValue(float('nan'))
+                fp.fill()
+                planes[(tid, c)] = fp
+        firsts = dict((tid, first) for tid, first, _ in self.tracks)
+        for tid, t, c, x, y, angle, values in self.rows:
+            fp, k = planes[(tid, c)], t - firsts[tid]
+            for i, v in enumerate(values):
+                fp.setf(i, k, v)
+
+        stack = ImageStack(n, height)
+        for tid, first, last in self.tracks:
+            for c in range(1, nc + 1):
+                stack.addSlice("track %d frames %d-%d" % (tid, first, last), planes[(tid, c)])
+        kymo = ImagePlus(title, stack)
+        kymo.setDimensions(nc, len(self.tracks), 1)
+        kymo.setOpenAsHyperStack(True)
+        return kymo
@@ -0,0 +1,215 @@
+"""Experiment-level columnar results dataset
+
+The measurements of every image of an experiment are appended, as they are
+produced, to one dataset folder instead of one text table per image:
+
+    <experiment>.results/part-<writer>.bin    zlib column blocks, append only
+    <experiment>.results/part-<writer>.json   index of the row groups
+
+Each append is a row group: one block per column plus, in the index, its
+type ("i8", "f8" little-endian, or "str" as a JSON list), offset, length,
+min, max and NaN count. Key columns (FILE, SERIES, EXPERIMENT...) constant
+over the group are stored in the index only. The index is rewritten
+atomically after the block is written, so an interrupted run never exposes
+half a group; appending the same key again (a re-processed image)
+supersedes its earlier groups. Each writer (process, queue worker) has its
+own part, so workers never write the same file.
+
+imagej_np.results reads a dataset into NumPy arrays, skipping the row
+groups whose statistics exclude a filter.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import zlib
+import threading
+from array import array
+
+from ij_utils.manifest import replace_file
+
+FORMAT = 1
+TYPES = {'i8': 'l', 'f8': 'd'}
+_LITTLE = sys.byteorder == 'little'
+
+
+def dataset_path(folder, experiment):
+
+    """ Dataset folder of an experiment inside an output folder """
+
+    return os.path.join(folder, experiment + ".results")
+
+
+def column_type(values):
+
+    """ i8, f8 or str for a list of values; numbers with None are f8 (NaN) """
+
+    if all(isinstance(v, (int, long)) and not isinstance(v, bool) for v in values):
+        return 'i8'
+    if all(v is None or isinstance(v, (int, long, float)) for v in values):
+        return 'f8'
+    return 'str'
+
+
+def encode(values, typ):
+
+    """ zlib-compressed block of a column """
+
+    if typ == 'str':
+        raw = json.dumps([unicode(v) for v in values]).encode('utf-8')
+    else:
+        data = array(TYPES[typ], [int(v) for v in values] if typ == 'i8' else
+                     [float('nan') if v is None else float(v) for v in values])
+        if data.itemsize != 8:
+            raise ValueError("No 8-byte array type for " + typ)
+        if not _LITTLE:
+            data.byteswap()
+        raw = data.tostring()
+    return zlib.compress(raw, 6)
+
+
+def statistics(values, typ):
+
+    """ min, max and NaN count of a column (NaNs excluded from min/max) """
+
+    if typ == 'f8':
+        finite = [v for v in values if v is not None and not math.isnan(v)]
+        stats = {'nan': len(values) - len(finite)}
+        if finite:
+            stats.update({'min': min(finite), 'max': max(finite)})
+        return stats
+    values = [unicode(v) for v in values] if typ == 'str' else values
+    return {'min': min(values), 'max': max(values)} if values else {}
+
+
+class ResultsSink(object):
+
+    """ Append row groups to the part of this writer in a dataset folder
+    :param path: dataset folder (see dataset_path), created if missing
+    :param writer: name of the part; default unique per process
+    """
+
+    def __init__(self, path, writer=None):
+
+        self.path = path
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass  # created by another worker
+        self.writer = writer or "%d-%s" % (os.getpid(), uuid.uuid4().hex[:6])
+        self.data_path = os.path.join(path, "part-" + self.writer + ".bin")
+        self.index_path = os.path.join(path, "part-" + self.writer + ".json")
+        self.lock = threading.Lock()
+        self.groups = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.groups = json.load(f)['row_groups']
+        # blocks after the last indexed group come from an interrupted append
+        self.end = max([c['offset'] + c['length'] for g in self.groups
+                        for c in g['columns'].values() if 'offset' in c] or [0])
+
+    def append(self, key, columns, tags=None):
+
+        """ Append a row group (thread safe)
+        :param key: source of the rows, e.g. the image path; earlier groups
+                    with the same key in this part are superseded
+        :param columns: ordered list of (name, values), values all the same length
+        :param tags: dict of columns constant over the group (FILE, SERIES...)
+        :return: number of rows appended
+        """
+
+        n = len(columns[0][1]) if columns else 0
+        for name, values in columns:
+            if len(values) != n:
+                raise ValueError("Column %s has %d rows, expected %d" % (name, len(values), n))
+
+        with self.lock:
+            meta, blocks, offset = {}, [], self.end
+            for name, value in sorted((tags or {}).items()):
+                meta[name] = {'type': column_type([value]), 'const': value}
+            for name, values in columns:
+                typ = column_type(values) if values else 'f8'
+                block = encode(values, typ)
+                meta[name] = dict(statistics(values, typ), type=typ, offset=offset, length=len(block))
+                blocks.append(block)
+                offset += len(block)
+
+            with open(self.data_path, 'r+b' if os.path.exists(self.data_path) else 'wb') as out:
+                out.seek(self.end)
+                for block in blocks:
+                    out.write(block)
+                out.truncate()
+
+            self.groups = [g for g in self.groups if g['key'] != key]
+            self.groups.append({'key': key, 'rows': n, 'order': [name for name, _ in columns],
+                                'written': time.time(), 'columns': meta})
+            self.end = offset
+            self._write_index()
+        return n
+
+    def _write_index(self):
+
+        tmp = self.index_path + ".partial"
+        with open(tmp, 'w') as f:
+            json.dump({'format': FORMAT, 'writer': self.writer, 'row_groups': self.groups}, f)
+        replace_file(tmp, self.index_path)
+
+    def keys(self):
+
+        """ Keys with rows in any part of the dataset """
+
+        keys = set()
+        for name in os.listdir(self.path):
+            if name.startswith("part-") and name.endswith(".json"):
+                with open(os.path.join(self.path, name)) as f:
+                    keys.update(g['key'] for g in json.load(f)['row_groups'])
+        return keys
+
+
+def results_table_columns(rt):
+
+    """ Columns of an ImageJ ResultsTable as (name, values), row labels first """
+
+    columns = []
+    if rt.size() and rt.getLabel(0) is not None:
+        columns.append(('Label', [rt.getLabel(i) for i in range(rt.size())]))
+    for heading in rt.getHeadings():
+        if heading == "Label" or not rt.columnExists(heading):
+            continue
+        columns.append((heading, list(rt.getColumnAsDoubles(rt.getColumnIndex(heading)))))
+    return columns
+
+
+def multi_measure_columns(rt):
+
+    """ Long format of a Multi Measure table (one row per slice, stats
+    suffixed with the ROI number): one row per slice and ROI
+    :return: [('FRAME', ...), ('ROI', ...), (stat, ...) ...]
+    """
+
+    stats, rois, values = [], set(), {}
+    for name, column in results_table_columns(rt):
+        stat = name.rstrip("0123456789")
+        if stat == name or name == "Label":
+            continue
+        roi = int(name[len(stat):])
+        if stat not in stats:
+            stats.append(stat)
+        rois.add(roi)
+        values[(stat, roi)] = column
+    n = rt.size()
+    if not rois:
+        # not a Multi Measure table
+        return [('FRAME', list(range(1, n + 1)))] + results_table_columns(rt)
+    rois = sorted(rois)
+    nan = float('nan')
+    columns = [('FRAME', [i + 1 for roi in rois for i in range(n)]),
+               ('ROI', [roi for roi in rois for i in range(n)])]
+    for stat in stats:
+        columns.append((stat, [values[(stat, roi)][i] if (stat, roi) in values else nan
+                               for roi in rois for i in range(n)]))
+    return columns
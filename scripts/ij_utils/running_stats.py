@@ -0,0 +1,184 @@
+"""Running aggregates for per-track and per-frame summary tables
+
+Statistics are updated one spot at a time while the spot table is written
+(Welford mean/variance, min/max, first/last, least-squares slope), so the
+summaries need no second pass over the data.
+"""
+
+import csv
+import math
+
+
+class RunningStats(object):
+
+    """ Streaming count, mean, variance, min and max """
+
+    def __init__(self):
+
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+
+        if x is None or math.isnan(x):
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if self.n == 1:
+            self.min = self.max = x
+        else:
+            self.min = min(self.min, x)
+            self.max = max(self.max, x)
+
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def get_mean(self):
+        return self.mean if self.n else None
+
+
+class RunningSlope(object):
+
+    """ Streaming least-squares slope of y against t """
+
+    def __init__(self):
+
+        self.n = 0
+        self.st = self.sy = self.stt = self.sty = 0.0
+
+    def add(self, t, y):
+
+        if y is None or math.isnan(y):
+            return
+        self.n += 1
+        self.st += t
+        self.sy += y
+        self.stt += t * t
+        self.sty += t * y
+
+    def slope(self):
+
+        den = self.n * self.stt - self.st * self.st
+        if self.n < 2 or den == 0:
+            return None
+        return (self.n * self.sty - self.st * self.sy) / den
+
+
+class TrackAggregate(object):
+
+    """ Running summary of one track """
+
+    def __init__(self):
+
+        self.n = 0
+        self.first = None  # (frame, x, y, intensity, snr), by frame
+        self.last = None
+        self.intensity = RunningStats()
+        self.snr = RunningStats()
+        self.snr_slope = RunningSlope()
+        self.ref = RunningStats()
+        self.norm = RunningStats()
+
+    def add(self, frame, x, y, intensity, snr, ref, norm):
+
+        self.n += 1
+        if self.first is None or frame < self.first[0]:
+            self.first = (frame, x, y, intensity, snr)
+        if self.last is None or frame > self.last[0]:
+            self.last = (frame, x, y, intensity, snr)
+        self.intensity.add(intensity)
+        self.snr.add(snr)
+        self.snr_slope.add(frame, snr)
+        self.ref.add(ref)
+        self.norm.add(norm)
+
+
+class FrameAggregate(object):
+
+    """ Running summary of the population in one frame """
+
+    def __init__(self):
+
+        self.n = 0  # spots, with or without an intensity
+        self.intensity = RunningStats()
+        self.snr = RunningStats()
+        self.ref = RunningStats()
+        self.norm = RunningStats()
+
+
+class SpotSummaries(object):
+
+    """ Per-track and per-frame summaries of a spot table, fed row by row """
+
+    TRACK_COLUMNS = ['TRACK_ID', 'N_SPOTS', 'FIRST_FRAME', 'LAST_FRAME', 'DURATION', 'DISPLACEMENT',
+                     'MEAN_INTENSITY', 'STD_INTENSITY', 'MIN_INTENSITY', 'MAX_INTENSITY',
+                     'FIRST_INTENSITY', 'LAST_INTENSITY', 'MEAN_SNR', 'SNR_SLOPE', 'FIRST_SNR', 'LAST_SNR',
+                     'MEAN_REF', 'MEAN_NORM_INTENSITY', 'STD_NORM_INTENSITY']
+    FRAME_COLUMNS = ['FRAME', 'N_SPOTS', 'MEAN_INTENSITY', 'STD_INTENSITY', 'MIN_INTENSITY',
+                     'MAX_INTENSITY', 'MEAN_SNR', 'MEAN_REF', 'MEAN_NORM_INTENSITY', 'STD_NORM_INTENSITY']
+
+    def __init__(self):
+
+        self.tracks = {}
+        self.track_order = []
+        self.frames = {}
+
+    def add(self, track_id, frame, x, y, intensity, snr, ref):
+
+        """ Add one spot
+        :param ref: reference intensity of the frame, the intensity is
+                    normalised by it when it is not 0
+        """
+
+        norm = intensity / ref if ref and intensity is not None else None
+        if track_id not in self.tracks:
+            self.tracks[track_id] = TrackAggregate()
+            self.track_order.append(track_id)
+        self.tracks[track_id].add(frame, x, y, intensity, snr, ref, norm)
+
+        frame = int(frame)
+        if frame not in self.frames:
+            self.frames[frame] = FrameAggregate()
+        agg = self.frames[frame]
+        agg.n += 1
+        agg.intensity.add(intensity)
+        agg.snr.add(snr)
+        agg.ref.add(ref)
+        agg.norm.add(norm)
+
+    def track_rows(self):
+
+        for tid in self.track_order:
+            agg = self.tracks[tid]
+            (f0, x0, y0, i0, s0), (f1, x1, y1, i1, s1) = agg.first, agg.last
+            yield [tid, agg.n, int(f0), int(f1), int(f1 - f0 + 1), math.hypot(x1 - x0, y1 - y0),
+                   agg.intensity.get_mean(), agg.intensity.std(), agg.intensity.min, agg.intensity.max,
+                   i0, i1, agg.snr.get_mean(), agg.snr_slope.slope(), s0, s1,
+                   agg.ref.get_mean(), agg.norm.get_mean(), agg.norm.std()]
+
+    def frame_rows(self):
+
+        for frame in sorted(self.frames):
+            agg = self.frames[frame]
+            yield [frame, agg.n, agg.intensity.get_mean(), agg.intensity.std(),
+                   agg.intensity.min, agg.intensity.max, agg.snr.get_mean(), agg.ref.get_mean(),
+                   agg.norm.get_mean(), agg.norm.std()]
+
+    def write(self, tracks_path, frames_path):
+
+        """ Write the per-track and per-frame tables as CSV """
+
+        for path, columns, rows in ((tracks_path, self.TRACK_COLUMNS, self.track_rows()),
+                                    (frames_path, self.FRAME_COLUMNS, self.frame_rows())):
+            with open(path, 'wb') as out:
+                writer = csv.writer(out)
+                writer.writerow(columns)
+                writer.writerows(rows)
@@ -0,0 +1,267 @@
+"""Spool directory of the warm Fiji worker (fiji_worker.py)
+
+Clients drop jobs (a script of this folder and its parameters) in the
+spool; one or more long-running workers pick them up and write the result
+next to them. Only file renames are used, so clients can be CPython,
+shell scripts or other Fiji instances, on any machine mounting the folder:
+
+    spool/incoming/<id>.json    job {'script', 'params'}, written atomically
+    spool/running/<id>.json     claimed by a worker (rename, one winner); its
+                                mtime is the lease, touched every heartbeat_s
+    spool/done/<id>.json        result {'status', 'error', 'log', times...}
+    spool/logs/<id>.log         output of the job
+    spool/workers/<worker>      status of each worker, touched while polling
+    spool/clock/<worker>        touched to read the file server clock
+    spool/stop                  workers exit once their current job is done
+
+    job_id = submit(spool, "/path/to/track_n_crop.py", {'inputDir': ..., ...})
+    result = wait(spool, job_id)          # or result(spool, job_id) to poll
+
+Job ids start with the submission time, so jobs run in submission order.
+A running job whose lease is not touched for lease_s belongs to a worker
+that died (JVM crash, OOM kill, lost node): the next claim moves it back to
+incoming, at most max_attempts times, after which it is recorded as failed.
+"""
+
+import os
+import time
+import uuid
+import threading
+
+from ij_utils.work_queue import read_json, write_json, LEASE_S, HEARTBEAT_S, MAX_ATTEMPTS
+
+FOLDERS = ("incoming", "running", "done", "logs", "workers", "clock")
+
+
+def make_spool(root):
+
+    """ Create the spool folders if missing """
+
+    for sub in FOLDERS:
+        path = os.path.join(root, sub)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass  # created by another worker
+    return root
+
+
+def submit(root, script, params=None, job_id=None):
+
+    """ Add a job to the spool
+    :param script: path of the script to run
+    :param params: dict of script parameters (#@ names) -> JSON values;
+                   File and ImagePlus parameters are given as paths
+    :return: job id
+    """
+
+    make_spool(root)
+    job_id = job_id or time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+    write_json(os.path.join(root, "incoming", job_id + ".json"),
+               {'id': job_id, 'script': script, 'params': params or {},
+                'submitted': time.strftime("%Y-%m-%d %H:%M:%S")})
+    return job_id
+
+
+def result(root, job_id):
+
+    """ Result of a job, None while it is queued or running """
+
+    return read_json(os.path.join(root, "done", job_id + ".json"))
+
+
+def wait(root, job_id, timeout=None, poll=1.0):
+
+    """ Wait for the result of a job
+    :param timeout: seconds, None to wait forever
+    :return: result dict, None on timeout
+    """
+
+    start = time.time()
+    while True:
+        found = result(root, job_id)
+        if found is not None:
+            return found
+        if timeout is not None and time.time() - start > timeout:
+            return None
+        time.sleep(poll)
+
+
+def request_stop(root):
+
+    """ Ask the workers of a spool to exit after their current job """
+
+    open(os.path.join(root, "stop"), 'w').close()
+
+
+class Spool(object):
+
+    """ Worker side of a spool directory
+    :param root: spool folder
+    :param worker: name of this worker
+    :param lease_s: seconds without heartbeat after which a running job is requeued
+    :param heartbeat_s: seconds between two touches of the running job
+    :param max_attempts: claims of a job before a lost one is given up
+    """
+
+    def __init__(self, root, worker, lease_s=LEASE_S, heartbeat_s=HEARTBEAT_S, max_attempts=MAX_ATTEMPTS):
+
+        self.root = make_spool(root)
+        self.worker = worker
+        self.lease_s = lease_s
+        self.heartbeat_s = heartbeat_s
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.held = {}  # job id -> claim token
+        self.stopped = threading.Event()
+        self.heart = threading.Thread(target=self._keep_alive, name="spool-heartbeat")
+        self.heart.setDaemon(True)
+        self.heart.start()
+
+    def _path(self, sub, job_id, ext=".json"):
+        return os.path.join(self.root, sub, job_id + ext)
+
+    def log_path(self, job_id):
+        return self._path("logs", job_id, ".log")
+
+    def pending(self):
+
+        """ Job ids waiting, oldest first """
+
+        return sorted(name[:-len(".json")] for name in os.listdir(os.path.join(self.root, "incoming"))
+                      if name.endswith(".json"))
+
+    def fs_now(self):
+
+        """ Current time of the file server (mtimes are set by it) """
+
+        path = os.path.join(self.root, "clock", self.worker)
+        if not os.path.exists(path):
+            open(path, 'w').close()
+        os.utime(path, None)
+        return os.path.getmtime(path)
+
+    def claim(self):
+
+        """ Take the oldest waiting job, after requeueing the lost ones
+        :return: job dict, None if nothing is waiting
+        """
+
+        self.requeue_expired()
+        for job_id in self.pending():
+            incoming, running = self._path("incoming", job_id), self._path("running", job_id)
+            try:
+                # the lease starts now, not at submission
+                os.utime(incoming, None)
+                os.rename(incoming, running)
+            except OSError:
+                continue  # taken by another worker
+            job = read_json(running)
+            if job is None:
+                self.finish({'id': job_id}, {'status': 'failed', 'error': "Unreadable job file"})
+                continue
+            token = uuid.uuid4().hex
+            job.update({'id': job.get('id', job_id), 'worker': self.worker, 'token': token,
+                        'attempts': job.get('attempts', 0) + 1})
+            write_json(running, job)
+            with self.lock:
+                self.held[job_id] = token
+            return job
+        return None
+
+    def requeue_expired(self):
+
+        """ Move the running jobs whose lease expired back to incoming; a job
+        lost max_attempts times is recorded as failed
+        :return: ids of the jobs requeued or given up
+        """
+
+        moved = []
+        now = self.fs_now()
+        for name in os.listdir(os.path.join(self.root, "running")):
+            if not name.endswith(".json"):
+                continue
+            job_id = name[:-len(".json")]
+            running = self._path("running", job_id)
+            stale = running + ".expired-" + self.worker
+            try:
+                if now - os.path.getmtime(running) < self.lease_s:
+                    continue
+                os.rename(running, stale)  # only one worker wins the rename
+            except OSError:
+                continue
+            job = read_json(stale) or {'id': job_id}
+            lost = "Worker %s stopped heartbeating" % job.get('worker', "?")
+            if job.get('attempts', 0) >= self.max_attempts:
+                write_json(self._path("done", job_id), {'id': job_id, 'script': job.get('script'),
+                                                        'worker': job.get('worker'), 'status': 'failed',
+                                                        'error': lost, 'attempts': job.get('attempts'),
+                                                        'finished': time.strftime("%Y-%m-%d %H:%M:%S")})
+            else:
+                write_json(self._path("incoming", job_id), dict(job, requeued=lost))
+            os.remove(stale)
+            moved.append(job_id)
+        return moved
+
+    def _owns(self, job_id, token):
+
+        job = read_json(self._path("running", job_id))
+        return job is not None and job.get('token') == token
+
+    def _touch_held(self):
+
+        """ Refresh the leases of the held jobs; a job requeued meanwhile is dropped """
+
+        with self.lock:
+            held = list(self.held.items())
+        for job_id, token in held:
+            if self._owns(job_id, token):
+                try:
+                    os.utime(self._path("running", job_id), None)
+                except OSError:
+                    pass
+            else:
+                with self.lock:
+                    self.held.pop(job_id, None)
+
+    def _keep_alive(self):
+
+        while not self.stopped.is_set():
+            self.stopped.wait(self.heartbeat_s)
+            self._touch_held()
+
+    def finish(self, job, outcome):
+
+        """ Write the result of a job and drop it from running """
+
+        record = dict(outcome, id=job['id'], script=job.get('script'), worker=self.worker,
+                      finished=time.strftime("%Y-%m-%d %H:%M:%S"))
+        write_json(self._path("done", job['id']), record)
+        with self.lock:
+            token = self.held.pop(job['id'], None)
+        # a job requeued after a lost lease now belongs to its new claim
+        if token is None or self._owns(job['id'], token):
+            try:
+                os.remove(self._path("running", job['id']))
+            except OSError:
+                pass
+
+    def heartbeat(self, status):
+
+        """ Status of this worker, for whoever watches the spool; also
+        refreshes the lease of the running job
+        """
+
+        self._touch_held()
+        write_json(os.path.join(self.root, "workers", self.worker),
+                   dict(status, worker=self.worker, updated=time.strftime("%Y-%m-%d %H:%M:%S")))
+
+    def close(self):
+
+        """ Stop refreshing the leases """
+
+        self.stopped.set()
+
+    def stop_requested(self):
+        return os.path.exists(os.path.join(self.root, "stop"))
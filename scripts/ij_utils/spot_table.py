@@ -0,0 +1,135 @@
+"""Pixel-space spot table
+
+Converts the spots of a TrackMate model to pixel coordinates once, and
+stores them column-wise in typed arrays grouped by track and sorted by
+frame. Crop generation, export and QC read from the table instead of
+walking the model and re-calibrating every spot.
+"""
+
+import csv
+from array import array
+
+
+class SpotTable(object):
+
+    """ Column store of spots in pixel space
+    :param width, height: image size in pixels, used to clamp boxes
+    :param n_frames: number of frames of the source image
+    """
+
+    COLUMNS = ['TRACK_ID', 'SPOT_ID', 'FRAME', 'X', 'Y', 'RADIUS', 'QUALITY']
+
+    def __init__(self, width, height, n_frames):
+
+        self.width = width
+        self.height = height
+        self.n_frames = n_frames
+        self.track_id = array('i')
+        self.spot_id = array('i')
+        self.frame = array('i')
+        self.x = array('i')
+        self.y = array('i')
+        self.radius = array('d')
+        self.quality = array('d')
+        self.tracks = {}  # track id -> (first row, last row + 1)
+        self.track_order = []
+
+    @classmethod
+    def from_model(cls, model, imp, filtered=True):
+
+        """ Build the table from a TrackMate model
+        :param model: TrackMate model
+        :param imp: image the model was computed on (for calibration and size)
+        :param filtered: only keep the tracks that passed the filters
+        :return: SpotTable
+        """
+
+        cal = imp.getCalibration()
+        table = cls(imp.getWidth(), imp.getHeight(), imp.getNFrames())
+        track_model = model.getTrackModel()
+
+        for tid in track_model.trackIDs(filtered):
+            rows = []
+            for spot in track_model.trackSpots(tid):
+                rows.append((int(spot.getFeature('FRAME')),
+                             int(spot.getFeature('POSITION_X') / cal.pixelWidth),
+                             int(spot.getFeature('POSITION_Y') / cal.pixelHeight),
+                             spot.getFeature('RADIUS') / cal.pixelWidth,
+                             spot.getFeature('QUALITY'),
+                             spot.ID()))
+            table.add_track(tid, rows)
+
+        return table
+
+    def add_track(self, tid, rows):
+
+        """ Append a track
+        :param tid: track id
+        :param rows: list of (frame, x, y, radius, quality, spot id) in pixels
+        """
+
+        rows.sort()
+        start = len(self.frame)
+        for frame, x, y, radius, quality, sid in rows:
+            self.track_id.append(tid)
+            self.spot_id.append(sid)
+            self.frame.append(frame)
+            self.x.append(x)
+            self.y.append(y)
+            self.radius.append(radius or 0.0)
+            self.quality.append(quality or 0.0)
+        self.tracks[tid] = (start, len(self.frame))
+        self.track_order.append(tid)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def track_ids(self):
+        return list(self.track_order)
+
+    def track_rows(self, tid):
+
+        """ Row indices of a track, in frame order """
+
+        start, end = self.tracks[tid]
+        return range(start, end)
+
+    def first_frame(self, tid):
+        return self.frame[self.tracks[tid][0]]
+
+    def last_frame(self, tid):
+        return self.frame[self.tracks[tid][1] - 1]
+
+    def max_radius(self, tid):
+        start, end = self.tracks[tid]
+        return max(self.radius[start:end])
+
+    def bbox(self, row, w, h):
+
+        """ Box of size w x h centred on a spot, clamped to the image borders
+        :param row: row index
+        :param w, h: box size in pixels
+        :return: (x, y, width, height) of the part inside the image and the
+                 (dx, dy) offset of that part inside the w x h box.
+                 width or height are 0 if the box is fully outside
+        """
+
+        x0 = self.x[row] - w // 2
+        y0 = self.y[row] - h // 2
+        cx0, cy0 = max(x0, 0), max(y0, 0)
+        cx1 = min(x0 + w, self.width)
+        cy1 = min(y0 + h, self.height)
+
+        return (cx0, cy0, max(cx1 - cx0, 0), max(cy1 - cy0, 0),
+                cx0 - x0, cy0 - y0)
+
+    def write_csv(self, path):
+
+        """ Export the table as CSV """
+
+        with open(path, 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(self.COLUMNS)
+            for i in range(len(self)):
+                writer.writerow([self.track_id[i], self.spot_id[i], self.frame[i],
+                                 self.x[i], self.y[i], self.radius[i], self.quality[i]])
@@ -0,0 +1,131 @@
+"""Synthetic time-lapse movies with known tracks
+
+Moving Gaussian "cells" on a noisy background, with the matching _MASK
+image and the ground-truth positions. Used by the benchmarks so every
+pipeline can be run on the same data on any machine.
+"""
+
+import csv
+import math
+import random
+from jarray import array
+from ij import IJ
+from ij.process import FloatProcessor, Blitter
+from ij.plugin import ChannelSplitter, RGBStackMerge
+
+
+def gaussian_kernel(sigma, amplitude):
+
+    """ FloatProcessor with a 2D Gaussian spot """
+
+    r = int(math.ceil(3 * sigma))
+    size = 2 * r + 1
+    values = []
+    for y in range(size):
+        for x in range(size):
+            d2 = (x - r) ** 2 + (y - r) ** 2
+            values.append(amplitude * math.exp(-d2 / (2.0 * sigma * sigma)))
+    return FloatProcessor(size, size, array(values, 'f'))
+
+
+def random_tracks(width, height, n_frames, n_cells, speed, seed):
+
+    """ Random walks with drift that bounce on the image borders
+    :return: list of tracks, each a list of (x, y) per frame
+    """
+
+    rnd = random.Random(seed)
+    tracks = []
+    for cell in range(n_cells):
+        x, y = rnd.uniform(0, width), rnd.uniform(0, height)
+        angle = rnd.uniform(0, 2 * math.pi)
+        vx, vy = speed * math.cos(angle), speed * math.sin(angle)
+        positions = []
+        for t in range(n_frames):
+            positions.append((x, y))
+            x += vx + rnd.gauss(0, speed / 2.0)
+            y += vy + rnd.gauss(0, speed / 2.0)
+            if not 0 <= x < width:
+                vx, x = -vx, min(max(x, 0), width - 1)
+            if not 0 <= y < height:
+                vy, y = -vy, min(max(y, 0), height - 1)
+        tracks.append(positions)
+    return tracks
+
+
+def make_movie(width=256, height=256, n_frames=50, n_channels=1, n_cells=30,
+               sigma=2.0, speed=0.5, background=100, noise=10, seed=0, title="synthetic"):
+
+    """ Build a synthetic movie, its mask and the ground-truth tracks
+    :param width, height: frame size in pixels
+    :param n_frames: number of frames
+    :param n_channels: number of fluorescence channels
+    :param n_cells: number of cells
+    :param sigma: Gaussian sigma of the cells, in pixels
+    :param speed: mean displacement per frame, in pixels
+    :param background, noise: background level and noise standard deviation
+    :param seed: random seed
+    :return: (image, mask, tracks) with image 16-bit C x T, mask 8-bit with
+             3 channels (cell disc, cell disc, empty) and tracks a list of
+             (x, y) per frame for each cell
+    """
+
+    rnd = random.Random(seed)
+    tracks = random_tracks(width, height, n_frames, n_cells, speed, seed)
+    amplitudes = [[rnd.uniform(500, 2000) for c in range(n_channels)] for cell in range(n_cells)]
+    radius = int(math.ceil(2 * sigma))
+
+    image = IJ.createImage(title, "16-bit black", width, height, n_channels, 1, n_frames)
+    mask = IJ.createImage(title + "_MASK", "8-bit black", width, height, 3, 1, n_frames)
+    image_stack, mask_stack = image.getStack(), mask.getStack()
+    kernels = {}
+
+    for t in range(n_frames):
+        for c in range(n_channels):
+            fp = FloatProcessor(width, height)
+            fp.add(background)
+            for cell in range(n_cells):
+                amplitude = int(amplitudes[cell][c])
+                if amplitude not in kernels:
+                    kernels[amplitude] = gaussian_kernel(sigma, amplitude)
+                kernel = kernels[amplitude]
+                x, y = tracks[cell][t]
+                fp.copyBits(kernel, int(x) - kernel.getWidth() // 2, int(y) - kernel.getHeight() // 2, Blitter.ADD)
+            fp.noise(noise)
+            image_stack.setProcessor(fp.convertToShortProcessor(False), image.getStackIndex(c + 1, 1, t + 1))
+
+        for c in (1, 2):
+            ip = mask_stack.getProcessor(mask.getStackIndex(c, 1, t + 1))
+            ip.setColor(255)
+            for cell in range(n_cells):
+                x, y = tracks[cell][t]
+                ip.fillOval(int(x) - radius, int(y) - radius, 2 * radius + 1, 2 * radius + 1)
+
+    return image, mask, tracks
+
+
+def merged_movie(image, mask):
+
+    """ Signal, mask and reference channels in one hyperstack, the input
+    layout of trackmate_cells_plusRef (reference = mask for synthetic data)
+    """
+
+    signal = ChannelSplitter.split(image)[0]
+    m1, m2, m3 = ChannelSplitter.split(mask)
+    IJ.run(m1, "16-bit", "")
+    IJ.run(m2, "16-bit", "")
+    merged = RGBStackMerge().mergeChannels([signal, m1, m2], True)
+    merged.setTitle(image.getTitle() + "_merged")
+    return merged
+
+
+def write_tracks(tracks, path):
+
+    """ Save the ground-truth positions as CSV """
+
+    with open(path, 'wb') as out:
+        writer = csv.writer(out)
+        writer.writerow(['CELL_ID', 'FRAME', 'X', 'Y'])
+        for cell, positions in enumerate(tracks):
+            for t, (x, y) in enumerate(positions):
+                writer.writerow([cell, t, x, y])
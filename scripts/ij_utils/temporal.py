@@ -0,0 +1,164 @@
+"""Tracking on fewer frames, measuring on all of them
+
+Slow cells barely move between consecutive frames, so detection and
+linking can run on a reduced movie: every factor-th frame (stride), or
+groups of factor frames averaged or max-projected (bins). The reduced movie
+keeps the time calibration of the original (its frame interval is factor
+times larger), so TRACK_DURATION and its filter stay in the original units.
+Frame gaps, counted in tracked frames, are divided by the factor
+(frame_gap) so they cover the same time span.
+
+The tracks are then expanded back to every original frame they cover,
+positions and radii interpolated linearly between the detected spots, and
+measured on the original movie.
+
+    small = reduce_frames(imp, 5, MODE_MEAN)
+    ... track on small ...
+    full = expand_table(SpotTable.from_model(model, small), 5, MODE_MEAN, imp.getNFrames())
+"""
+
+from ij import ImagePlus, ImageStack
+from ij.process import Blitter
+
+from ij_utils.spot_table import SpotTable
+
+MODE_ALL = "All frames"
+MODE_STRIDE = "Stride"
+MODE_MEAN = "Mean bin"
+MODE_MAX = "Max bin"
+MODES = [MODE_ALL, MODE_STRIDE, MODE_MEAN, MODE_MAX]
+
+
+def reduced(mode, factor):
+
+    """ Whether a mode and factor actually drop frames """
+
+    return mode != MODE_ALL and factor > 1
+
+
+def frame_gap(gap, factor, mode):
+
+    """ A gap in original frames counted in tracked frames, at least 1 unless
+    gap is 0, so linking allows the same time span on a reduced movie
+    """
+
+    if not reduced(mode, factor) or gap <= 0:
+        return gap
+    return max(int(gap) // factor, 1)
+
+
+def combine(planes, mode):
+
+    """ One plane from a group of frames, in the type of the input """
+
+    if mode == MODE_STRIDE or len(planes) == 1:
+        return planes[0].duplicate()
+    if mode == MODE_MAX:
+        out = planes[0].duplicate()
+        for ip in planes[1:]:
+            out.copyBits(ip, 0, 0, Blitter.MAX)
+        return out
+    acc = planes[0].convertToFloat().duplicate()
+    for ip in planes[1:]:
+        acc.copyBits(ip.convertToFloat(), 0, 0, Blitter.ADD)
+    acc.multiply(1.0 / len(planes))
+    bits = planes[0].getBitDepth()
+    if bits == 8:
+        return acc.convertToByteProcessor(False)
+    if bits == 16:
+        return acc.convertToShortProcessor(False)
+    return acc
+
+
+def reduce_frames(imp, factor, mode, title=None):
+
+    """ Movie with one frame per group of factor frames
+    :param imp: C x Z x T hyperstack
+    :param factor: frames per group
+    :param mode: MODE_STRIDE (first frame of each group), MODE_MEAN or MODE_MAX
+    :return: new ImagePlus, frame interval multiplied by factor
+    """
+
+    nc, nz, nt = imp.getNChannels(), imp.getNSlices(), imp.getNFrames()
+    src = imp.getStack()
+    out = ImageStack(imp.getWidth(), imp.getHeight())
+    n_out = (nt + factor - 1) // factor
+    for i in range(n_out):
+        frames = range(i * factor, min((i + 1) * factor, nt))
+        if mode == MODE_STRIDE:
+            frames = frames[:1]
+        for z in range(1, nz + 1):
+            for c in range(1, nc + 1):
+                planes = [src.getProcessor(imp.getStackIndex(c, z, t + 1)) for t in frames]
+                out.addSlice("frames %d-%d" % (frames[0] + 1, frames[-1] + 1), combine(planes, mode))
+
+    small = ImagePlus(title or imp.getTitle(), out)
+    small.setDimensions(nc, nz, n_out)
+    small.setOpenAsHyperStack(True)
+    cal = imp.getCalibration().copy()
+    cal.frameInterval = (cal.frameInterval or 1.0) * factor
+    small.setCalibration(cal)
+    return small
+
+
+def frame_center(i, factor, mode):
+
+    """ Original frame (may be fractional) a reduced frame stands for """
+
+    return i * factor if mode == MODE_STRIDE else i * factor + (factor - 1) / 2.0
+
+
+def frame_span(i, factor, mode, n_frames):
+
+    """ First and last original frames covered by a reduced frame """
+
+    if mode == MODE_STRIDE:
+        return i * factor, i * factor
+    return i * factor, min(i * factor + factor - 1, n_frames - 1)
+
+
+def expand_track(points, factor, mode, n_frames):
+
+    """ Spots of a track at every original frame it covers
+    :param points: list of (reduced frame, x, y, radius, quality, spot id), any order
+    :return: list of (frame, x, y, radius, quality, spot id) in frame order;
+             x, y and radius are interpolated between the detected spots,
+             quality and spot id are those of the nearest detected spot
+             (spot id -1 for frames that were not detected themselves)
+    """
+
+    points = sorted(points)
+    if not points:
+        return []
+    centers = [frame_center(p[0], factor, mode) for p in points]
+    first = frame_span(points[0][0], factor, mode, n_frames)[0]
+    last = frame_span(points[-1][0], factor, mode, n_frames)[1]
+    out, j = [], 0
+    for f in range(first, last + 1):
+        while j + 1 < len(points) and centers[j + 1] <= f:
+            j += 1
+        a = points[j]
+        if f <= centers[0] or j + 1 == len(points):
+            x, y, r = a[1], a[2], a[3]
+            near, center = a, centers[j]
+        else:
+            b = points[j + 1]
+            w = (f - centers[j]) / float(centers[j + 1] - centers[j])
+            x, y, r = a[1] + w * (b[1] - a[1]), a[2] + w * (b[2] - a[2]), a[3] + w * (b[3] - a[3])
+            near, center = (a, centers[j]) if w <= 0.5 else (b, centers[j + 1])
+        sid = near[5] if int(round(center)) == f else -1
+        out.append((f, x, y, r, near[4], sid))
+    return out
+
+
+def expand_table(table, factor, mode, n_frames):
+
+    """ SpotTable of a reduced movie expanded to the original frames """
+
+    full = SpotTable(table.width, table.height, n_frames)
+    for tid in table.track_ids():
+        points = [(table.frame[row], table.x[row], table.y[row], table.radius[row],
+                   table.quality[row], table.spot_id[row]) for row in table.track_rows(tid)]
+        full.add_track(tid, [(f, int(round(x)), int(round(y)), r, q, sid)
+                             for f, x, y, r, q, sid in expand_track(points, factor, mode, n_frames)])
+    return full
@@ -0,0 +1,224 @@
+"""Tiled processing of large planes with overlap halos
+
+A plane is split into tiles; each tile is processed together with a halo
+(border) at least as wide as the footprint of the operators applied to it,
+and only its core is copied back into the output. Away from the image
+borders every core pixel therefore sees the same neighbourhood as in
+whole-image processing, and memory is bounded by the tile size times the
+number of workers instead of by the plane size.
+
+    executor = TileExecutor(tile_size=2048)
+    halo = rolling_ball_halo(12.5) + rank_halo(1)
+    out = executor.map_stack(stack, clean_tile, halo)
+
+Tile origins are multiples of ALIGN so the shrunk grid of the rolling ball
+(BackgroundSubtracter) falls on the same pixels as for the whole image.
+"""
+
+import math
+import threading
+from java.awt import Rectangle
+from java.lang import Runtime
+from java.util.concurrent import Executors, Callable
+from ij import ImageStack
+
+ALIGN = 8
+
+
+def gaussian_halo(sigma, accuracy=0.0002):
+
+    """ Kernel radius of GaussianBlur (0.002 for 8-bit/RGB, 0.0002 otherwise) """
+
+    return int(math.ceil(sigma * math.sqrt(-2 * math.log(accuracy)))) + 1
+
+
+def rank_halo(radius):
+
+    """ Kernel radius of RankFilters (median, mean, variance, min, max...) """
+
+    r2 = int(radius * radius) + 1
+    return int(math.sqrt(r2 + 1e-10))
+
+
+def rolling_ball_halo(radius):
+
+    """ Reach of Subtract Background: the ball (erosion + dilation), the
+    shrink blocks and interpolation, and the 3x3 presmoothing
+    """
+
+    shrink = 1 if radius <= 10 else 2 if radius <= 30 else 4 if radius <= 100 else 8
+    return 2 * int(math.ceil(radius)) + 2 * shrink + 1
+
+
+def local_threshold_halo(radius):
+
+    """ Reach of Auto Local Threshold (the plugin truncates the radius) """
+
+    return rank_halo(max(int(radius), 1)) + 1
+
+
+def weka_halo(segmentation):
+
+    """ Reach of the Trainable Weka Segmentation features: the Gaussian
+    kernels of the largest sigma, twice for the features smoothing a first
+    filter (structure tensor), plus the membrane projection patch
+    """
+
+    from trainableSegmentation import FeatureStack
+    enabled = dict(zip(FeatureStack.availableFeatures, segmentation.getEnabledFeatures()))
+    sigma = max(segmentation.getMaximumSigma(), 1.0)
+    halo = gaussian_halo(sigma)
+    if enabled.get("Structure"):
+        halo *= 2
+    if enabled.get("Membrane_projections"):
+        halo += segmentation.getMembranePatchSize() // 2 + 1
+    return halo
+
+
+def align(n, step=ALIGN):
+    return int(math.ceil(n / float(step))) * step
+
+
+class Tile(object):
+
+    """ Core and padded (core + halo, clamped to the image) rectangles """
+
+    def __init__(self, x, y, w, h, width, height, halo):
+
+        self.core = Rectangle(x, y, w, h)
+        px, py = max(x - halo, 0), max(y - halo, 0)
+        self.padded = Rectangle(px, py, min(x + w + halo, width) - px, min(y + h + halo, height) - py)
+
+    def core_in_padded(self):
+        return Rectangle(self.core.x - self.padded.x, self.core.y - self.padded.y,
+                         self.core.width, self.core.height)
+
+
+def make_tiles(width, height, tile_size, halo):
+
+    """ Tiles covering a width x height plane
+    :param tile_size: core size, rounded up to a multiple of ALIGN
+    :param halo: halo width, rounded up to a multiple of ALIGN
+    """
+
+    tile_size, halo = align(tile_size), align(halo)
+    return [Tile(x, y, min(tile_size, width - x), min(tile_size, height - y), width, height, halo)
+            for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+
+class _TileTask(Callable):
+
+    def __init__(self, run):
+        self.run = run
+
+    def call(self):
+        return self.run()
+
+
+class TileExecutor(object):
+
+    """ Apply a function to the tiles of planes on a thread pool
+    :param tile_size: core size of the tiles; 0 processes whole planes
+    :param workers: threads, 0 for one per core
+    """
+
+    def __init__(self, tile_size=2048, workers=0):
+
+        self.tile_size = tile_size
+        self.workers = workers or Runtime.getRuntime().availableProcessors()
+
+    def tiles(self, ip, halo):
+
+        w, h = ip.getWidth(), ip.getHeight()
+        if self.tile_size <= 0:
+            return make_tiles(w, h, max(w, h), 0)
+        return make_tiles(w, h, self.tile_size, halo)
+
+    def run_tasks(self, tasks):
+
+        """ Run callables on the pool, re-raising the first error """
+
+        pool = Executors.newFixedThreadPool(min(self.workers, max(len(tasks), 1)))
+        try:
+            for future in pool.invokeAll([_TileTask(t) for t in tasks]):
+                future.get()
+        finally:
+            pool.shutdown()
+
+    def _plane_tasks(self, ip, fn, halo, store):
+
+        """ Tasks processing the tiles of one plane; store(tile, result) keeps the core """
+
+        def task(tile):
+            def run():
+                ip_tile = _crop(ip, tile.padded)
+                result = fn(ip_tile)
+                if result is None:
+                    result = ip_tile
+                result.setRoi(tile.core_in_padded())
+                store(tile, result.crop())
+            return run
+        return [task(tile) for tile in self.tiles(ip, halo)]
+
+    def map(self, ip, fn, halo):
+
+        """ fn applied to a plane tile by tile
+        :param ip: ImageProcessor
+        :param fn: function(tile ImageProcessor) -> processed tile of the same
+                   size (or None if processed in place); may change the type
+        :param halo: reach of fn in pixels
+        :return: new ImageProcessor
+        """
+
+        return self.map_stack([ip], fn, halo)[0]
+
+    def map_stack(self, planes, fn, halo):
+
+        """ fn applied to every plane of a stack, tiles of all planes in parallel
+        :param planes: ImageStack or list of ImageProcessor
+        :return: list of new ImageProcessor, one per plane
+        """
+
+        if isinstance(planes, ImageStack):
+            planes = [planes.getProcessor(i + 1) for i in range(planes.getSize())]
+        outputs = [None] * len(planes)
+        lock = threading.Lock()
+
+        def store_into(k):
+            def store(tile, core):
+                with lock:
+                    if outputs[k] is None:
+                        outputs[k] = core.createProcessor(planes[k].getWidth(), planes[k].getHeight())
+                outputs[k].insert(core, tile.core.x, tile.core.y)
+            return store
+
+        tasks = []
+        for k, ip in enumerate(planes):
+            tasks += self._plane_tasks(ip, fn, halo, store_into(k))
+        self.run_tasks(tasks)
+        return outputs
+
+    def map_to_stack(self, stack, fn, halo):
+
+        """ map_stack returning an ImageStack with the slice labels of the input """
+
+        out = ImageStack(stack.getWidth(), stack.getHeight())
+        for i, ip in enumerate(self.map_stack(stack, fn, halo)):
+            out.addSlice(stack.getSliceLabel(i + 1), ip)
+        return out
+
+
+def _crop(ip, rect):
+
+    """ Copy of a rectangle of a processor; the ROI of the processor is
+    shared between the tasks, so it is set and cropped under a lock
+    """
+
+    with _crop_lock:
+        ip.setRoi(rect)
+        sub = ip.crop()
+        ip.resetRoi()
+    return sub
+
+
+_crop_lock = threading.Lock()
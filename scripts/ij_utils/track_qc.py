@@ -0,0 +1,210 @@
+"""Tracking quality control
+
+Metrics of a TrackMate model computed in bulk once the tracking is done,
+so a run within the configured bounds is accepted without watching the
+tracks and only the outliers are kept for manual review:
+
+    spots                  spots detected (visible)
+    tracks                 tracks kept by the filters
+    linked_fraction        detected spots that belong to a kept track
+    kept_track_fraction    tracks kept by the duration filter
+    near_filter_fraction   kept tracks lasting less than 1.25x the duration
+                           filter (fragmented tracks barely passing it)
+    median_duration        median TRACK_DURATION of the kept tracks
+    gaps_per_track         frames skipped by gap closing, per kept track
+    outlier_step_fraction  steps longer than the median step + 5 MADs
+    count_cv               coefficient of variation of the spots per frame
+    count_jump             largest change of the spots between two frames,
+                           relative to the mean spots per frame
+
+    report = assess(model, imp, duration, bounds)
+    if needs_review(REVIEW_OUTLIERS, report):
+        ...
+"""
+
+import csv
+import json
+import math
+
+from ij_utils.spot_table import SpotTable
+
+REVIEW_OUTLIERS = "Outliers only"
+REVIEW_ALL = "Every movie"
+REVIEW_NONE = "None"
+REVIEW_MODES = [REVIEW_OUTLIERS, REVIEW_ALL, REVIEW_NONE]
+
+METRICS = ['spots', 'tracks', 'linked_fraction', 'kept_track_fraction', 'near_filter_fraction',
+           'median_duration', 'gaps_per_track', 'outlier_step_fraction', 'count_cv', 'count_jump']
+
+# (min, max) accepted, None for an open bound; metrics not listed are only reported
+BOUNDS = {
+    'tracks': (1, None),
+    'linked_fraction': (0.5, None),
+    'near_filter_fraction': (None, 0.5),
+    'gaps_per_track': (None, 2.0),
+    'outlier_step_fraction': (None, 0.02),
+    'count_jump': (None, 0.3),
+}
+
+OUTLIER_MADS = 5.0
+MIN_MAD = 0.5  # pixels, so still cells do not make every step an outlier
+
+
+def load_bounds(path=None):
+
+    """ Default bounds, updated from a JSON file {"metric": [min, max], ...}
+    :param path: JSON file or None
+    :return: dict metric -> (min, max)
+    """
+
+    bounds = dict(BOUNDS)
+    if path:
+        with open(path) as f:
+            for name, (lo, hi) in json.load(f).items():
+                if name not in METRICS:
+                    raise ValueError("Unknown QC metric " + name)
+                bounds[name] = (lo, hi)
+    return bounds
+
+
+def median(values):
+
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return float('nan')
+    return values[n // 2] if n % 2 else 0.5 * (values[n // 2 - 1] + values[n // 2])
+
+
+def _ratio(a, b):
+    return a / float(b) if b else float('nan')
+
+
+class NeedsReview(Exception):
+
+    """ Raised for a movie whose metrics are out of bounds, to review it
+    after the movies that passed
+    """
+
+    def __init__(self, report):
+        Exception.__init__(self, "Tracking QC: " + report.summary())
+        self.report = report
+
+
+class QcReport(object):
+
+    """ Tracking metrics of a movie and the bounds they break
+    :param metrics: dict metric -> value
+    :param bounds: dict metric -> (min, max)
+    """
+
+    def __init__(self, metrics, bounds):
+
+        self.metrics = metrics
+        self.bounds = bounds
+        self.reviewed = False
+        self.failures = []
+        for name in METRICS:
+            lo, hi = bounds.get(name, (None, None))
+            value = metrics[name]
+            # NaN (no tracks, no steps) fails a bounded metric
+            if (lo is not None or hi is not None) and math.isnan(value):
+                self.failures.append((name, value, lo, hi))
+            elif (lo is not None and value < lo) or (hi is not None and value > hi):
+                self.failures.append((name, value, lo, hi))
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    def summary(self):
+
+        """ One line: passed, or the metrics out of bounds """
+
+        if self.ok:
+            return "passed (%d tracks, %.0f%% of spots linked)" % (
+                self.metrics['tracks'], 100 * self.metrics['linked_fraction'])
+        return "; ".join("%s = %.3g not in [%s, %s]" % (name, value, "" if lo is None else lo,
+                                                         "" if hi is None else hi)
+                         for name, value, lo, hi in self.failures)
+
+    def write_csv(self, path):
+
+        """ One-row table of the metrics and the decision """
+
+        status = "reviewed" if self.reviewed else ("passed" if self.ok else "outlier")
+        with open(path, 'wb') as out:
+            writer = csv.writer(out)
+            writer.writerow(['STATUS'] + METRICS + ['FAILED'])
+            writer.writerow([status] + [self.metrics[name] for name in METRICS] +
+                            [" ".join(name for name, _, _, _ in self.failures)])
+
+
+def assess(model, imp, duration, bounds=None, table=None):
+
+    """ Tracking metrics of a model, checked against bounds
+    :param model: TrackMate model after process()
+    :param imp: image tracked
+    :param duration: value of the TRACK_DURATION filter
+    :param bounds: dict metric -> (min, max), default BOUNDS
+    :param table: SpotTable of the kept tracks, built if None
+    :return: QcReport
+    """
+
+    spots = model.getSpots()
+    track_model = model.getTrackModel()
+    features = model.getFeatureModel()
+    if table is None:
+        table = SpotTable.from_model(model, imp)
+
+    n_spots = spots.getNSpots(True)
+    all_tracks = track_model.nTracks(False)
+    kept = table.track_ids()
+    durations = [features.getTrackFeature(tid, 'TRACK_DURATION') for tid in kept]
+    durations = [d for d in durations if d is not None]
+
+    gaps, steps = 0, []
+    for tid in kept:
+        rows = table.track_rows(tid)
+        for a, b in zip(rows[:-1], rows[1:]):
+            df = table.frame[b] - table.frame[a]
+            if df <= 0:
+                continue
+            gaps += df - 1
+            steps.append(math.hypot(table.x[b] - table.x[a], table.y[b] - table.y[a]) / df)
+
+    outliers = 0
+    if steps:
+        mid = median(steps)
+        mad = max(1.4826 * median([abs(s - mid) for s in steps]), MIN_MAD)
+        outliers = len([s for s in steps if s > mid + OUTLIER_MADS * mad])
+
+    counts = [spots.getNSpots(t, True) for t in range(imp.getNFrames())]
+    mean = sum(counts) / float(len(counts)) if counts else 0.0
+    sd = math.sqrt(sum((c - mean) ** 2 for c in counts) / len(counts)) if counts else 0.0
+    jump = max([abs(b - a) for a, b in zip(counts[:-1], counts[1:])] or [0])
+
+    metrics = {
+        'spots': n_spots,
+        'tracks': len(kept),
+        'linked_fraction': _ratio(len(table), n_spots),
+        'kept_track_fraction': _ratio(len(kept), all_tracks),
+        'near_filter_fraction': _ratio(len([d for d in durations if d < 1.25 * duration]), len(durations)),
+        'median_duration': median(durations),
+        'gaps_per_track': _ratio(gaps, len(kept)),
+        'outlier_step_fraction': _ratio(outliers, len(steps)),
+        'count_cv': _ratio(sd, mean),
+        'count_jump': _ratio(jump, mean),
+    }
+    return QcReport(metrics, bounds if bounds is not None else BOUNDS)
+
+
+def needs_review(mode, report):
+
+    """ Whether a run is shown for manual review under a review mode """
+
+    if mode == REVIEW_ALL:
+        return True
+    if mode == REVIEW_NONE:
+        return False
+    return not report.ok
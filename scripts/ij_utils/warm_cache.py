@@ -0,0 +1,58 @@
+"""Models kept loaded between script runs
+
+The module stays imported for the life of the Jython interpreter (the
+warm worker, or a Fiji session), so a model loaded by one run is reused by
+the next ones as long as its file is unchanged:
+
+    weka = warm_cache.load(model_path, load_weka)
+    spare = warm_cache.load(model_path, load_weka, copy=1)   # for another thread
+"""
+
+import os
+import threading
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def file_key(path):
+
+    """ Identity of a file's content: path, size and modification time """
+
+    st = os.stat(path)
+    return os.path.realpath(path), st.st_size, int(st.st_mtime)
+
+
+def load(path, loader, copy=0):
+
+    """ Cached loader(path), loaded again when the file changes
+    :param path: model file
+    :param loader: function(path) -> model
+    :param copy: index of an independent instance of the model (e.g. one
+                 per thread for models that are not thread-safe), 0 for the
+                 shared one
+    """
+
+    key = file_key(path) + (copy,)
+    with _lock:
+        if key in _cache:
+            return _cache[key]
+    model = loader(path)
+    with _lock:
+        # a changed file replaces its previous version, all copies
+        for old in [k for k in _cache if k[0] == key[0] and k[1:3] != key[1:3]]:
+            del _cache[old]
+        _cache[key] = model
+    return model
+
+
+def clear():
+
+    """ Drop every cached model (e.g. after running out of memory) """
+
+    with _lock:
+        _cache.clear()
+
+
+def size():
+    return len(_cache)
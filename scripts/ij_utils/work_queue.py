@@ -0,0 +1,395 @@
+"""Shared-filesystem work queue for folder batches on several machines
+
+Every worker (Fiji, headless or not, on any node that mounts the folders)
+runs the same folder driver with the same queue folder. Each one enqueues
+the inputs it finds (idempotent, the first writer wins), then claims jobs
+one at a time until none is left. Only POSIX file operations are used, so
+no broker is needed:
+
+    queue/jobs/<id>.json     job description, created once with O_EXCL
+    queue/leases/<id>        lease of the worker processing the job; created
+                             with O_EXCL (the atomic claim) and touched every
+                             heartbeat_s by a background thread
+    queue/done/<id>.json     completion record (worker, outputs, times)
+    queue/failed/<id>.json   last error and number of attempts
+    queue/clock/<worker>     touched to read the file server clock
+
+A lease not touched for lease_s (measured on the file server clock, so the
+nodes' clocks do not matter) belongs to a dead worker: it is renamed away,
+which only one worker can do, and the job is claimed again. Failed jobs are
+retried until max_attempts. Job ids hash the input key with the run
+parameters, so changing the parameters makes new jobs in the same folder.
+
+    queue = WorkQueue(queue_dir, params)
+    for pair in queue.claimed(pairs, key=lambda pair: pair[0].getCanonicalPath()):
+        ...
+        queue.complete(key, outputs)      # or queue.fail(key, error)
+    queue.merge(out_dir)                  # by the worker that sees the queue finished
+
+Outputs the workers cannot share (run manifest, profiles) are written under
+worker_name() and combined by merge().
+"""
+
+import os
+import csv
+import json
+import time
+import uuid
+import random
+import socket
+import hashlib
+import threading
+
+from ij_utils.manifest import replace_file, params_hash, merge_manifests
+
+LEASE_S = 600
+HEARTBEAT_S = 30
+MAX_ATTEMPTS = 2
+
+
+def read_json(path):
+
+    """ Parsed JSON file, None if missing or being replaced """
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+
+    """ Write a JSON file under a temporary name and rename it into place """
+
+    tmp = path + "." + uuid.uuid4().hex[:8] + ".partial"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    replace_file(tmp, path)
+
+
+def create_exclusive(path, text):
+
+    """ Create a file only if it does not exist (the atomic claim)
+    :return: True if this call created it
+    """
+
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    try:
+        os.write(fd, text.encode('utf-8'))
+    finally:
+        os.close(fd)
+    return True
+
+
+def merge_csv(paths, out_path):
+
+    """ Concatenate CSV files with the same header into out_path """
+
+    header, rows = None, []
+    for path in sorted(paths):
+        with open(path, 'rb') as f:
+            reader = csv.reader(f)
+            head = next(reader, None)
+            if head is None:
+                continue
+            if header is None:
+                header = head
+            elif head != header:
+                raise ValueError("Different columns in " + path)
+            rows.extend(reader)
+    if header is None:
+        return
+    tmp = out_path + ".partial"
+    with open(tmp, 'wb') as out:
+        writer = csv.writer(out)
+        writer.writerow(header)
+        writer.writerows(rows)
+    replace_file(tmp, out_path)
+
+
+class WorkQueue(object):
+
+    """ Job queue in a folder shared by the workers
+    :param root: queue folder (created if missing)
+    :param params: run parameters, part of the job ids
+    :param lease_s: seconds without heartbeat after which a lease is expired
+    :param heartbeat_s: seconds between two touches of the held leases
+    :param max_attempts: failures after which a job is given up
+    """
+
+    def __init__(self, root, params=None, lease_s=LEASE_S, heartbeat_s=HEARTBEAT_S, max_attempts=MAX_ATTEMPTS):
+
+        self.root = root
+        self.params_hash = params_hash(params or {})
+        self.lease_s = lease_s
+        self.heartbeat_s = heartbeat_s
+        self.max_attempts = max_attempts
+        self.worker = "%s-%d-%s" % (socket.gethostname().split(".")[0], os.getpid(), uuid.uuid4().hex[:6])
+        for sub in ("jobs", "leases", "done", "failed", "clock"):
+            if not os.path.isdir(os.path.join(root, sub)):
+                try:
+                    os.makedirs(os.path.join(root, sub))
+                except OSError:
+                    pass  # created by another worker
+        self.held = {}  # job id -> lease token
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heart = threading.Thread(target=self._heartbeat, name="queue-heartbeat")
+        self.heart.setDaemon(True)
+        self.heart.start()
+
+    # -- paths
+
+    def job_id(self, key):
+
+        """ Stable id of an input key for these parameters """
+
+        name = "".join([c if c.isalnum() or c in "-_." else "_" for c in os.path.basename(key)])[:60]
+        return name + "-" + hashlib.sha1(key.encode('utf-8') + self.params_hash).hexdigest()[:12]
+
+    def _path(self, sub, job_id, ext=""):
+        return os.path.join(self.root, sub, job_id + ext)
+
+    def worker_name(self, prefix, ext):
+
+        """ File name for an output of this worker, e.g. run_manifest.<worker>.json """
+
+        return prefix + "." + self.worker + ext
+
+    def fs_now(self):
+
+        """ Current time of the file server (mtimes are set by it) """
+
+        path = os.path.join(self.root, "clock", self.worker)
+        if not os.path.exists(path):
+            open(path, 'w').close()
+        os.utime(path, None)
+        return os.path.getmtime(path)
+
+    # -- jobs
+
+    def enqueue(self, keys):
+
+        """ Add jobs for input keys; jobs already in the queue are kept """
+
+        for key in keys:
+            create_exclusive(self._path("jobs", self.job_id(key), ".json"),
+                             json.dumps({'key': key, 'params_hash': self.params_hash}))
+
+    def attempts(self, job_id):
+
+        record = read_json(self._path("failed", job_id, ".json"))
+        return record['attempts'] if record else 0
+
+    def is_done(self, job_id):
+        return os.path.exists(self._path("done", job_id, ".json"))
+
+    def is_open(self, job_id):
+
+        """ Neither done nor given up after max_attempts failures """
+
+        return not self.is_done(job_id) and self.attempts(job_id) < self.max_attempts
+
+    def claim(self, key):
+
+        """ Try to take the lease of a job
+        :return: True if this worker now holds it
+        """
+
+        job_id = self.job_id(key)
+        if not self.is_open(job_id):
+            return False
+        lease = self._path("leases", job_id)
+        token = uuid.uuid4().hex
+        if not create_exclusive(lease, json.dumps({'worker': self.worker, 'token': token})):
+            self._expire(job_id)
+            if not create_exclusive(lease, json.dumps({'worker': self.worker, 'token': token})):
+                return False
+        if not self.is_open(job_id):
+            # finished by the previous holder between the check and the claim
+            self._remove_lease(job_id, token)
+            return False
+        with self.lock:
+            self.held[job_id] = token
+        return True
+
+    def _expire(self, job_id):
+
+        """ Remove the lease of a job if its holder stopped heartbeating """
+
+        lease = self._path("leases", job_id)
+        try:
+            if self.fs_now() - os.path.getmtime(lease) < self.lease_s:
+                return False
+            stale = lease + ".expired-" + self.worker
+            os.rename(lease, stale)  # only one worker wins the rename
+        except OSError:
+            return False
+        os.remove(stale)
+        return True
+
+    def _owns(self, job_id, token):
+
+        lease = read_json(self._path("leases", job_id))
+        return lease is not None and lease.get('token') == token
+
+    def _remove_lease(self, job_id, token):
+
+        if self._owns(job_id, token):
+            try:
+                os.remove(self._path("leases", job_id))
+            except OSError:
+                pass
+
+    def _heartbeat(self):
+
+        """ Touch the held leases; a lease taken over by another worker is dropped """
+
+        while not self.stopped.is_set():
+            self.stopped.wait(self.heartbeat_s)
+            with self.lock:
+                held = list(self.held.items())
+            for job_id, token in held:
+                if self._owns(job_id, token):
+                    try:
+                        os.utime(self._path("leases", job_id), None)
+                    except OSError:
+                        pass
+                else:
+                    with self.lock:
+                        if self.held.get(job_id) == token:
+                            del self.held[job_id]
+
+    def complete(self, key, outputs=None):
+
+        """ Record a job as done and drop its lease
+        :param outputs: optional list of output files, kept in the record
+        """
+
+        job_id = self.job_id(key)
+        with self.lock:
+            token = self.held.pop(job_id, None)
+        write_json(self._path("done", job_id, ".json"),
+                   {'key': key, 'worker': self.worker, 'outputs': outputs or [],
+                    'finished': time.strftime("%Y-%m-%d %H:%M:%S")})
+        self._remove_lease(job_id, token)
+
+    def fail(self, key, error):
+
+        """ Record a failed attempt and drop the lease; the job is retried
+        by any worker until max_attempts
+        """
+
+        job_id = self.job_id(key)
+        with self.lock:
+            token = self.held.pop(job_id, None)
+        write_json(self._path("failed", job_id, ".json"),
+                   {'key': key, 'worker': self.worker, 'error': str(error),
+                    'attempts': self.attempts(job_id) + 1})
+        self._remove_lease(job_id, token)
+
+    def release(self, key):
+
+        """ Give a claimed job back without recording an attempt """
+
+        job_id = self.job_id(key)
+        with self.lock:
+            token = self.held.pop(job_id, None)
+        self._remove_lease(job_id, token)
+
+    def release_all(self):
+
+        with self.lock:
+            held = list(self.held.items())
+            self.held.clear()
+        for job_id, token in held:
+            self._remove_lease(job_id, token)
+
+    def close(self):
+
+        """ Stop the heartbeat and give back the jobs not completed """
+
+        self.stopped.set()
+        self.release_all()
+
+    # -- iteration
+
+    def claimed(self, items, key):
+
+        """ Enqueue items, then yield the ones this worker claims
+        Once nothing is claimable the generator waits for the jobs leased
+        by other workers, taking over those whose lease expires, and stops
+        when every job is done or given up.
+        :param items: inputs, the same list on every worker
+        :param key: function(item) -> unique string (e.g. the input path)
+        """
+
+        items = list(items)
+        keys = [key(item) for item in items]
+        self.enqueue(keys)
+        # workers start at different places to avoid claiming in lockstep
+        order = list(range(len(items)))
+        random.shuffle(order)
+        while True:
+            claimed_any, open_jobs = False, False
+            for i in order:
+                job_id = self.job_id(keys[i])
+                if not self.is_open(job_id):
+                    continue
+                if self.claim(keys[i]):
+                    claimed_any = True
+                    yield items[i]
+                else:
+                    open_jobs = True  # leased by another worker
+            if not claimed_any and not open_jobs:
+                return
+            if not claimed_any:
+                time.sleep(min(self.heartbeat_s, self.lease_s / 4.0))
+
+    def status(self, keys):
+
+        """ Number of jobs of keys done, failed for good, leased and pending """
+
+        counts = {'done': 0, 'failed': 0, 'leased': 0, 'pending': 0}
+        for k in keys:
+            job_id = self.job_id(k)
+            if self.is_done(job_id):
+                counts['done'] += 1
+            elif self.attempts(job_id) >= self.max_attempts:
+                counts['failed'] += 1
+            elif os.path.exists(self._path("leases", job_id)):
+                counts['leased'] += 1
+            else:
+                counts['pending'] += 1
+        return counts
+
+    def finished(self, keys):
+
+        counts = self.status(keys)
+        return counts['leased'] == 0 and counts['pending'] == 0
+
+    def merge(self, out_dir, params=None, profile_prefix="profile"):
+
+        """ Combine the per-worker run manifests and profiles of out_dir
+        Only one worker merges at a time; the per-worker files are kept so a
+        later merge gives the same result.
+        :return: True if this worker merged
+        """
+
+        lock = os.path.join(self.root, "merge.lock")
+        if not create_exclusive(lock, self.worker):
+            return False
+        try:
+            merge_manifests(out_dir, params)
+            names = os.listdir(out_dir)
+            profiles = [os.path.join(out_dir, n) for n in names
+                        if n.startswith(profile_prefix + ".") and n.endswith(".csv") and "_summary" not in n]
+            if profiles:
+                merge_csv(profiles, os.path.join(out_dir, profile_prefix + ".csv"))
+        finally:
+            os.remove(lock)
+        return True
@@ -0,0 +1,251 @@
+"""Streaming OME-Zarr (NGFF 0.4, Zarr v2) writer for time-lapse movies
+
+Frames are appended one at a time. Every full block of frames is cut into
+zlib-compressed chunks written in parallel, and each frame is averaged 2x2
+into the next pyramid level as it arrives, so the movie is never held in
+memory. The layout on disk is
+
+    movie.zarr/.zgroup, .zattrs      multiscales metadata, axes t, y, x
+    movie.zarr/0/.zarray, 0/t/y/x    full resolution chunks
+    movie.zarr/1/...                 each level half the size of the previous
+
+which the Fiji N5/OME-Zarr readers, napari and zarr-python open lazily.
+"""
+
+import os
+import json
+from java.lang import Runtime, System
+from java.nio import ByteBuffer, ByteOrder
+from java.util.concurrent import Executors, Callable
+from java.util.zip import Deflater
+from jarray import zeros
+from ij.process import ImageProcessor
+
+DTYPES = {8: "|u1", 16: "<u2", 32: "<f4"}
+UNITS = {"micron": "micrometer", "microns": "micrometer", "um": "micrometer", u"\u00b5m": "micrometer",
+         "nm": "nanometer", "mm": "millimeter", "sec": "second", "s": "second", "min": "minute"}
+
+
+def write_json(path, data):
+
+    """ Replace a small JSON file atomically """
+
+    tmp = path + ".partial"
+    with open(tmp, 'w') as out:
+        json.dump(data, out, indent=2)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+def encode(pixels, bits, level=5):
+
+    """ zlib-compressed little-endian bytes of a pixel array """
+
+    if bits == 8:
+        raw = pixels
+    else:
+        buf = ByteBuffer.allocate(len(pixels) * bits // 8).order(ByteOrder.LITTLE_ENDIAN)
+        if bits == 16:
+            buf.asShortBuffer().put(pixels)
+        else:
+            buf.asFloatBuffer().put(pixels)
+        raw = buf.array()
+    deflater = Deflater(level)
+    deflater.setInput(raw)
+    deflater.finish()
+    out = zeros(len(raw) + 1024, 'b')
+    n = 0
+    while not deflater.finished():
+        n += deflater.deflate(out, n, len(out) - n)
+        if n == len(out):
+            grown = zeros(2 * len(out), 'b')
+            System.arraycopy(out, 0, grown, 0, n)
+            out = grown
+    deflater.end()
+    return out[:n].tostring()
+
+
+class _Task(Callable):
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def call(self):
+        self.fn(*self.args)
+
+
+class ZarrLevel(object):
+
+    """ One resolution level: frames are buffered until a time chunk is full
+    :param path: folder of the level array
+    :param width, height: size of the level
+    :param bits: 8, 16 or 32
+    :param chunks: chunk shape (t, y, x)
+    """
+
+    def __init__(self, path, width, height, bits, chunks):
+
+        self.path = path
+        self.width = width
+        self.height = height
+        self.bits = bits
+        self.chunks = chunks
+        self.frames = []
+        self.n_frames = 0
+        self.n_blocks = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def zarray(self):
+
+        return {'zarr_format': 2, 'shape': [self.n_frames, self.height, self.width],
+                'chunks': list(self.chunks), 'dtype': DTYPES[self.bits],
+                'compressor': {'id': 'zlib', 'level': 5}, 'fill_value': 0, 'order': 'C',
+                'filters': None, 'dimension_separator': '/'}
+
+    def write_zarray(self):
+        write_json(os.path.join(self.path, ".zarray"), self.zarray())
+
+    def add(self, ip):
+
+        """ Buffer a frame; return the chunk tasks when a time chunk is full """
+
+        self.frames.append(ip)
+        self.n_frames += 1
+        if len(self.frames) == self.chunks[0]:
+            return self.flush()
+        return []
+
+    def flush(self):
+
+        """ Chunk tasks of the buffered frames (a last partial block is padded) """
+
+        if not self.frames:
+            return []
+        frames, t_block = [ip.getPixels() for ip in self.frames], self.n_blocks
+        self.frames = []
+        self.n_blocks += 1
+        ct, ch, cw = self.chunks
+        ny, nx = (self.height + ch - 1) // ch, (self.width + cw - 1) // cw
+        return [_Task(self.write_chunk, t_block, cy, cx, frames) for cy in range(ny) for cx in range(nx)]
+
+    def write_chunk(self, t_block, cy, cx, frames):
+
+        """ Copy, compress and write chunk (t_block, cy, cx)
+        Edge chunks are written full size, padded with the fill value.
+        """
+
+        ct, ch, cw = self.chunks
+        x0, y0 = cx * cw, cy * ch
+        w, h = min(cw, self.width - x0), min(ch, self.height - y0)
+        block = zeros(ct * ch * cw, {8: 'b', 16: 'h', 32: 'f'}[self.bits])
+        for i, pixels in enumerate(frames):
+            for y in range(h):
+                System.arraycopy(pixels, (y0 + y) * self.width + x0, block, (i * ch + y) * cw, w)
+        folder = os.path.join(self.path, str(t_block), str(cy))
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass  # created by another chunk of the block
+        with open(os.path.join(folder, str(cx)), 'wb') as out:
+            out.write(encode(block, self.bits))
+
+
+class OmeZarrWriter(object):
+
+    """ Append frames to a multi-resolution OME-Zarr movie
+    :param path: output folder (e.g. movie.zarr)
+    :param width, height, bits: frame size and bit depth
+    :param calibration: ij.measure.Calibration for the scales, or None
+    :param chunk_xy: chunk width and height
+    :param chunk_t: frames per chunk
+    :param min_size: levels are added until the frame fits in this size
+    :param workers: threads compressing chunks, 0 for one per core
+    """
+
+    def __init__(self, path, width, height, bits, calibration=None, chunk_xy=512, chunk_t=8,
+                 min_size=512, workers=0, name=None):
+
+        self.path = path
+        self.calibration = calibration
+        self.name = name or os.path.basename(path)
+        self.levels = []
+        w, h = width, height
+        while True:
+            self.levels.append(ZarrLevel(os.path.join(path, str(len(self.levels))), w, h, bits,
+                                         (chunk_t, chunk_xy, chunk_xy)))
+            if max(w, h) <= min_size or min(w, h) < 2:
+                break
+            w, h = max(w // 2, 1), max(h // 2, 1)
+        self.workers = workers or Runtime.getRuntime().availableProcessors()
+        self.pool = Executors.newFixedThreadPool(self.workers)
+        self.pending = []
+        write_json(os.path.join(path, ".zgroup"), {'zarr_format': 2})
+        self.write_metadata()
+
+    def write_metadata(self):
+
+        """ .zattrs multiscales and the .zarray of every level """
+
+        cal = self.calibration
+        unit = UNITS.get(cal.getUnit(), None) if cal is not None else None
+        time_unit = UNITS.get(cal.getTimeUnit(), None) if cal is not None else None
+        pw = cal.pixelWidth if cal is not None else 1.0
+        ph = cal.pixelHeight if cal is not None else 1.0
+        dt = cal.frameInterval if cal is not None and cal.frameInterval > 0 else 1.0
+
+        axes = [{'name': 't', 'type': 'time'}, {'name': 'y', 'type': 'space'}, {'name': 'x', 'type': 'space'}]
+        if time_unit:
+            axes[0]['unit'] = time_unit
+        if unit:
+            axes[1]['unit'] = axes[2]['unit'] = unit
+        datasets = []
+        for k, level in enumerate(self.levels):
+            fx = self.levels[0].width / float(level.width)
+            fy = self.levels[0].height / float(level.height)
+            datasets.append({'path': str(k),
+                             'coordinateTransformations': [{'type': 'scale', 'scale': [dt, ph * fy, pw * fx]}]})
+            level.write_zarray()
+        write_json(os.path.join(self.path, ".zattrs"),
+                   {'multiscales': [{'version': '0.4', 'name': self.name, 'axes': axes, 'datasets': datasets}]})
+
+    def submit(self, tasks):
+
+        """ Queue chunk tasks, keeping at most two blocks per worker in flight """
+
+        self.pending += [self.pool.submit(t) for t in tasks]
+        while len(self.pending) > 2 * self.workers:
+            self.pending.pop(0).get()
+
+    def add_frame(self, ip):
+
+        """ Append a frame (ImageProcessor) to every level """
+
+        for k, level in enumerate(self.levels):
+            if k > 0:
+                ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+                ip = ip.resize(level.width, level.height, True)
+            self.submit(level.add(ip))
+
+    def add_stack(self, stack):
+
+        """ Append every plane of an ImageStack as frames """
+
+        for i in range(stack.getSize()):
+            self.add_frame(stack.getProcessor(i + 1))
+
+    def close(self):
+
+        """ Write the last partial blocks, wait for all chunks, write the metadata """
+
+        try:
+            for level in self.levels:
+                self.submit(level.flush())
+            while self.pending:
+                self.pending.pop(0).get()
+        finally:
+            self.pool.shutdown()
+        self.write_metadata()
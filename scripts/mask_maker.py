@@ -1,37 +1,67 @@
 """ This script is used to clean the image for the segmentation.
     It should help to sharpen the image and remove the background for the segmentation and further tracking"""
 
-from ij import IJ
-from ij.plugin import ZProjector, ImageCalculator
+#@ Integer(label="Tile size (0 = whole planes)", value=4096) tile_size
+#@ Integer(label="Worker threads (0 = all cores)", value=0) workers
+
+from ij import IJ, ImagePlus
+from ij.plugin import ZProjector, ImageCalculator, ContrastEnhancer
+from ij.plugin.filter import BackgroundSubtracter, RankFilters, GaussianBlur
+from fiji.threshold import Auto_Local_Threshold as ALT
+from ij_utils.tiling import TileExecutor, rolling_ball_halo, rank_halo, gaussian_halo, local_threshold_halo
 imp = IJ.getImage()
 
-def clean_image(imp):
-    
-    """"Clean the image for the segmentation."""
+
+def subtract_background(ip, radius):
+
+    """ Subtract Background... rolling=radius on a processor """
+
+    BackgroundSubtracter().rollingBallBackground(ip, radius, False, False, False, True, True)
+
+
+def clean_image(imp, executor):
+
+    """"Clean the image for the segmentation.
+    The neighbourhood filters run tile by tile on the executor, the steps
+    that need whole planes (contrast, projection, erosion) on the result.
+    """
 
     # Create duplicates
     IJ.run(imp, "Select None", "")
-    img = imp.duplicate()
-    img2 = imp.duplicate()
+    stack = imp.getStack()
 
     # Clear image for Zproj
-    IJ.run(img, "Subtract...", "value=2000 stack")
-    IJ.run(img, "Subtract Background...", "rolling=12.5 stack")
-    IJ.run(img, "Despeckle", "stack")
-    IJ.run(img, "Enhance Contrast", "saturated=0.35")
+    def clear(ip):
+        ip.subtract(2000)
+        subtract_background(ip, 12.5)
+        RankFilters().rank(ip, 1, RankFilters.MEDIAN)  # Despeckle
+    img = ImagePlus(imp.getTitle(), executor.map_to_stack(stack, clear, rolling_ball_halo(12.5) + rank_halo(1)))
+    img.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+    ContrastEnhancer().stretchHistogram(img, 0.35)
     IJ.run(img, "8-bit", "")
 
     # Zproj and binary
-    img_Zave = ZProjector.run(img,"avg")
-    IJ.run(img_Zave, "Auto Local Threshold", "method=Phansalkar radius=0.7 parameter_1=0.2 parameter_2=0.1 white stack")
-    IJ.run(img, "Remove Outliers...", "radius=5 threshold=50 which=Bright stack")
+    img_Zave = ZProjector.run(img, "avg")
+    img.close()
+    # Auto Local Threshold only takes 8-bit images
+    img_Zave = ImagePlus(img_Zave.getTitle(), img_Zave.getProcessor().convertToByteProcessor(False))
+
+    def local_threshold(ip):
+        tile = ImagePlus("tile", ip)
+        ALT().exec(tile, "Phansalkar", 0, 0.2, 0.1, True)  # radius=0.7 is truncated to 0
+        return tile.getProcessor()
+    img_Zave.setProcessor(executor.map(img_Zave.getProcessor(), local_threshold, local_threshold_halo(0.7)))
     IJ.run(img_Zave, "Erode", "")
     ip_Zave = img_Zave.getProcessor()
     ip_Zave.add(-254)
 
     # Clear image 2
-    IJ.run(img2, "Subtract Background...", "rolling=12.5 stack")
-    IJ.run(img2, "Gaussian Blur...", "sigma=2 stack")
+    def blur(ip):
+        subtract_background(ip, 12.5)
+        GaussianBlur().blurGaussian(ip, 2, 2, 0.0002)
+    img2 = ImagePlus(imp.getTitle(), executor.map_to_stack(stack, blur, rolling_ball_halo(12.5) + gaussian_halo(2)))
+    img2.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+    img2.setCalibration(imp.getCalibration().copy())
     ImageCalculator().run( "Multiply  stack", img2, img_Zave)
 
     # Title and show
@@ -41,5 +71,5 @@ def clean_image(imp):
     img2.show()
 
     return True
-      
-clean_image(imp)
+
+clean_image(imp, TileExecutor(tile_size=tile_size, workers=workers))
@@ -3,9 +3,17 @@
 #@ File(label="Input directory", description="Select the directory with input images", style="directory") inputDir
 #@ File(label="Output directory", description="Select the output directory", style="directory") outputFolder
 #@ File(label="Weka model", description="Select the Weka model to apply") modelPath
+#@ Integer(label="Prefetch memory budget (MB)", value=4096) prefetch_mb
+#@ Boolean(label="Write timing profiles", value=false) profile_run
+#@ String(label="Results", choices={"Experiment dataset", "Text file per image", "Both"}, value="Experiment dataset") results_format
+#@ Integer(label="Classification tile size (0 = whole image)", value=1024) weka_tile
+#@ Integer(label="Probability threshold (0-255)", value=130) prob_threshold
 
 # Load libraries
 
+import Queue
+import threading
+from java.awt import GraphicsEnvironment
 from loci.plugins import BF
 from ij import IJ
 from ij.plugin import Duplicator, ZProjector, ImageCalculator
@@ -13,25 +21,107 @@ from ij import ImagePlus, IJ, io, plugin, ImageStack, WindowManager as WM
 from trainableSegmentation import WekaSegmentation
 from ij.gui import WaitForUserDialog
 from ij.plugin.frame import RoiManager
+from ij.plugin.filter import ParticleAnalyzer
 from ij.measure import ResultsTable
 from ij.io import FileSaver 
+from ij_utils.prefetch import Prefetcher, AsyncWriter, file_size
+from ij_utils.profiler import Profiler
+from ij_utils.results_sink import ResultsSink, dataset_path, multi_measure_columns
+from ij_utils import warm_cache
+from ij_utils.tiling import TileExecutor, weka_halo
 
 # Load variables
 
+def load_weka(path):
+
+    """ Weka segmentation with a trained classifier """
+
+    weka = WekaSegmentation()
+    weka.loadClassifier(path)
+    return weka
+
+def probability_mask(fp):
+
+    """ Binary mask of a probability map, the same for tiles and whole images:
+    probabilities scaled to 0-255 (not to the display range) and thresholded
+    :return: ByteProcessor, 255 where the probability is above prob_threshold
+    """
+
+    fp = fp.duplicate()
+    fp.multiply(255.0)
+    bp = fp.convertToByteProcessor(False)
+    bp.threshold(prob_threshold)
+    return bp
+
+def classify_tiled(imp, executor):
+
+    """ Binary mask of the first class, classified tile by tile
+    Each tile gets a halo as wide as the largest feature filter; its
+    probabilities are thresholded before the next tile, so no whole-image
+    feature stack or float map is kept. WekaSegmentation is not thread-safe:
+    every tile borrows a classifier no other tile is using.
+    :return: ByteProcessor, 255 where the probability is above prob_threshold
+    """
+
+    def classify(tile):
+        try:
+            segmentation = classifiers.get_nowait()
+        except Queue.Empty:
+            # one more copy of the model, kept for the next tiles and, in the
+            # warm cache, for the next runs
+            with copies_lock:
+                copies[0] += 1
+                n = copies[0]
+            segmentation = warm_cache.load(modelPath.getCanonicalPath(), load_weka, copy=n)
+        try:
+            probabilities = segmentation.applyClassifier(ImagePlus("tile", tile), 1, True)
+        finally:
+            classifiers.put(segmentation)
+        return probability_mask(probabilities.getStack().getProcessor(1))
+
+    return executor.map(imp.getProcessor(), classify, weka_halo(weka))
+
 listOfFiles = inputDir.listFiles()
-weka = WekaSegmentation()
-weka.loadClassifier( modelPath.getCanonicalPath() )
+# Loaded once per session (or warm worker) while the model file is unchanged
+weka = warm_cache.load(modelPath.getCanonicalPath(), load_weka)
+# Classifiers not in use by a tile thread, copies added as threads need them
+classifiers = Queue.Queue()
+classifiers.put(weka)
+copies = [0]  # copies of the model taken from the cache by this run
+copies_lock = threading.Lock()
+executor = TileExecutor(tile_size=weka_tile)
+if GraphicsEnvironment.isHeadless():
+    # no manager window in a headless worker: a hidden one
+    rm = RoiManager(True)
+else:
+    rm = RoiManager.getRoiManager()
+profiler = Profiler(enabled=profile_run)
+# All the tables of the input folder go to one dataset
+sink = None
+if results_format != "Text file per image":
+    sink = ResultsSink(dataset_path(outputFolder.getPath(), inputDir.getName()))
+
+def open_file(f):
+
+    """ Open all the series of a file, used by the prefetcher """
+
+    with profiler.movie(f.getName()).stage("open"):
+        return BF.openImagePlus(f.getCanonicalPath())
 
-for i in range(0, len(listOfFiles)):  # Loop over files
+# Open the next file while the current one is classified, save in the background
+loader = Prefetcher(listOfFiles, open_file, size_of=file_size, budget_mb=prefetch_mb)
+writer = AsyncWriter(budget_mb=prefetch_mb / 4)
 
-    files = listOfFiles[i].getCanonicalPath()
-    imps = BF.openImagePlus(files) # Open images
-    print(listOfFiles[i].getName()) # indicate current image in analysis
+for file_i, imps in loader:  # Loop over files
 
-    for image in imps:
+    print(file_i.getName()) # indicate current image in analysis
+    mp = profiler.movie(file_i.getName())
+
+    for series, image in enumerate(imps):
     
-        IJ.run(image, "Subtract Background...", "rolling=15 stack") # Remove background
-        IJ.run(image, "Align HyperStack", "max=50")
+        with mp.stage("background", frames=image.getNFrames()):
+            IJ.run(image, "Subtract Background...", "rolling=15 stack") # Remove background
+            IJ.run(image, "Align HyperStack", "max=50")
         inputStack = image.getImageStack() 
         dupStack = inputStack.duplicate()
         
@@ -58,15 +148,16 @@ for i in range(0, len(listOfFiles)):  # Loop over files
         # Combine images in one for classification
         
         impout = ImageCalculator().run("Add create", impout, edges)
-        result = weka.applyClassifier( impout, 0, True)
-        result = result.getProcessor().duplicate()
-        result = ImagePlus("Bacteria_Prob_map", result)
+        if weka_tile > 0:
+            # Features, probabilities and threshold tile by tile on all cores
+            with mp.stage("classify"):
+                result = ImagePlus("Bacteria_Prob_map", classify_tiled(impout, executor))
+        else:
+            with mp.stage("classify"):
+                result = weka.applyClassifier( impout, 0, True)
+            # Transform in binary, as the tiles are
 
-        # Transform in binary
-        
-        IJ.run(result, "8-bit", "")
-        result.getProcessor().threshold(130)
-        result.updateAndDraw()
+            result = ImagePlus("Bacteria_Prob_map", probability_mask(result.getProcessor()))
         
         project.setImage(dupStack)
         project.doProjection()
@@ -78,23 +169,24 @@ for i in range(0, len(listOfFiles)):  # Loop over files
         impout.show()
         result.show()
         IJ.run(result, "Invert", "")
-        IJ.run(result, "Analyze Particles...", "size=1.50-5.00 circularity=0.40-0.90 
-        myWait = WaitForUserDialog ("Select ROIS", "Click Ok when all ROIS are selected")
-        myWait.show()
+        ParticleAnalyzer.setRoiManager(rm)  # only for the next analysis
+        IJ.run(result, "Analyze Particles...", "size=1.50-5.00 circularity=0.40-0.90 show=Nothing add")
+        if not GraphicsEnvironment.isHeadless():
+            myWait = WaitForUserDialog ("Select ROIS", "Click Ok when all ROIS are selected")
+            myWait.show()
 
         # Measure ROIs
         
-        rm = RoiManager.getInstance()
         rt = ResultsTable.getResultsTable()
         IJ.run("Clear Results", "")
-        rm = RoiManager.getInstance()
-        rt = rm.multiMeasure(image)
+        with mp.stage("measure", rois=rm.getCount()):
+            rt = rm.multiMeasure(image)
         
         # Generate mask with measured cells
         IJ.run(result, "Invert", "")
         ip = result.getProcessor()
         index = 0
-        for roi in RoiManager.getInstance().getRoisAsArray():
+        for roi in rm.getRoisAsArray():
                 index = index + 1
                 ip.setRoi(roi)  
                 ip.setColor(index)
@@ -106,11 +198,24 @@ for i in range(0, len(listOfFiles)):  # Loop over files
         result.show()
 
         # Save results
-        outputFileName = "Mask_" + listOfFiles[ i ].getName() + ".tif"  
-        FileSaver(result).saveAsTiff(outputFolder.getPath() + "/"+ outputFileName)
+        # (a copy is saved, "Close All" below may flush the displayed one first)
+        outputFileName = "Mask_" + file_i.getName() + ".tif"  
+        mask_copy = result.duplicate()
+        writer.submit(mp.wrap("save", FileSaver(mask_copy).saveAsTiff), outputFolder.getPath() + "/"+ outputFileName,
+                      size=mask_copy.getSizeInBytes())
         
-        outputFileName = listOfFiles[ i ].getName() + ".txt"
-        rt.saveAs(outputFolder.getPath() + "/"+ outputFileName)
+        if sink is not None:
+            # one row per frame and ROI, tagged with the file and series
+            writer.submit(mp.wrap("save", sink.append), file_i.getCanonicalPath() + "#" + str(series),
+                          multi_measure_columns(rt),
+                          {'FILE': file_i.getName(), 'SERIES': series, 'EXPERIMENT': inputDir.getName()})
+        if results_format != "Experiment dataset":
+            outputFileName = file_i.getName() + ".txt"
+            writer.submit(mp.wrap("save", rt.saveAs), outputFolder.getPath() + "/"+ outputFileName)
         # Clean up!
-        del index, impout, dupStack, edges, imps, result, rm, rt, roi
+        rm.reset()
+        del index, impout, dupStack, edges, imps, result, rt, roi
         IJ.run(image, "Close All", "")
+
+writer.close()
+profiler.write(outputFolder.getPath())
@@ -3,111 +3,121 @@
 #@ File(label="Input directory", description="Select the directory with input images", style="directory") inputDir
 #@ File(label="Output directory", description="Select the output directory", style="directory") outputFolder
 #@ File(label="LUT", description="Select the LUT for the image", style="file") LUTpath
+#@ Integer(label="Prefetch memory budget (MB)", value=4096) prefetch_mb
+#@ Boolean(label="Write timing profiles", value=false) profile_run
+#@ File(label="Shared queue folder (optional, several workers)", style="directory", required=false) queueDir
+#@ String(label="Results", choices={"Experiment dataset", "CSV per image", "Both"}, value="Experiment dataset") results_format
+#@ String(label="Pairing suffixes", value="mask=_MASK,MASK") pairing
+#@ Boolean(label="Include subfolders", value=false) recursive
 
 # Load libraries
 
 import os
+from java.awt import GraphicsEnvironment
 from ij import IJ
-from ij.plugin import , LutLoader
 from ij import IJ, WindowManager as WM
 from ij.gui import WaitForUserDialog
 from ij.plugin.frame import RoiManager
+from ij.plugin.filter import ParticleAnalyzer
 from ij.measure import ResultsTable
+from ij_utils.prefetch import Prefetcher, AsyncWriter, file_size
+from ij_utils.profiler import Profiler
+from ij_utils import luts
+from ij_utils.manifest import RunManifest, atomic_save
+from ij_utils.work_queue import WorkQueue
+from ij_utils.results_sink import ResultsSink, dataset_path, multi_measure_columns
+from ij_utils.dataset_index import DatasetIndex, PairingRules, INDEX_NAME
+
+profiler = Profiler(enabled=profile_run)
 
 
 def lut_change(imp, LUTpath):
     
-    """ Change LUT of image"""
+    """ Change LUT of image, once per channel"""
     
-    # Get image info and LUT 
-    lut = LutLoader.openLut(LUTpath.getCanonicalPath())
-    nslices = imp.getStackSize()
-    nCh = imp.getDimensions()[2]
-    
-    if nCh == 1:
-        # Iterate through slices
-        for i in range(nslices):
-            imp.setSlice(i + 1)
-            imp.setLut(lut)
-
-    else:
-        for i in range(nslices):
-            # Iterate through slices
-            for ch in range(nCh):
-            # Iterate through channels
-                imp.setSlice(i + 1)
-                imp.setChannelLut(lut, ch + 1)
+    luts.apply_lut(imp, luts.load_lut(LUTpath))
     
     return 0
 
-def grep_file_filter(filesFolder, grep):
-
-    """ Filter mask and files from the source folder
-    :param filesFolder: Folder with files
-    :param grep: String to grep"""
-
-    files_mask, files_raw = [], []
-    for i in filesFolder.listFiles():
-            
-        if ".tif" in i.getName():
-         
-            if grep in i.getName():
+def open_pair(pair):
+    
+    """ Open image and mask, used by the prefetcher
+    :param pair: (image file, mask file)
+    :return: (image, mask) ImagePlus"""
 
-                files_mask.append(i)
-            else:
-                files_raw.append(i)
-    return files_raw, files_mask
+    image_file, mask_file = pair
+    with profiler.movie(image_file.getName()[:-4]).stage("open") as stage:
+        imp = IJ.openImage(image_file.getCanonicalPath())
+        ref_image = IJ.openImage(mask_file.getCanonicalPath())
+        stage.count(frames=imp.getNFrames())
+    return imp, ref_image
 
-def analyse_movie(image_file, mask_file, rm, outputFolder):
+def analyse_movie(image_file, imp, ref_image, rm, outputFolder, writer, save_output=atomic_save, save_rows=None):
     
     """ Analyse movie
     :param image_file: Image file
-    :param mask_file: Mask file
+    :param imp: Opened image
+    :param ref_image: Opened mask
     :param rm: Roi manager
     :param outputFolder: Output folder
+    :param writer: AsyncWriter saving the results
+    :param save_output: function(save, path) writing and recording an output
+    :param save_rows: function(columns, tags) appending the table to the
+                      experiment dataset, None to skip it
     """
-
-    # Open image and ref.
-    ref_image = IJ.openImage(mask_file.getCanonicalPath())
-    imp = IJ.openImage(image_file.getCanonicalPath())
-    
-    # Prepare image
-    lut_change(imp, LUTpath)
-    IJ.run("Set Measurements...", "area mean median standard min centroid stack redirect=None decimal=3")
-    IJ.run("Collect Garbage", "")
-    IJ.run("Clear Results", "")
-    IJ.run(imp, "Subtract Background...", "rolling=15 stack") 
     
-    # Generate ROIs
-    
-    IJ.setThreshold(ref_image, 2, 65535)
-    ref_image.createThresholdMask()
-    IJ.run(ref_image, "Analyze Particles...", "size=0.5-Infinity circularity=0.10-0.95 add")
-    ref_image.close()
-    
-    
-    # Measure ROIs
-    rt = ResultsTable.getResultsTable()
-    IJ.run("Clear Results", "")
-    #ref_image.show()
-    imp.show()
-    rm.runCommand(imp,"Show All")
-    rm.runCommand(imp,"Deselect")
-    myWait = WaitForUserDialog ("Are ROIs Ok?", "Add or remove ROIs")
-    myWait. show()
-    rm.getRoisAsArray()
-    rt = rm.multiMeasure(imp)
+    mp = profiler.movie(image_file.getName()[:-4])
+
+    try:
+        # Prepare image
+        lut_change(imp, LUTpath)
+        IJ.run("Set Measurements...", "area mean median standard min centroid stack redirect=None decimal=3")
+        IJ.run("Collect Garbage", "")
+        IJ.run("Clear Results", "")
+        with mp.stage("background", frames=imp.getNFrames()):
+            IJ.run(imp, "Subtract Background...", "rolling=15 stack") 
+    
+        # Generate ROIs
+    
+        with mp.stage("detect") as stage:
+            IJ.setThreshold(ref_image, 2, 65535)
+            ref_image.createThresholdMask()
+            # only for the next analysis: the manager may be a hidden one
+            ParticleAnalyzer.setRoiManager(rm)
+            IJ.run(ref_image, "Analyze Particles...", "size=0.5-Infinity circularity=0.10-0.95 add")
+            stage.count(rois=rm.getCount())
+        ref_image.close()
+    
+    
+        # Measure ROIs
+        rt = ResultsTable.getResultsTable()
+        IJ.run("Clear Results", "")
+        #ref_image.show()
+        imp.show()
+        rm.runCommand(imp,"Show All")
+        rm.runCommand(imp,"Deselect")
+        if not GraphicsEnvironment.isHeadless():  # headless queue workers keep the detected ROIs
+            with mp.stage("review"):
+                myWait = WaitForUserDialog ("Are ROIs Ok?", "Add or remove ROIs")
+                myWait. show()
+        rm.getRoisAsArray()
+        with mp.stage("measure", rois=rm.getCount(), frames=imp.getNFrames()):
+            rt = rm.multiMeasure(imp)
         
-    # Export data
-    outputFileName = image_file.getName().replace(".tif", ".csv")
-    rt.saveAs(outputFolder.getPath() + "/"+ outputFileName)
-       
-       # Clean up!
-    rm.runCommand(imp,"Deselect")
-    rm.runCommand(imp,"Delete")
-    IJ.run(imp, "Close All", "")
-    imp.close()
-    del imp, ref_image, rt
+        # Export data
+        if save_rows is not None:
+            # one row per frame and ROI, tagged with the file
+            writer.submit(mp.wrap("save", save_rows), multi_measure_columns(rt), {'FILE': image_file.getName()})
+        if results_format != "Experiment dataset":
+            outputFileName = image_file.getName().replace(".tif", ".csv")
+            writer.submit(mp.wrap("save", save_output), rt.saveAs, outputFolder.getPath() + "/"+ outputFileName)
+    finally:
+        # Clean up, after a failure too: the next movie starts without these ROIs
+        rm.reset()
+        ref_image.close()
+        IJ.run(imp, "Close All", "")
+        imp.changes = False
+        imp.close()
     
     return 0
     
@@ -115,19 +125,91 @@ def analyse_movie(image_file, mask_file, rm, outputFolder):
     # Loop over images
     #----------------------------
 
+def append_rows(sink, manifest, key, columns, tags):
+
+    """ Append the table of an input to the dataset, a failure marks the input failed """
+
+    try:
+        sink.append(key, columns, tags)
+    except Exception, e:
+        manifest.add_error(key, e)
+        raise
+
 def file_iterator(inputDir, outputFolder):
     
     """ Iterate over files in a folder"""
 
-    files_raw, files_mask = grep_file_filter(inputDir, grep = "MASK")
+    # Images and masks paired by name, the folder listings cached in the output folder
+    index = DatasetIndex(inputDir.getPath(), PairingRules.parse(pairing),
+                         os.path.join(outputFolder.getPath(), INDEX_NAME), recursive=recursive)
+    all_pairs = index.pairs('mask')
+    IJ.log(index.summary())
     
-    rm = RoiManager.getInstance()
-    
-    for image_i, mask_i in zip(files_raw, files_mask):
-        IJ.log("# ----------------")
-        IJ.log(image_i.getName())
-        analyse_movie(image_i, mask_i, rm, outputFolder)
-        IJ.log("# ----------------")
+    if GraphicsEnvironment.isHeadless():
+        # no manager window in a headless worker: a hidden one
+        rm = RoiManager(True)
+    else:
+        rm = RoiManager.getRoiManager()
+
+    # All the tables of the input folder go to one dataset
+    sink = None
+    if results_format != "CSV per image":
+        sink = ResultsSink(dataset_path(outputFolder.getPath(), inputDir.getName()))
+        in_dataset = sink.keys()
+
+    # Skip the pairs already measured with the same files and LUT
+    params = {'lut': LUTpath.getCanonicalPath(), 'results': results_format}
+    manifest = RunManifest(outputFolder.getPath(), params)
+    skipped = []
+    pairs = manifest.pending(all_pairs, skipped,
+                             redo=lambda pair: sink is not None and pair[0].getCanonicalPath() not in in_dataset)
+
+    # With a queue folder, every worker running this script claims pairs
+    # from the shared queue and keeps its own manifest and profile
+    queue, items, profile_prefix = None, pairs, "profile"
+    if queueDir is not None:
+        pairs = items = list(pairs)
+        queue = WorkQueue(queueDir.getPath(), params)
+        manifest = RunManifest(outputFolder.getPath(), params, name=queue.worker_name("run_manifest", ".json"))
+        items = queue.claimed(pairs, key=lambda pair: pair[0].getCanonicalPath())
+        profile_prefix = queue.worker_name("profile", "")
+
+    # Open the next pair while the current one is measured
+    loader = Prefetcher(items, open_pair, size_of=lambda pair: file_size(*pair), budget_mb=prefetch_mb)
+    writer = AsyncWriter(budget_mb=prefetch_mb / 4)
+    try:
+        for (image_i, mask_i), (imp, ref_image) in loader:
+            IJ.log("# ----------------")
+            IJ.log(image_i.getName())
+            key = image_i.getCanonicalPath()
+            manifest.start(key, mask_i.getCanonicalPath())
+            save_output = lambda save, path, key=key: manifest.save_output(key, save, path)
+            save_rows = None
+            if sink is not None:
+                save_rows = lambda columns, tags, key=key: append_rows(sink, manifest, key, columns,
+                                                                       dict(tags, EXPERIMENT=inputDir.getName()))
+            try:
+                analyse_movie(image_i, imp, ref_image, rm, outputFolder, writer, save_output, save_rows)
+            except Exception, e:
+                manifest.finish(key, 'failed', e)
+                if queue is not None:
+                    queue.fail(key, e)
+                IJ.log("Failed: " + str(e))
+                continue
+            # marked done once its results are written
+            writer.submit(manifest.finish, key)
+            if queue is not None:
+                writer.submit(queue.complete, key)
+            IJ.log("# ----------------")
+    finally:
+        writer.close()
+        IJ.log(str(len(skipped)) + " images were already measured")
+        profiler.write(outputFolder.getPath(), prefix=profile_prefix)
+        if queue is not None:
+            queue.close()
+            # the last worker to finish combines the manifests and profiles
+            if queue.finished([pair[0].getCanonicalPath() for pair in pairs]):
+                queue.merge(outputFolder.getPath())
     
     return True
 
@@ -8,15 +8,34 @@
 #@ File(label="LUT", description="Select the LUT for the image", style="file") LUTpath
 #@ Integer(label="Crop width", value=17) crop_width
 #@ Integer(label="Crop height", value=37) crop_height
+#@ String(label="Tracker", choices={"LoG + LAP", "Mask overlap"}, value="LoG + LAP") tracker
+#@ String(label="Crop size", choices={"Fixed", "Spot radius", "Mask bounding box"}, value="Fixed") crop_sizing
+#@ String(label="Crop output", choices={"One file per track", "Single stack", "Chunked stacks"}, value="One file per track") crop_output
+#@ Integer(label="Tracks per chunk", value=100) chunk_size
+#@ Integer(label="Prefetch memory budget (MB)", value=4096) prefetch_mb
+#@ Boolean(label="Write timing profiles", value=false) profile_run
+#@ String(label="Log level", choices={"INFO", "DEBUG", "WARNING"}, value="INFO") log_level
+#@ File(label="Shared queue folder (optional, several workers)", style="directory", required=false) queueDir
+#@ String(label="Track review", choices={"Outliers only", "Every movie", "None"}, value="Outliers only") track_review
+#@ File(label="QC bounds (optional JSON)", style="file", required=false) qc_bounds_file
+#@ String(label="Pairing suffixes", value="mask=_MASK") pairing
+#@ Boolean(label="Include subfolders", value=false) recursive
+#@ String(label="Profiles and kymographs", choices={"None", "Long axis", "Short axis"}, value="None") profile_axis
+#@ Integer(label="Profile length (px)", value=37) profile_length
+#@ Integer(label="Profile width (px)", value=3) profile_width
+#@ String(label="Track on", choices={"All frames", "Stride", "Mean bin", "Max bin"}, value="All frames") temporal_mode
+#@ Integer(label="Frames per tracked frame", value=1) temporal_factor
+#@ String(label="Compartments", choices={"None", "Mask channel 3", "Rim"}, value="None") compartment_mode
+#@ Integer(label="Rim width (px)", value=2) compartment_rim
 
 import sys
 import csv
 import os
-from ij import IJ, ImagePlus
+from java.awt import GraphicsEnvironment
+from ij import IJ, ImagePlus, ImageStack
 from ij.plugin import ChannelSplitter, RGBStackMerge
 from ij.io import FileSaver
 from ij.gui import WaitForUserDialog, GenericDialog, NonBlockingGenericDialog
-from ij.plugin import LutLoader
 from fiji.plugin.trackmate import Model
 from fiji.plugin.trackmate import Settings
 from fiji.plugin.trackmate import TrackMate
@@ -36,83 +55,60 @@ import fiji.plugin.trackmate.features.FeatureFilter as FeatureFilter
 import fiji.plugin.trackmate.gui.displaysettings.DisplaySettingsIO as DisplaySettingsIO
 from fiji.plugin.trackmate.gui.displaysettings.DisplaySettings import TrackMateObject
 from fiji.plugin.trackmate.gui.displaysettings.DisplaySettings import TrackDisplayMode
-
-
-def grep_file_filter(filesFolder, grep):
-
-    """ Filter mask and files from the source folder
-    :param filesFolder: source folder
-    :param grep: string to grep in the file name
-    :return: list of files and list of masks"""
-
-    files_mask, files_raw = [], []
-    for i in filesFolder.listFiles():
-            
-        if ".tif" in i.getName():
-         
-            if grep in i.getName():
-
-                files_mask.append(i)
-            else:
-                files_raw.append(i)
-    return files_raw, files_mask
-
-def create_crop_for_a_track(imp, model, tid, w, h, lut):
-
-    """ Create a crop hyperstack from the cource image and the tracking model
+from ij_utils.spot_table import SpotTable
+from ij_utils.overlap_tracker import MaskOverlapTracking, TRACKER_OVERLAP, dialog_overlap
+from ij_utils import crops, luts, profiles, temporal
+from ij_utils.compartments import CompartmentTable, MODE_NONE as COMPARTMENTS_NONE
+from ij_utils.prefetch import Prefetcher, AsyncWriter, file_size
+from ij_utils.mapped_tiff import open_mapped, mapped
+from ij_utils.profiler import Profiler
+from ij_utils.manifest import RunManifest, atomic_save, atomic_path, commit_path
+from ij_utils.work_queue import WorkQueue
+from ij_utils import track_qc
+from ij_utils.dataset_index import DatasetIndex, PairingRules, INDEX_NAME
+from ij_utils.buffered_log import BufferedLogger, DEBUG
+
+log = BufferedLogger(level=log_level)
+profiler = Profiler(enabled=profile_run)
+qc_bounds = track_qc.load_bounds(qc_bounds_file.getPath() if qc_bounds_file is not None else None)
+# Tracking parameters of the last movie, reused for the next ones
+tracking_params = {}
+
+
+def create_crop_for_a_track(imp, table, tid, w, h, lut):
+
+    """ Create a crop hyperstack from the cource image and the spot table
+    Boxes crossing the image border are zero padded, so the cell stays centred.
     :param imp: source image
-    :param model: tracking model
+    :param table: SpotTable built from the tracking model
     :param tid: track id
     :param w, h: width and height of the crop
     :param lut: LUT for the crop"""
     
-    track = model.getTrackModel().trackSpots(tid)
-    track_len = int(model.getFeatureModel().getTrackFeature(tid, 'TRACK_DURATION'))
-    n_channels = imp.getDimensions()[2]
-    n_slices = imp.getDimensions()[3]
-    n_frames = imp.getDimensions()[4]
-    crop = IJ.createImage("Celln", "16-bit grayscale-mode", w, h, n_channels, n_slices, n_frames)
-    
-    cal = imp.getCalibration()
-    crop.setCalibration(cal)
-    crop.setLut(lut)
-    #crop.show()
-    
-    # first time point of this track
-    pos_t0 = min([int(spot.getFeature('POSITION_T')) for spot in track])
-    for spot in track:
-        pos_x = int(spot.getFeature('POSITION_X') / cal.pixelWidth)
-        pos_y = int(spot.getFeature('POSITION_Y') / cal.pixelHeight)
-        pos_t = int(spot.getFeature('POSITION_T'))
-        frame = int(spot.getFeature('FRAME'))
-        IJ.log("FRAME:" + str(frame) + "/" + str(n_frames) + " (x:" +str(pos_x) + ",y:" + str(pos_y)+",t:"+ str(pos_t)+")")
-        copy_roi_allzc(imp, crop, pos_x, pos_y, frame, pos_t0, w, h)
+    crop = crops.new_crop_image(imp, w, h)
+
+    n = crops.fill_track_crop(imp, crop, table, tid, w, h)
+    log.debug("TRACK " + str(tid) + ": " + str(n) + " spots, first frame " + str(table.first_frame(tid)))
         
     return crop
-    
-def copy_roi_allzc(src, dst, x, y, t, t0, w, h):
-    
-    """ copy ZC planes from src to dst 
-    :param src: source image
-    :param dst: destination image
-    :param x, y, t: x, y, t coordinate of the ROI
-    :param t0: first time point of the track
-    :param w, h: width and height of the ROI
+
+def save_crop(crop, lut, oname, save_output=atomic_save, after=()):
+
+    """ Set the LUT and save a crop once
+    :param crop: crop image
+    :param lut: LUT for the crop
+    :param oname: output path
+    :param save_output: function(save, path) writing the file atomically
+    :param after: futures still reading the crop, waited for before it is closed
     """
-    
-    IJ.run("Select None")
-    nc = src.getNChannels()
-    nz = src.getNSlices()
-    for z in range(nz):
-        for c in range(nc):
-            src.setPosition(c+1, z+1, t + 1)
-            src.setRoi(x-w/2, y-h/2, w, h)
-            src.copy()
-            dst.setPosition(c+1, z+1, t + 1)
-            IJ.run("Select None")
-            dst.paste()
-            
-    IJ.run("Select None")
+
+    for future in after:
+        future.get()
+    lut_change(crop, lut)
+    log.info("Saving file " + oname)
+    save_output(FileSaver(crop).saveAsTiff, oname)
+    crop.changes = False
+    crop.close()
 
 def dialog_size_thr(title='Select images for processing', size = 1, thr = 10, df = 500, dist1 = 1, dist2 = 1):
 
@@ -140,12 +136,14 @@ def dialog_size_thr(title='Select images for processing', size = 1, thr = 10, df
 
     return [size, thr, duration, dist1, dist2]
 
-def dialog_TrackCheck(title='Repeat tracking analysis?'):
+def dialog_TrackCheck(title='Repeat tracking analysis?', message=None):
 
     """ Display a dialog for checking the cell tracks"""
 
     # Define dialog
     gd = NonBlockingGenericDialog(title)
+    if message:
+        gd.addMessage(message)
     gd.enableYesNoCancel("Repeat tracking", "No")
     gd.showDialog()
 
@@ -160,212 +158,411 @@ def dialog_TrackCheck(title='Repeat tracking analysis?'):
 
 def lut_change(imp, lut):
 
-    """ set LUT for improved visualisation 
+    """ set LUT for improved visualisation, once per channel
     :param imp: image to be processed
     :param lut: LUT for visualisation
     """
-    nslices = imp.getStackSize()
-    dimA = imp.getDimensions()
-    
-    for i in range(nslices):
-        # Iterate through slices
-        
-        if dimA[2] > 1:
-            for ch in range(dimA[2]):
-            
-            # Iterate through channels
-                imp.setSlice(i + 1)
-                imp.setChannelLut(lut, ch + 1)
-            else:
-                imp.getProcessor().setLut (lut)    
 
-def process_image(image, mask, lut, crop_width, crop_height):
+    luts.apply_lut(imp, lut)
+
+def open_pair(pair):
+
+    """ Open an image + mask pair, used by the prefetcher
+    :param pair: (image file, mask file)
+    :return: (image, mask) ImagePlus
+    """
+
+    image, mask = pair
+    with profiler.movie(image.getName()[:-4]).stage("open") as stage:
+        # The image is only read to be merged, so it is mapped instead of
+        # copied to the heap; its pages are loaded into the OS cache here
+        imp0 = open_mapped(image.getCanonicalPath())
+        if mapped(imp0) is not None:
+            mapped(imp0).load()
+        imp1 = IJ.openImage(mask.getCanonicalPath())
+        stage.count(frames=imp0.getNFrames())
+    return imp0, imp1
+
+def crop_tracks(Final, masks, table, experiment, lut, writer, mp, save_output=atomic_save):
+
+    """ Crop every track of the table and queue the crops for saving
+    :param Final: source image
+    :param masks: cell (channel 1) and inner (channel 2) masks without
+                  background subtraction, see mask_image
+    :param table: SpotTable of the filtered tracks
+    :param experiment: movie name, prefix of the output files
+    :param lut: LUT for the crops
+    :param writer: AsyncWriter saving the crops
+    :param mp: movie profile, the saves are timed as "save"
+    :param save_output: function(save, path) writing and recording an output
+    """
+
+    save = mp.wrap("save", lambda crop, lut, oname, after=(): save_crop(crop, lut, oname, save_output, after))
+    sizes = {}
+    for tid in table.track_ids():
+        sizes[tid] = crops.track_crop_size(table, tid, crop_sizing, crop_width, crop_height,
+                                           imp=masks, mask_channel=1)
+
+    # Profiles along the cell axis, sampled with the crops of each track
+    track_profiles = None
+    if profile_axis != profiles.AXIS_NONE:
+        track_profiles = profiles.TrackProfiles(Final, profile_axis, profile_length, profile_width,
+                                                mask_channel=1, mask_imp=masks)
+
+    # Compartments measured on the crops in memory, in parallel with the next crops
+    measures = None
+    if compartment_mode != COMPARTMENTS_NONE:
+        measures = CompartmentTable(compartment_mode, cell_channel=1, inner_channel=2, rim=compartment_rim)
+
+    if crop_output == crops.OUTPUT_PER_TRACK:
+        ndiv = 0
+        for tid in table.track_ids():
+
+            ndiv += 1
+            w, h = sizes[tid]
+            crop = create_crop_for_a_track(Final, table, tid, w, h, lut)
+            if track_profiles is not None:
+                track_profiles.add_track(table, tid)
+            after = []
+            if measures is not None:
+                mask_crop = crops.new_crop_image(masks, w, h)
+                crops.fill_track_crop(masks, mask_crop, table, tid, w, h)
+                after.append(measures.submit(crop, table, tid, nz=Final.getNSlices(), masks=mask_crop))
+            outputFileName = experiment + "_celln_" + str(tid) + "_path0" + str(ndiv) + ".tif"
+            writer.submit(save, crop, lut, str(os.path.join(outputFolder.getPath(), outputFileName)), after,
+                          size=crop.getSizeInBytes())
+    else:
+        # Several tracks per file, stacked along Z and padded to the largest box
+        n_per_file = len(sizes) if crop_output == crops.OUTPUT_STACK else chunk_size
+        index_path = os.path.join(outputFolder.getPath(), experiment + "_crops_index.csv")
+        with open(atomic_path(index_path), 'wb') as indexFile:
+            indexWriter = csv.writer(indexFile)
+            indexWriter.writerow(['FILE', 'TRACK_ID', 'TRACK_INDEX', 'WIDTH', 'HEIGHT', 'FIRST_FRAME', 'LAST_FRAME'])
+            for k, group in enumerate(crops.chunks(table.track_ids(), n_per_file)):
+                w = max([sizes[tid][0] for tid in group])
+                h = max([sizes[tid][1] for tid in group])
+                crop = crops.new_crop_image(Final, w, h, n_tracks=len(group))
+                outputFileName = experiment + "_crops_" + "%03d" % k + ".tif"
+                after = []
+                if measures is not None:
+                    mask_crop = crops.new_crop_image(masks, w, h, n_tracks=len(group))
+                for i, tid in enumerate(group):
+                    crops.fill_track_crop(Final, crop, table, tid, sizes[tid][0], sizes[tid][1],
+                                          track_index=i, label="track " + str(tid))
+                    if track_profiles is not None:
+                        track_profiles.add_track(table, tid)
+                    indexWriter.writerow([outputFileName, tid, i, sizes[tid][0], sizes[tid][1],
+                                          table.first_frame(tid), table.last_frame(tid)])
+                    if measures is not None:
+                        crops.fill_track_crop(masks, mask_crop, table, tid, sizes[tid][0], sizes[tid][1],
+                                              track_index=i)
+                        after.append(measures.submit(crop, table, tid, track_index=i, nz=Final.getNSlices(),
+                                                     masks=mask_crop))
+                writer.submit(save, crop, lut, str(os.path.join(outputFolder.getPath(), outputFileName)), after,
+                              size=crop.getSizeInBytes())
+        # committed after the last chunk is saved, so it never lists missing files
+        writer.submit(save_output, lambda tmp: None, index_path)
+
+    if measures is not None:
+        # queued after the crops, so every measurement is done when it is written
+        measures.shutdown()
+        writer.submit(mp.wrap("save", save_output), measures.write_csv,
+                      os.path.join(outputFolder.getPath(), experiment + "_compartments.csv"))
+
+    if track_profiles is not None:
+        # all tracks of the movie in one table and one kymograph stack
+        out = outputFolder.getPath()
+        writer.submit(mp.wrap("save", save_output), track_profiles.write_csv,
+                      os.path.join(out, experiment + "_profiles.csv"))
+        kymo = track_profiles.kymographs(experiment + "_kymographs")
+        if kymo is not None:
+            writer.submit(mp.wrap("save", save_output), FileSaver(kymo).saveAsTiff,
+                          os.path.join(out, experiment + "_kymographs.tif"), size=kymo.getSizeInBytes())
+
+
+def mask_image(c1, c2):
+
+    """ Both mask channels as one hyperstack sharing their planes (no copy),
+    for segmenting objects without the background subtraction of Final
+    :param c1: cell mask
+    :param c2: inner compartment mask
+    :return: ImagePlus, channel 1 from c1 and channel 2 from c2
+    """
+
+    nz, nt = c1.getNSlices(), c1.getNFrames()
+    stack = ImageStack(c1.getWidth(), c1.getHeight())
+    for t in range(1, nt + 1):
+        for z in range(1, nz + 1):
+            for mask in (c1, c2):
+                stack.addSlice(None, mask.getStack().getProcessor(mask.getStackIndex(1, z, t)))
+    masks = ImagePlus(c1.getTitle() + " (masks)", stack)
+    masks.setDimensions(2, nz, nt)
+    masks.setOpenAsHyperStack(True)
+    masks.setCalibration(c1.getCalibration().copy())
+    return masks
+
+
+def close_tracking(track_imp, track_mask, Final):
+
+    """ Close the reduced copies tracking ran on, if any """
+
+    if track_imp is not Final:
+        track_imp.changes = False
+        track_imp.close()
+        track_mask.close()
+
+
+def process_image(image, imp0, imp1, lut, crop_width, crop_height, writer, save_output=atomic_save, defer=False):
 
     """ Apply track and crop to a single image + mask 
-    :param image: image to be processed
-    :param mask: mask to be used for tracking
+    :param image: file of the image to be processed
+    :param imp0: opened image
+    :param imp1: opened mask to be used for tracking
     :param lut: LUT for visualisation
     :param crop_width: width of the crop
     :param crop_height: height of the crop
+    :param writer: AsyncWriter saving the crops
+    :param save_output: function(save, path) writing and recording an output
+    :param defer: raise track_qc.NeedsReview instead of showing an outlier run
     :return: True if successful
     """
 
-	# Load images
     experiment = image.getName()[:-4]
-    IJ.log("#--------------------- Start analysing movie: ")
-    IJ.log("\n original: " + experiment)
-
-    imp0 = IJ.openImage(image.getCanonicalPath())
-    imp1 = IJ.openImage(mask.getCanonicalPath())
+    mp = profiler.movie(experiment)
+    log.info("#--------------------- Start analysing movie: ")
+    log.info("\n original: " + experiment)
+    log.flush()
 
     #----------------------------
     # Image preparation
     #----------------------------
     
-    c1, c2, c3 = ChannelSplitter.split(imp1)
-    c3.close()
-    
-    IJ.run(c1, "16-bit", "")
-    IJ.run(c2, "16-bit", "")
-    imp_merger = RGBStackMerge()
-    Final = imp_merger.mergeChannels([imp0, c1, c2], True)
+    with mp.stage("prepare"):
+        c1, c2, c3 = ChannelSplitter.split(imp1)
+        c3.close()
+        imp1.close()
+        
+        IJ.run(c1, "16-bit", "")
+        IJ.run(c2, "16-bit", "")
+        imp_merger = RGBStackMerge()
+        Final = imp_merger.mergeChannels([imp0, c1, c2], True)
+    # c1 and c2 stay open: the overlap tracker and the crops (sizes, profiles,
+    # compartments) segment the masks before background subtraction
     n = Final.getNSlices()
 
-    # Transfer image calibration
+    track_imp, track_mask = Final, c1
+    try:
+        # Transfer image calibration
     
-    imp_cal = imp0.getCalibration().copy()
-    Final.setCalibration(imp_cal)
-
-    Final.setDisplayMode(IJ.GRAYSCALE)
-    IJ.run(Final, "Subtract Background...", "rolling=15 stack")
-    imp0.close()
-    Final.show()
-    lut_change(Final, lut)
-
-    #----------------------------
-    # Create the model object now
-    #----------------------------
-
-    # Some of the parameters we configure below need to have
-    # a reference to the model at creation. So we create an
-    # empty model now.
+        imp_cal = imp0.getCalibration().copy()
+        Final.setCalibration(imp_cal)
+
+        Final.setDisplayMode(IJ.GRAYSCALE)
+        with mp.stage("background", frames=Final.getNFrames()):
+            IJ.run(Final, "Subtract Background...", "rolling=15 stack")
+        imp0.close()
+        Final.show()
+        lut_change(Final, lut)
+
+        # Track on fewer frames; crops are still taken from every frame
+        if temporal.reduced(temporal_mode, temporal_factor):
+            with mp.stage("temporal", frames=Final.getNFrames()):
+                track_imp = temporal.reduce_frames(Final, temporal_factor, temporal_mode,
+                                                   title=Final.getTitle() + " (tracking)")
+                # a binned mask keeps every pixel covered in the bin
+                track_mask = temporal.reduce_frames(c1, temporal_factor,
+                                                    temporal.MODE_STRIDE if temporal_mode == temporal.MODE_STRIDE
+                                                    else temporal.MODE_MAX)
+            track_imp.show()
+            lut_change(track_imp, lut)
+            log.info(experiment + ": tracking on %d of %d frames (%s)" % (track_imp.getNFrames(), Final.getNFrames(),
+                                                                         temporal_mode))
+
+        #----------------------------
+        # Create the model object now
+        #----------------------------
+
+        # Some of the parameters we configure below need to have
+        # a reference to the model at creation. So we create an
+        # empty model now.
     
-    model = Model()
-
-    # Send all messages to ImageJ log window.
-    model.setLogger(Logger.IJ_LOGGER)
-    logger = Logger.IJ_LOGGER
-
-    #------------------------
-    # Prepare settings object
-    #------------------------
-
-    run_tracker = True
-    while run_tracker:
+        model = Model()
+
+        # Send all messages to ImageJ log window.
+        model.setLogger(Logger.IJ_LOGGER)
+        logger = Logger.IJ_LOGGER
+
+        #------------------------
+        # Prepare settings object
+        #------------------------
+
+        # Get cell size and pixel threshold, asked for the first movie, when
+        # reviewing every movie, and again when a run is repeated
+        cell_size = tracking_params.get('size', 1)
+        threshold = tracking_params.get('thr', 10)
+        duration = tracking_params.get('duration', Final.getStackSize()/(2 * Final.getNChannels() * Final.getNSlices()))
+        dist1 = tracking_params.get('dist1', 1)
+        dist2 = tracking_params.get('dist2', 1)
+        overlap = tracking_params.get('overlap', {})
+        ask = not tracking_params or track_review == track_qc.REVIEW_ALL
+
+        run_tracker = True
+        while run_tracker:
             
-        # Get cell size and pixel threshold
-        if 'cell_size' not in locals():
-            cell_size = 1 
-            threshold = 10
-            duration = Final.getStackSize()/(2 * Final.getNChannels() * Final.getNSlices())
-            dist1 = 1
-            dist2 = 1
-            
-        cell_size, threshold, duration, dist1, dist2 = dialog_size_thr(size = cell_size,
-        thr = threshold, 
-        df = duration, 
-        dist1 = dist1, 
-        dist2 = dist2)
-        settings = Settings(Final)
+            if ask and tracker == TRACKER_OVERLAP:
+                overlap = dialog_overlap(dict(overlap, duration=duration))
+                if overlap is None:
+                    sys.exit(0)
+                duration = overlap['duration']
+            elif ask:
+                cell_size, threshold, duration, dist1, dist2 = dialog_size_thr(size = cell_size,
+                thr = threshold, 
+                df = duration, 
+                dist1 = dist1, 
+                dist2 = dist2)
+            settings = Settings(track_imp)
     
-        # Configure detector - We use the Strings for the keys
+            if tracker != TRACKER_OVERLAP:
+
+                # Configure detector - We use the Strings for the keys
         
-        settings.detectorFactory = LogDetectorFactory()
-        settings.detectorSettings = { 
-            'DO_SUBPIXEL_LOCALIZATION' : True,
-            'RADIUS' : cell_size,
-            'TARGET_CHANNEL' : 2,
-            'THRESHOLD' : threshold,
-            'DO_MEDIAN_FILTERING' : True,
-            }  
+                settings.detectorFactory = LogDetectorFactory()
+                settings.detectorSettings = { 
+                    'DO_SUBPIXEL_LOCALIZATION' : True,
+                    'RADIUS' : cell_size,
+                    'TARGET_CHANNEL' : 2,
+                    'THRESHOLD' : threshold,
+                    'DO_MEDIAN_FILTERING' : True,
+                    }  
     
-        # Configure tracker - We want to allow merges and fusions
-
-        allow_cell_split = False
-        settings.trackerFactory = SparseLAPTrackerFactory()
-        settings.trackerSettings = LAPUtils.getDefaultLAPSettingsMap() # almost good enough
-        settings.trackerSettings['LINKING_MAX_DISTANCE'] = dist1
-        settings.trackerSettings['GAP_CLOSING_MAX_DISTANCE'] = dist2
-        settings.trackerSettings['MAX_FRAME_GAP'] = 5 #n_slices/10
-        settings.trackerSettings['ALLOW_TRACK_SPLITTING'] = allow_cell_split
-        settings.trackerSettings['ALLOW_TRACK_MERGING'] = False
-
-        if allow_cell_split:
-            settings.trackerSettings['SPLITTING_MAX_DISTANCE'] = 0.25
+                # Configure tracker - We want to allow merges and fusions
+
+                allow_cell_split = False
+                settings.trackerFactory = SparseLAPTrackerFactory()
+                settings.trackerSettings = LAPUtils.getDefaultLAPSettingsMap() # almost good enough
+                settings.trackerSettings['LINKING_MAX_DISTANCE'] = dist1
+                settings.trackerSettings['GAP_CLOSING_MAX_DISTANCE'] = dist2
+                settings.trackerSettings['MAX_FRAME_GAP'] = temporal.frame_gap(5, temporal_factor, temporal_mode) #n_slices/10
+                settings.trackerSettings['ALLOW_TRACK_SPLITTING'] = allow_cell_split
+                settings.trackerSettings['ALLOW_TRACK_MERGING'] = False
+
+                if allow_cell_split:
+                    settings.trackerSettings['SPLITTING_MAX_DISTANCE'] = 0.25
             
-        # Configure track analyzers - Later on we want to filter out tracks 
-        # based on their displacement, so we need to state that we want 
-        # track displacement to be calculated. By default, out of the GUI, 
-        # not features are calculated. 
+            # Configure track analyzers - Later on we want to filter out tracks 
+            # based on their displacement, so we need to state that we want 
+            # track displacement to be calculated. By default, out of the GUI, 
+            # not features are calculated. 
     
-        # The displacement feature is provided by the TrackDurationAnalyzer.
-        # Spot analyzer: we want the multi-C intensity analyzer.
-
-        spotIntensityAnalyzer = SpotIntensityMultiCAnalyzerFactory()
-        spotIntensityAnalyzer.setNChannels( Final.getNChannels() )
-        settings.addSpotAnalyzerFactory( spotIntensityAnalyzer )
-        settings.addTrackAnalyzer(TrackDurationAnalyzer())
-        settings.addTrackAnalyzer( TrackIndexAnalyzer() )
-        snrAnalyzer = SpotContrastAndSNRAnalyzerFactory()
-        snrAnalyzer.setNChannels( Final.getNChannels() )
-        settings.addSpotAnalyzerFactory( snrAnalyzer )
+            # The displacement feature is provided by the TrackDurationAnalyzer.
+            # Spot analyzer: we want the multi-C intensity analyzer.
+
+            spotIntensityAnalyzer = SpotIntensityMultiCAnalyzerFactory()
+            spotIntensityAnalyzer.setNChannels( track_imp.getNChannels() )
+            settings.addSpotAnalyzerFactory( spotIntensityAnalyzer )
+            settings.addTrackAnalyzer(TrackDurationAnalyzer())
+            settings.addTrackAnalyzer( TrackIndexAnalyzer() )
+            snrAnalyzer = SpotContrastAndSNRAnalyzerFactory()
+            snrAnalyzer.setNChannels( track_imp.getNChannels() )
+            settings.addSpotAnalyzerFactory( snrAnalyzer )
         
-        # Filter out short tracks
+            # Filter out short tracks
 
-        dur_filter = FeatureFilter('TRACK_DURATION', duration, True)
-        settings.addTrackFilter(dur_filter)
+            dur_filter = FeatureFilter('TRACK_DURATION', duration, True)
+            settings.addTrackFilter(dur_filter)
         
-        #-------------------
-        # Instantiate plugin
-        #-------------------
+            #-------------------
+            # Instantiate plugin
+            #-------------------
     
-        trackmate = TrackMate(model, settings)
+            if tracker == TRACKER_OVERLAP:
+                # Objects of the mask linked by overlap, no detection
+                trackmate = MaskOverlapTracking(model, settings, track_mask, 1, min_size=overlap['min_size'],
+                                                min_iou=overlap['min_iou'],
+                                                max_gap=temporal.frame_gap(overlap['max_gap'], temporal_factor,
+                                                                           temporal_mode))
+            else:
+                trackmate = TrackMate(model, settings)
 
         
-        #--------
-        # Process
-        #--------
+            #--------
+            # Process
+            #--------
     
-        ok = trackmate.checkInput()
-        if not ok:
-            sys.exit(str(trackmate.getErrorMessage()))
+            ok = trackmate.checkInput()
+            if not ok:
+                sys.exit(str(trackmate.getErrorMessage()))
         
-        ok = trackmate.process()
-        if not ok:
-            sys.exit(str(trackmate.getErrorMessage()))
+            with mp.stage("tracking") as stage:
+                ok = trackmate.process()
+                stage.count(spots=model.getSpots().getNSpots(True), tracks=model.getTrackModel().nTracks(True))
+            if not ok:
+                sys.exit(str(trackmate.getErrorMessage()))
         
-        #----------------
-        # Display results
-        #----------------
-
-        selectionModel = SelectionModel(model)
-        ds = DisplaySettingsIO.readUserDefault()
-        ds.setTrackColorBy(TrackMateObject.TRACKS, 'TRACK_DURATION' )
-        ds.setTrackDisplayMode(TrackDisplayMode.LOCAL_BACKWARD)
-        ds.setTrackMinMax(duration, n) 
-        ds.setFadeTrackRange(n)
+            #-----------------
+            # Quality control
+            #-----------------
+
+            # Pixel-space spot table, only filtered tracks
+            table = SpotTable.from_model(model, track_imp)
+            report = track_qc.assess(model, track_imp, duration, qc_bounds, table)
+            log.info(experiment + " tracking QC: " + report.summary())
+            log.flush()
+            if not ask and not track_qc.needs_review(track_review, report):
+                run_tracker = False
+                continue
+            if defer and not ask:
+                # reviewed after the movies that passed
+                raise track_qc.NeedsReview(report)
+
+            #----------------
+            # Display results
+            #----------------
+
+            selectionModel = SelectionModel(model)
+            ds = DisplaySettingsIO.readUserDefault()
+            ds.setTrackColorBy(TrackMateObject.TRACKS, 'TRACK_DURATION' )
+            ds.setTrackDisplayMode(TrackDisplayMode.LOCAL_BACKWARD)
+            ds.setTrackMinMax(duration, n) 
+            ds.setFadeTrackRange(n)
         
-        displayer =  HyperStackDisplayer(model, selectionModel, Final, ds)
-        displayer.render()
-        displayer.refresh()
-        trackIDs = model.getTrackModel().trackIDs(True)
-        t_analyzer = TrackDurationAnalyzer()
-        for tid in trackIDs:
-            dur = model.getFeatureModel().getTrackFeature( tid, TrackDurationAnalyzer.TRACK_DURATION )
-            IJ.log("TRACK_D: " + str(tid) + " TRACK_DURATION: " + str(dur))
+            displayer =  HyperStackDisplayer(model, selectionModel, track_imp, ds)
+            displayer.render()
+            displayer.refresh()
+            trackIDs = model.getTrackModel().trackIDs(True)
+            t_analyzer = TrackDurationAnalyzer()
+            for tid in trackIDs:
+                dur = model.getFeatureModel().getTrackFeature( tid, TrackDurationAnalyzer.TRACK_DURATION )
+                log.debug("TRACK_D: " + str(tid) + " TRACK_DURATION: " + str(dur))
+            log.flush()
                 
-        run_tracker = dialog_TrackCheck()
-    
-    # The feature model, that stores edge and track features.
-    model.getLogger().log(str(model))
-    trackIDs = model.getTrackModel().trackIDs(True) # only filtered out ones
-
-    ndiv = 0
-    for tid in trackIDs:
-
-        ndiv += 1
-        crop = create_crop_for_a_track(Final, model, tid, crop_width, crop_height, lut)
-        lut_change(crop, lut)
-               
-        outputFileName = experiment + "_celln_" + str(tid) + "_path0" + str(ndiv) + ".tif"
-        oname = str(os.path.join(outputFolder.getPath(), outputFileName))
-        IJ.log("Saving file " + oname)
-        FileSaver(crop).saveAsTiff(oname)
-        IJ.saveAs(crop, "Tiff", oname)
-        crop.changes = False
-        crop.close()
+            run_tracker = dialog_TrackCheck(message="Tracking QC: " + report.summary())
+            report.reviewed = True
+            ask = True
 
-    return True
+        tracking_params.update({'size': cell_size, 'thr': threshold, 'duration': duration,
+                                'dist1': dist1, 'dist2': dist2, 'overlap': overlap})
+    
+        # The feature model, that stores edge and track features.
+        model.getLogger().log(str(model))
+        close_tracking(track_imp, track_mask, Final)
+        if track_imp is not Final:
+            # interpolated between the tracked frames, spot id -1 where not detected
+            table = temporal.expand_table(table, temporal_factor, temporal_mode, Final.getNFrames())
+        save_output(table.write_csv, os.path.join(outputFolder.getPath(), experiment + "_spots.csv"))
+        save_output(report.write_csv, os.path.join(outputFolder.getPath(), experiment + "_qc.csv"))
+
+        with mp.stage("crop", tracks=len(table.track_ids()), spots=len(table)):
+            crop_tracks(Final, mask_image(c1, c2), table, experiment, lut, writer, mp, save_output)
+
+        log.flush()
+        return True
+    finally:
+        # after a failure or a deferred review too: nothing of the movie stays open
+        close_tracking(track_imp, track_mask, Final)
+        for leftover in (imp0, c1, c2, Final):
+            leftover.changes = False
+            leftover.close()
 
 def process_folder(inputDir, outputFolder, LUTpath, crop_width, crop_height):
 
@@ -378,14 +575,107 @@ def process_folder(inputDir, outputFolder, LUTpath, crop_width, crop_height):
     :return: True if successful
     """
 
-    image_list, masks_list = grep_file_filter(inputDir, "_MASK")
-    lut = LutLoader.openLut(LUTpath.getCanonicalPath())
-    
-    for image_i, mask_i in zip(image_list, masks_list):
-        
-        process_image(image_i, mask_i, lut, crop_width, crop_height)
-        image_i.close()
-        mask_i.close()
+    # Movies and masks paired by name, the folder listings cached in the output folder
+    index = DatasetIndex(inputDir.getPath(), PairingRules.parse(pairing),
+                         os.path.join(outputFolder.getPath(), INDEX_NAME), recursive=recursive)
+    all_pairs = index.pairs('mask')
+    log.info(index.summary())
+    lut = luts.load_lut(LUTpath)
+
+    # Skip the pairs already processed with the same files and parameters,
+    # checked as the pairs are reached
+    params = {'lut': LUTpath.getCanonicalPath(), 'crop_width': crop_width, 'crop_height': crop_height,
+              'crop_sizing': crop_sizing, 'crop_output': crop_output, 'chunk_size': chunk_size,
+              'tracker': tracker, 'compartment_mode': compartment_mode, 'compartment_rim': compartment_rim,
+              'profile_axis': profile_axis, 'profile_length': profile_length, 'profile_width': profile_width,
+              'temporal_mode': temporal_mode, 'temporal_factor': temporal_factor}
+    manifest = RunManifest(outputFolder.getPath(), params)
+    skipped = []
+    pairs = manifest.pending(all_pairs, skipped)
+
+    # With a queue folder, every worker running this script claims pairs
+    # from the shared queue and keeps its own manifest and profile
+    queue, items, profile_prefix = None, pairs, "profile"
+    if queueDir is not None:
+        pairs = items = list(pairs)
+        queue = WorkQueue(queueDir.getPath(), params)
+        manifest = RunManifest(outputFolder.getPath(), params, name=queue.worker_name("run_manifest", ".json"))
+        items = queue.claimed(pairs, key=lambda pair: pair[0].getCanonicalPath())
+        profile_prefix = queue.worker_name("profile", "")
+
+    def run(image_i, mask_i, imp0, imp1, defer):
+
+        """ Process a pair and record the outcome
+        :return: False if its review was deferred
+        """
+
+        key = image_i.getCanonicalPath()
+        manifest.start(key, mask_i.getCanonicalPath())
+        save_output = lambda save, path, key=key: manifest.save_output(key, save, path)
+        try:
+            process_image(image_i, imp0, imp1, lut, crop_width, crop_height, writer, save_output, defer)
+        except track_qc.NeedsReview, e:
+            manifest.finish(key, 'review', e)
+            log.warning(image_i.getName() + ": " + str(e) + ", kept for review")
+            return False
+        except SystemExit, e:
+            if e.code in (0, None):
+                # cancelled by the user, the job goes back to the queue
+                manifest.finish(key, 'cancelled')
+                raise
+            manifest.finish(key, 'failed', e.code)
+            if queue is not None:
+                queue.fail(key, e.code)
+            log.error(image_i.getName() + ": " + str(e.code))
+            return True
+        except Exception, e:
+            manifest.finish(key, 'failed', e)
+            if queue is not None:
+                queue.fail(key, e)
+            log.error(image_i.getName() + ": " + str(e))
+            return True
+        # marked done once its crops are written
+        writer.submit(manifest.finish, key)
+        if queue is not None:
+            writer.submit(queue.complete, key)
+        return True
+
+    # Runs out of the QC bounds are reviewed once the others are done, so the
+    # batch goes on unattended; headless workers leave them to an interactive run
+    headless = GraphicsEnvironment.isHeadless()
+    defer = track_review == track_qc.REVIEW_OUTLIERS
+    review = []
+
+    # The next pair is opened while the current one is tracked,
+    # and crops are saved while the next ones are computed
+    loader = Prefetcher(items, open_pair, size_of=lambda pair: file_size(*pair), budget_mb=prefetch_mb)
+    writer = AsyncWriter(budget_mb=prefetch_mb / 4)
+    try:
+        for (image_i, mask_i), (imp0, imp1) in loader:
+            if not run(image_i, mask_i, imp0, imp1, defer):
+                review.append((image_i, mask_i))
+                if queue is not None:
+                    # done for the queue, pending in the manifest
+                    queue.complete(image_i.getCanonicalPath())
+        if review and not headless:
+            log.info(str(len(review)) + " movies to review")
+            for image_i, mask_i in review:
+                imp0, imp1 = open_pair((image_i, mask_i))
+                run(image_i, mask_i, imp0, imp1, False)
+    finally:
+        # a failed write must not keep the profile or the queue from closing
+        try:
+            writer.close()
+        finally:
+            log.info(str(len(skipped)) + " movies were already processed")
+            try:
+                profiler.write(outputFolder.getPath(), prefix=profile_prefix)
+            finally:
+                if queue is not None:
+                    queue.close()
+                    # the last worker to finish combines the manifests and profiles
+                    if queue.finished([pair[0].getCanonicalPath() for pair in pairs]):
+                        queue.merge(outputFolder.getPath())
         
     return True
 
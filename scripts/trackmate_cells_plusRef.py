@@ -1,20 +1,34 @@
 """ This script is used to track cells in a time-lapse image series. The script is based on the TrackMate plugin for ImageJ/Fiji.
     The script requires an input mask where the cells have been cleaned up and the original image to measure fluorescence intensity
     and other variables. The script will show track the cells with the provided parameters and allow to check the tracks are correct.
-    If so, the output will be a csv file with the tracks and the fluorescence intensity of the cells.
+    If so, the output will be a csv file with the tracks and the fluorescence intensity of the cells,
+    plus per-track (_tracks.csv) and per-frame (_frames.csv) summary tables.
     NOTE: THIS SCRIPT USES TRACKMATE 7.5. THE CHANGES INTRODUCED IN THIS VERSION BROKE THE PREVIOUS SCRIPT.
 """
 
 #@ File(label="Input directory", description="Select the directory with input images", style="directory") inputDir
 #@ File(label="Output directory", description="Select the output directory", style="directory") outputFolder
 #@ File(label="LUT", description="Select the LUT for the image", style="file") LUTpath
+#@ String(label="Tracker", choices={"LoG + LAP", "Mask overlap"}, value="LoG + LAP") tracker
+#@ Integer(label="Mask channel (mask overlap tracker)", value=2) mask_channel
+#@ Integer(label="Prefetch memory budget (MB)", value=4096) prefetch_mb
+#@ Boolean(label="Write timing profiles", value=false) profile_run
+#@ String(label="Results", choices={"Experiment dataset", "CSV per movie", "Both"}, value="Experiment dataset") results_format
+#@ String(label="Track review", choices={"Outliers only", "Every movie", "None"}, value="Outliers only") track_review
+#@ File(label="QC bounds (optional JSON)", style="file", required=false) qc_bounds_file
+#@ String(label="Background", choices={"Rolling ball", "Local annulus", "Both"}, value="Rolling ball") background_mode
+#@ Integer(label="Annulus gap (px)", value=1) annulus_gap
+#@ Integer(label="Annulus width (px)", value=3) annulus_width
+#@ String(label="Track on", choices={"All frames", "Stride", "Mean bin", "Max bin"}, value="All frames") temporal_mode
+#@ Integer(label="Frames per tracked frame", value=1) temporal_factor
 
+import os
 import sys
 import csv
+from StringIO import StringIO
 from ij import IJ
-from ij.plugin import Zoom
+from ij.plugin import Zoom, Duplicator
 from ij.gui import WaitForUserDialog, GenericDialog, NonBlockingGenericDialog
-from ij.plugin import LutLoader
 from ij.plugin.frame import RoiManager
 from fiji.plugin.trackmate import Model
 from fiji.plugin.trackmate import Settings
@@ -36,6 +50,20 @@ import fiji.plugin.trackmate.features.spot.SpotIntensityMultiCAnalyzerFactory as
 import fiji.plugin.trackmate.gui.displaysettings.DisplaySettingsIO as DisplaySettingsIO
 from fiji.plugin.trackmate.gui.displaysettings.DisplaySettings import TrackMateObject
 from fiji.plugin.trackmate.gui.displaysettings.DisplaySettings import TrackDisplayMode
+from ij_utils.prefetch import Prefetcher, AsyncWriter, file_size
+from ij_utils.mapped_tiff import mapped_channel
+from ij_utils.profiler import Profiler
+from ij_utils import luts
+from ij_utils.running_stats import SpotSummaries
+from ij_utils.results_sink import ResultsSink, dataset_path
+from ij_utils.overlap_tracker import MaskOverlapTracking, TRACKER_OVERLAP, dialog_overlap
+from ij_utils import track_qc
+from ij_utils.dataset_index import DatasetIndex, PairingRules, INDEX_NAME
+from ij_utils.local_background import LocalBackground
+from ij_utils import temporal
+
+profiler = Profiler(enabled=profile_run)
+qc_bounds = track_qc.load_bounds(qc_bounds_file.getPath() if qc_bounds_file is not None else None)
 
     #----------------------------
     # Define interactive dialogs
@@ -79,11 +107,13 @@ def dialog_size_thr(title='Select images for processing', size = 1, thr = 10, df
     
     return tracking_settings
 
-def dialog_TrackCheck(title='Repeat tracking analysis?'):
+def dialog_TrackCheck(title='Repeat tracking analysis?', message=None):
 
     """ Display a dialog to check tracks are correct """
     # Define dialog
     gd = NonBlockingGenericDialog(title)
+    if message:
+        gd.addMessage(message)
     gd.enableYesNoCancel("Repeat tracking", "No")
     gd.showDialog()
 
@@ -98,22 +128,12 @@ def dialog_TrackCheck(title='Repeat tracking analysis?'):
         
 def lut_change(imp, LUTpath):
 
-    """ Change LUT to improve visibility 
+    """ Change LUT to improve visibility, once per channel
     :param imp: image to change LUT
-    :param LUTpath: path to LUT
+    :param LUTpath: path to LUT, loaded only once per session
     """
 
-    # Get image info and LUT 
-    lut = LutLoader.openLut(LUTpath.getCanonicalPath())
-    nslices = imp.getStackSize()
-    dimA = imp.getDimensions()
-    
-    for i in range(nslices):
-        # Iterate through slices
-        for ch in range(dimA[2]):
-            # Iterate through channels
-            imp.setSlice(i + 1)
-            imp.setChannelLut(lut, ch + 1)
+    luts.apply_lut(imp, luts.load_lut(LUTpath))
             
     return True
 
@@ -129,82 +149,145 @@ def zoom_image(imp, n_times):
 
     return True
 
-def process_image(imp, ref_channel = 3, outputFolder = outputFolder, tracking_settings = {}):
+def write_text(path, text):
+
+    """ Write a text file, used for the background CSV writes
+    :param path: output path
+    :param text: file content
+    """
+
+    with open(path, 'wb') as out:
+        out.write(text)
+
+def process_image(imp, ref_channel = 3, outputFolder = outputFolder, tracking_settings = {}, writer = None, sink = None,
+                  defer = False):
 
     """ Process image to track cells and measure fluorescence intensity
     :param imp: image to process
     :param ref_channel: channel to use as reference
     :param outputFolder: output folder
-    :param tracking_settings: dictionary with tracking parameters"""
+    :param tracking_settings: dictionary with tracking parameters
+    :param writer: AsyncWriter saving the results table
+    :param sink: ResultsSink of the experiment dataset, None to skip it
+    :param defer: raise track_qc.NeedsReview instead of showing an outlier run"""
 
     # Create file with results
     experiment = imp.getTitle()[:-4]
+    mp = profiler.movie(experiment)
     outpath = outputFolder.getPath() + "/"+ experiment + ".csv"
-    with open(outpath, 'wb') as resultFile:
+    resultFile = StringIO()
 
-        row_headings = ['TRACK_ID','QUALITY','POSITION_X','POSITION_Y', 'POSITION_T','FRAME', 'MEAN_MASK',
-                            'MEAN_INTENSITY', 'STANDARD_DEVIATION','CONTRAST','SNR', 'REF']
+    row_headings = ['TRACK_ID','QUALITY','POSITION_X','POSITION_Y', 'POSITION_T','FRAME', 'MEAN_MASK',
+                        'MEAN_INTENSITY', 'STANDARD_DEVIATION','CONTRAST','SNR', 'REF']
 
-        csvWriter = csv.DictWriter(resultFile, row_headings, delimiter=',', quotechar='|')
-        csvWriter.writeheader()
-        
-        # Sharpen borders
-        
-        IJ.run(imp, "Subtract Background...", "rolling=20 stack")
-        rm = RoiManager.getRoiManager()
-        imp.show()   
-        zoom_image(imp, 10)
+    # Disc and annulus means of every spot, per channel
+    local = None
+    if background_mode != "Rolling ball":
+        local = LocalBackground(gap=annulus_gap, width=annulus_width)
+        row_headings += local.headings(imp.getNChannels())
 
-        
-        lut_change(imp, LUTpath)
-        IJ.run(imp, "Enhance Contrast", "saturated=0.35")
-        if rm.getCount() == 0:
-            IJ.run(imp, "Select All", "")
-            rm.addRoi(imp.getRoi())
-            
-        ra = rm.getRoisAsArray()[0]
-        IJ.run("Select None", "")
+    csvWriter = csv.DictWriter(resultFile, row_headings, delimiter=',', quotechar='|')
+    csvWriter.writeheader()
+    columns = [(heading, []) for heading in row_headings] # the same rows for the dataset
+    
+    # The overlap tracker labels the mask before background subtraction
+    # (read from the file through a mapped view when possible instead of copied)
+    if tracker == TRACKER_OVERLAP:
+        mask = mapped_channel(imp, mask_channel)
+        if mask is None:
+            mask = Duplicator().run(imp, mask_channel, mask_channel, 1, imp.getNSlices(), 1, imp.getNFrames())
+
+    # Sharpen borders
     
-        #----------------------------
-        # Create the model object now
-        #----------------------------
+    # (skipped when the background is measured around each spot instead)
+    if background_mode != "Local annulus":
+        with mp.stage("background", frames=imp.getNFrames()):
+            IJ.run(imp, "Subtract Background...", "rolling=20 stack")
+    rm = RoiManager.getRoiManager()
+    imp.show()   
+    zoom_image(imp, 10)
+
+    # Track on fewer frames, measure on every frame of imp
+    track_imp = imp
+    if temporal.reduced(temporal_mode, temporal_factor):
+        with mp.stage("temporal", frames=imp.getNFrames()):
+            track_imp = temporal.reduce_frames(imp, temporal_factor, temporal_mode,
+                                               title=imp.getTitle() + " (tracking)")
+            if tracker == TRACKER_OVERLAP:
+                # a binned mask keeps every pixel covered in the bin
+                full_mask = mask
+                mask = temporal.reduce_frames(full_mask, temporal_factor,
+                                              temporal.MODE_STRIDE if temporal_mode == temporal.MODE_STRIDE
+                                              else temporal.MODE_MAX)
+                full_mask.close()
+        track_imp.show()
+        zoom_image(track_imp, 10)
+        lut_change(track_imp, LUTpath)
+        IJ.log(experiment + ": tracking on %d of %d frames (%s)" % (track_imp.getNFrames(), imp.getNFrames(),
+                                                                   temporal_mode))
+
     
-        # Some of the parameters we configure below need to have
-        # a reference to the model at creation. So we create an
-        # empty model now.
+    lut_change(imp, LUTpath)
+    IJ.run(imp, "Enhance Contrast", "saturated=0.35")
+    if rm.getCount() == 0:
+        IJ.run(imp, "Select All", "")
+        rm.addRoi(imp.getRoi())
         
-        model = Model()
+    ra = rm.getRoisAsArray()[0]
+    IJ.run("Select None", "")
+
+    #----------------------------
+    # Create the model object now
+    #----------------------------
+
+    # Some of the parameters we configure below need to have
+    # a reference to the model at creation. So we create an
+    # empty model now.
     
-        # Send all messages to ImageJ log window.
-        model.setLogger(Logger.IJ_LOGGER)
-        logger = Logger.IJ_LOGGER
+    model = Model()
+
+    # Send all messages to ImageJ log window.
+    model.setLogger(Logger.IJ_LOGGER)
+    logger = Logger.IJ_LOGGER
+
+    #------------------------
+    # Prepare settings object
+    #------------------------
     
-        #------------------------
-        # Prepare settings object
-        #------------------------
-        
-        nSlices = imp.getDimensions()[4]
-        if len(tracking_settings) == 0:
-            
-            tracking_settings = {'size' : 1.2, 
-                                 'thr' : 100, 
-                                 'duration' : nSlices/2, 
-                                 'dist1' : 2,
-                                 'dist2' : 2}
+    nSlices = imp.getDimensions()[4]
+    tracked_frames = track_imp.getNFrames()
+    # Parameters are asked for the first movie, when reviewing every
+    # movie, and again when a run is repeated
+    ask = len(tracking_settings) == 0 or track_review == track_qc.REVIEW_ALL
+    if len(tracking_settings) == 0:
         
-        run_tracker = True
-        while run_tracker:
-                        
-            tracking_settings = dialog_size_thr(size = tracking_settings['size'],
+        tracking_settings = {'size' : 1.2, 
+                             'thr' : 100, 
+                             'duration' : nSlices/2, 
+                             'dist1' : 2,
+                             'dist2' : 2}
+    
+    run_tracker = True
+    while run_tracker:
+                    
+        if ask and tracker == TRACKER_OVERLAP:
+            overlap = dialog_overlap(tracking_settings)
+            if overlap is None:
+                sys.exit(0)
+            tracking_settings.update(overlap)
+        elif ask:
+            tracking_settings.update(dialog_size_thr(size = tracking_settings['size'],
             thr = tracking_settings['thr'], 
             df = tracking_settings['duration'], 
             dist1 = tracking_settings['dist1'], 
-            dist2 = tracking_settings['dist2'])
-            
-            settings = Settings(imp)
+            dist2 = tracking_settings['dist2']))
         
+        settings = Settings(track_imp)
+    
+        if tracker != TRACKER_OVERLAP:
+
             # Configure detector - We use the Strings for the keys
-            
+        
             settings.detectorFactory = LogDetectorFactory()
             settings.detectorSettings = { 
                 'DO_SUBPIXEL_LOCALIZATION' : True,
@@ -213,131 +296,219 @@ def process_image(imp, ref_channel = 3, outputFolder = outputFolder, tracking_se
                 'THRESHOLD' : tracking_settings['thr'],
                 'DO_MEDIAN_FILTERING' : True,
                 }  
-        
+    
             # Configure tracker - We want to allow merges and fusions
-        
+    
             settings.trackerFactory = SparseLAPTrackerFactory()
             #settings.trackerSettings = LAPUtils.getDefaultLAPSettingsMap() # almost good enough
             settings.trackerSettings = settings.trackerFactory.getDefaultSettings() 
             settings.trackerSettings['LINKING_MAX_DISTANCE'] = tracking_settings['dist1']
             settings.trackerSettings['GAP_CLOSING_MAX_DISTANCE'] = tracking_settings['dist2']
-            settings.trackerSettings['MAX_FRAME_GAP'] = nSlices/20
+            settings.trackerSettings['MAX_FRAME_GAP'] = tracked_frames/20
             settings.trackerSettings['ALLOW_TRACK_SPLITTING'] = False
             settings.trackerSettings['ALLOW_TRACK_MERGING'] = False
-        
-            # Configure track analyzers - Later on we want to filter out tracks 
-            # based on their displacement, so we need to state that we want 
-            # track displacement to be calculated. By default, out of the GUI, 
-            # not features are calculated. 
-        
-            # The displacement feature is provided by the TrackDurationAnalyzer.
-            # Spot analyzer: we want the multi-C intensity analyzer.
-            
-            spotIntensityAnalyzer = SpotIntensityMultiCAnalyzerFactory()
-            spotIntensityAnalyzer.setNChannels( imp.getNChannels() )
-            settings.addSpotAnalyzerFactory( spotIntensityAnalyzer )
-            settings.addTrackAnalyzer(TrackDurationAnalyzer())
-            settings.addTrackAnalyzer( TrackIndexAnalyzer() )
-            snrAnalyzer = SpotContrastAndSNRAnalyzerFactory()
-            snrAnalyzer.setNChannels( imp.getNChannels() )
-            settings.addSpotAnalyzerFactory( snrAnalyzer )
-            
-            # Filter out short tracks
     
-            dur_filter = FeatureFilter('TRACK_DURATION', tracking_settings['duration'], True)
-            settings.addTrackFilter(dur_filter)
-            
-            #-------------------
-            # Instantiate plugin
-            #-------------------
+        # Configure track analyzers - Later on we want to filter out tracks 
+        # based on their displacement, so we need to state that we want 
+        # track displacement to be calculated. By default, out of the GUI, 
+        # not features are calculated. 
+    
+        # The displacement feature is provided by the TrackDurationAnalyzer.
+        # Spot analyzer: we want the multi-C intensity analyzer.
         
-            trackmate = TrackMate(model, settings)
-            
-            #--------
-            # Process
-            #--------
+        spotIntensityAnalyzer = SpotIntensityMultiCAnalyzerFactory()
+        spotIntensityAnalyzer.setNChannels( track_imp.getNChannels() )
+        settings.addSpotAnalyzerFactory( spotIntensityAnalyzer )
+        settings.addTrackAnalyzer(TrackDurationAnalyzer())
+        settings.addTrackAnalyzer( TrackIndexAnalyzer() )
+        snrAnalyzer = SpotContrastAndSNRAnalyzerFactory()
+        snrAnalyzer.setNChannels( track_imp.getNChannels() )
+        settings.addSpotAnalyzerFactory( snrAnalyzer )
         
-            ok = trackmate.checkInput()
-            if not ok:
-                sys.exit(str(trackmate.getErrorMessage()))
-            
-            ok = trackmate.process()
-            if not ok:
-                sys.exit(str(trackmate.getErrorMessage()))
+        # Filter out short tracks
+
+        dur_filter = FeatureFilter('TRACK_DURATION', tracking_settings['duration'], True)
+        settings.addTrackFilter(dur_filter)
         
-            #----------------
-            # Display results
-            #----------------
-
-            selectionModel = SelectionModel(model)
-            ds = DisplaySettingsIO.readUserDefault()
-            ds.setTrackColorBy(TrackMateObject.TRACKS, 'TRACK_DURATION' )
-            ds.setTrackDisplayMode(TrackDisplayMode.LOCAL_BACKWARD)
-            ds.setTrackMinMax(tracking_settings['duration'], nSlices) 
-            ds.setFadeTrackRange(nSlices)
-            
-            displayer =  HyperStackDisplayer(model, selectionModel, imp, ds)
-            displayer.render()
-            displayer.refresh()
-            trackIDs = model.getTrackModel().trackIDs(True)
-            t_analyzer = TrackDurationAnalyzer()
-            for tid in trackIDs:
-                dur = model.getFeatureModel().getTrackFeature( tid, TrackDurationAnalyzer.TRACK_DURATION )
-                IJ.log("TRACK_D: " + str(tid) + " TRACK_DURATION: " + str(dur))
+        #-------------------
+        # Instantiate plugin
+        #-------------------
+    
+        if tracker == TRACKER_OVERLAP:
+            # Objects of the mask linked by overlap, no detection
+            trackmate = MaskOverlapTracking(model, settings, mask, 1,
+                                            min_size=tracking_settings['min_size'],
+                                            min_iou=tracking_settings['min_iou'],
+                                            max_gap=temporal.frame_gap(tracking_settings['max_gap'],
+                                                                       temporal_factor, temporal_mode))
+        else:
+            trackmate = TrackMate(model, settings)
         
-            run_tracker = dialog_TrackCheck()
+        #--------
+        # Process
+        #--------
     
-        # The feature model, that stores edge and track features.
-        model.getLogger().log(str(model))
+        ok = trackmate.checkInput()
+        if not ok:
+            sys.exit(str(trackmate.getErrorMessage()))
+        
+        ok = trackmate.process()
+        if not ok:
+            sys.exit(str(trackmate.getErrorMessage()))
+
+        #-----------------
+        # Quality control
+        #-----------------
+
+        report = track_qc.assess(model, track_imp, tracking_settings['duration'], qc_bounds)
+        IJ.log(experiment + " tracking QC: " + report.summary())
+        if not ask and not track_qc.needs_review(track_review, report):
+            run_tracker = False
+            continue
+        if defer and not ask:
+            # reviewed after the movies that passed
+            if tracker == TRACKER_OVERLAP:
+                mask.close()
+            IJ.run("Close All", "")
+            rm.runCommand("Delete")
+            imp.close()
+            raise track_qc.NeedsReview(report)
     
-        trackIDs = model.getTrackModel().trackIDs(True) # only filtered out ones
-        for id in trackIDs:
-            
-            # Fetch the track feature from the feature model.
-            
-            track = model.getTrackModel().trackSpots(id)
-            for spot in track:
-                sid = spot.ID()
-                # Fetch spot features directly from spot. 
-                x = spot.getFeature('POSITION_X')
-                y = spot.getFeature('POSITION_Y') 
-                pos_t = spot.getFeature('POSITION_T')
+        #----------------
+        # Display results
+        #----------------
+
+        selectionModel = SelectionModel(model)
+        ds = DisplaySettingsIO.readUserDefault()
+        ds.setTrackColorBy(TrackMateObject.TRACKS, 'TRACK_DURATION' )
+        ds.setTrackDisplayMode(TrackDisplayMode.LOCAL_BACKWARD)
+        ds.setTrackMinMax(tracking_settings['duration'], nSlices) 
+        ds.setFadeTrackRange(tracked_frames)
         
-                t = spot.getFeature('FRAME')
-                q = spot.getFeature('QUALITY')
+        displayer =  HyperStackDisplayer(model, selectionModel, track_imp, ds)
+        displayer.render()
+        displayer.refresh()
+        trackIDs = model.getTrackModel().trackIDs(True)
+        t_analyzer = TrackDurationAnalyzer()
+        for tid in trackIDs:
+            dur = model.getFeatureModel().getTrackFeature( tid, TrackDurationAnalyzer.TRACK_DURATION )
+            IJ.log("TRACK_D: " + str(tid) + " TRACK_DURATION: " + str(dur))
+    
+        run_tracker = dialog_TrackCheck(message="Tracking QC: " + report.summary())
+        report.reviewed = True
+        ask = True
+
+    # The feature model, that stores edge and track features.
+    model.getLogger().log(str(model))
+
+    trackIDs = model.getTrackModel().trackIDs(True) # only filtered out ones
+    summaries = SpotSummaries() # per-track and per-frame tables, updated as spots are written
+    cal = imp.getCalibration()
+    # (track id, frame, x, y, t, quality, radius in pixels, TrackMate spot or None)
+    if track_imp is imp:
+        records = [(tid, int(spot.getFeature('FRAME')), spot.getFeature('POSITION_X'),
+                    spot.getFeature('POSITION_Y'), spot.getFeature('POSITION_T'), spot.getFeature('QUALITY'),
+                    spot.getFeature('RADIUS') / cal.pixelWidth, spot)
+                   for tid in trackIDs for spot in model.getTrackModel().trackSpots(tid)]
+    else:
+        # every frame of the tracks, the frames in between interpolated
+        # (subpixel); with a stride the detected spots keep their TrackMate
+        # features, bins were measured by TrackMate on the reduced movie only
+        keep_spots = temporal_mode == temporal.MODE_STRIDE
+        records = []
+        for tid in trackIDs:
+            spots = dict((spot.ID(), spot) for spot in model.getTrackModel().trackSpots(tid))
+            points = [(int(spot.getFeature('FRAME')), spot.getFeature('POSITION_X'), spot.getFeature('POSITION_Y'),
+                       spot.getFeature('RADIUS') / cal.pixelWidth, spot.getFeature('QUALITY'), sid)
+                      for sid, spot in spots.items()]
+            for t, x, y, radius, q, sid in temporal.expand_track(points, temporal_factor, temporal_mode,
+                                                                 imp.getNFrames()):
+                records.append((tid, t, x, y, t * (cal.frameInterval or 1.0), q, radius,
+                                spots.get(sid) if keep_spots else None))
+        track_imp.changes = False
+        track_imp.close()
+
+    # Disc means on the original frames replace the TrackMate intensities of
+    # the interpolated spots, and of all spots when the tracked movie was
+    # binned (TrackMate measured those on the bins, not on the frames)
+    measurer = local
+    if measurer is None and track_imp is not imp:
+        measurer = LocalBackground(gap=annulus_gap, width=annulus_width)
+    local_values = {}
+    if measurer is not None:
+        with mp.stage("local_background", tracks=len(trackIDs)):
+            local_values = measurer.measure(imp, [((tid, t), t, x / cal.pixelWidth, y / cal.pixelHeight, radius)
+                                                  for tid, t, x, y, pos_t, q, radius, spot in records
+                                                  if local is not None or spot is None])
+    with mp.stage("export", tracks=len(trackIDs)) as stage:
+        for id, t, x, y, pos_t, q, radius, spot in records:
+            if spot is not None:
+                # Fetch spot features directly from spot.
                 mean = spot.getFeature('MEAN_INTENSITY_CH1')
                 mean_mask = spot.getFeature('MEAN_INTENSITY_CH2')
-                    
                 std = spot.getFeature('STD_INTENSITY_CH1')
                 contrast = spot.getFeature('CONTRAST_CH1')
                 snr = spot.getFeature('SNR_CH1')
-                imp.setPosition(1, 1, int(t))
-                processor = 2 * (t) + 1
-                ip = imp.getProcessor()
-                ip.setRoi(ra)
-                stats = ip.getStatistics()
-
-                # Write results
-                row = {'TRACK_ID' : id,
-                        'QUALITY' : q,
-                        'POSITION_X' : x,
-                        'POSITION_Y' : y, 
-                        'POSITION_T' : pos_t,
-                        'FRAME' : t, 
-                        'MEAN_MASK' : mean_mask,
-                        'MEAN_INTENSITY' : mean, 
-                        'STANDARD_DEVIATION' : std, 
-                        'CONTRAST' : contrast,
-                        'SNR' : snr, 
-                        'REF' : stats.mean}
-                csvWriter.writerow(row)
-
-        resultFile.close()
-        IJ.run("Close All", "")
-        rm.runCommand("Delete")
-        imp.close()
-
-        return tracking_settings
+            else:
+                # DISC_MEAN_CH1 and DISC_MEAN_CH2, see LocalBackground.headings
+                mean, mean_mask = local_values[(id, t)][0], local_values[(id, t)][3]
+                std = contrast = snr = None
+            imp.setPosition(1, 1, int(t))
+            processor = 2 * (t) + 1
+            ip = imp.getProcessor()
+            ip.setRoi(ra)
+            stats = ip.getStatistics()
+
+            # Write results
+            row = {'TRACK_ID' : id,
+                    'QUALITY' : q,
+                    'POSITION_X' : x,
+                    'POSITION_Y' : y, 
+                    'POSITION_T' : pos_t,
+                    'FRAME' : t, 
+                    'MEAN_MASK' : mean_mask,
+                    'MEAN_INTENSITY' : mean, 
+                    'STANDARD_DEVIATION' : std, 
+                    'CONTRAST' : contrast,
+                    'SNR' : snr, 
+                    'REF' : stats.mean}
+            if local is not None:
+                row.update(zip(local.headings(imp.getNChannels()), local_values[(id, t)]))
+            csvWriter.writerow(row)
+            for heading, values in columns:
+                values.append(row[heading])
+            summaries.add(id, t, x, y, mean, snr, stats.mean)
+            stage.count(spots=1)
+
+    # Write the table in the background while the next movie is tracked
+    if sink is not None:
+        writer.submit(mp.wrap("save", sink.append), imp.getTitle(), columns,
+                      {'FILE': imp.getTitle(), 'EXPERIMENT': inputDir.getName()})
+    if results_format != "Experiment dataset":
+        writer.submit(mp.wrap("save", write_text), outpath, resultFile.getvalue())
+    writer.submit(report.write_csv, outputFolder.getPath() + "/" + experiment + "_qc.csv")
+    writer.submit(mp.wrap("save", summaries.write),
+                  outputFolder.getPath() + "/" + experiment + "_tracks.csv",
+                  outputFolder.getPath() + "/" + experiment + "_frames.csv")
+    resultFile.close()
+    if tracker == TRACKER_OVERLAP:
+        mask.close()
+    IJ.run("Close All", "")
+    rm.runCommand("Delete")
+    imp.close()
+
+    return tracking_settings
+
+def open_movie(file_i):
+
+    """ Open a movie, used by the prefetcher
+    :param file_i: movie file
+    """
+
+    with profiler.movie(file_i.getName()[:-4]).stage("open") as stage:
+        imp = IJ.openImage(file_i.getCanonicalPath())
+        stage.count(frames=imp.getNFrames())
+    return imp
 
 def process_forlder(inputDir, outputFolder):
 
@@ -347,19 +518,51 @@ def process_forlder(inputDir, outputFolder):
     """
     
     tracking_settings = {}
-    for file_i in inputDir.listFiles():
-        
-        if '.tif' in file_i.getCanonicalPath():
-            imp = IJ.openImage(file_i.getCanonicalPath())
+    # Movies in name order, the folder listing cached in the output folder
+    index = DatasetIndex(inputDir.getPath(), PairingRules(), os.path.join(outputFolder.getPath(), INDEX_NAME))
+    files = index.files()
+
+    # Open the next movie while the current one is tracked
+    loader = Prefetcher(files, open_movie,
+                        size_of=file_size, budget_mb=prefetch_mb)
+    writer = AsyncWriter(budget_mb=prefetch_mb / 4)
+    # All the spot tables of the input folder go to one dataset
+    sink = None
+    if results_format != "CSV per movie":
+        sink = ResultsSink(dataset_path(outputFolder.getPath(), inputDir.getName()))
+    # Runs out of the QC bounds are reviewed once the others are done
+    defer = track_review == track_qc.REVIEW_OUTLIERS
+    review = []
+    try:
+        for file_i, imp in loader:
             experiment = file_i.getName()
         
             print("#--------------------- Start analysing movie: ")
             print("\n original: " +experiment)
         
-            tracking_settings = process_image(imp, 
-                                          ref_channel = 3, 
-                                          outputFolder = outputFolder, 
-                                          tracking_settings = tracking_settings)
+            try:
+                tracking_settings = process_image(imp, 
+                                              ref_channel = 3, 
+                                              outputFolder = outputFolder, 
+                                              tracking_settings = tracking_settings,
+                                              writer = writer,
+                                              sink = sink,
+                                              defer = defer)
+            except track_qc.NeedsReview, e:
+                IJ.log(experiment + ": " + str(e) + ", kept for review")
+                review.append(file_i)
+        if review:
+            IJ.log(str(len(review)) + " movies to review")
+        for file_i in review:
+            tracking_settings = process_image(open_movie(file_i),
+                                              ref_channel = 3,
+                                              outputFolder = outputFolder,
+                                              tracking_settings = tracking_settings,
+                                              writer = writer,
+                                              sink = sink)
+    finally:
+        writer.close()
+        profiler.write(outputFolder.getPath())
 
     return True
 
@@ -10,12 +10,13 @@ and saves them as separate stack to train on.
 
 import random
 from ij import IJ
+from ij_utils.mapped_tiff import open_mapped
 
 def sample_slices(imp, stack_size, n_samples, imp_out, last_count):
 
 	"""Sample N slices from a ImagePlus
 
-	imp: reference imagePlus
+	imp: reference imagePlus (memory-mapped, only the sampled slices are read)
 	stack_size: number of slices in the stack
 	n_samples: total number of slices to subset
 	imp_out: imagePlus to collect the output
@@ -23,16 +24,16 @@ def sample_slices(imp, stack_size, n_samples, imp_out, last_count):
 	"""
 
 	sample_slices = [random.randrange(1, stack_size) for x in range(n_samples)]
+	stack, stack_out = imp.getStack(), imp_out.getStack()
+	# pasted centred, converted to 8-bit with scaling as Edit>Paste does
+	x0 = (imp_out.getWidth() - imp.getWidth()) // 2
+	y0 = (imp_out.getHeight() - imp.getHeight()) // 2
 	n = 1 + last_count
 	for i in sample_slices:
 		print("Paste Slice: " + str(i))
-		imp.setSlice(i)
-		IJ.run("Select None")
-		imp.copy()
-		imp_out.setSlice(n)
-		IJ.run("Select None")
-		imp_out.paste()
+		stack_out.getProcessor(n).insert(stack.getProcessor(i).convertToByte(True), x0, y0)
 		n += 1
+	imp_out.updateAndDraw()
 
 	return True
 
@@ -55,7 +56,7 @@ def process_folder(folder, n_samples, dimx = 512, dimy = 512):
 	
 	for file_i in fil_list:
 		last_count = n * n_samples
-		imp0 = IJ.openImage(file_i.getAbsolutePath())
+		imp0 = open_mapped(file_i.getAbsolutePath())
 		imp_dim = imp0.getDimensions()	
 		stack_size = imp_dim[4]
 		sample_slices(imp0, stack_size, n_samples, imp_out, last_count)